@@ -207,6 +207,12 @@ STATIC_ROOT = os.path.join(BASE_DIR, "static")
 
 # Media files (Uploaded files)
 MEDIA_ROOT = os.environ.get("MEDIA_ROOT", os.path.join(BASE_DIR, "media"))
+
+# Cache for files downloaded by the management commands
+FETCH_CACHE_DIR = os.environ.get(
+    "FETCH_CACHE_DIR", os.path.join(BASE_DIR, ".cache", "fetch")
+)
+
 AWS_S3_ACCESS_KEY_ID = os.environ.get("AWS_S3_ACCESS_KEY_ID")
 AWS_S3_SECRET_ACCESS_KEY = os.environ.get("AWS_S3_SECRET_ACCESS_KEY")
 AWS_STORAGE_BUCKET_NAME = os.environ.get("AWS_STORAGE_BUCKET_NAME", "charity-accounts")
@@ -118,9 +118,11 @@ class CSVUploadModelAdmin(admin.ModelAdmin):
                     setattr(obj, k, v)
             bulk_updates.append(obj)
         if bulk_updates:
-            return self.model.objects.bulk_update(
-                bulk_updates, keys_found, batch_size=1_000
-            )
+            return self.bulk_update_rows(bulk_updates, keys_found)
+
+    def bulk_update_rows(self, objs, fields):
+        """Save the rows changed by an upload, returning the number updated."""
+        return self.model.objects.bulk_update(objs, fields, batch_size=1_000)
 
     def upload_csv_file(self, request):
         non_readonly_fields = [
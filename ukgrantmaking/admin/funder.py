@@ -8,7 +8,12 @@ from django.utils.html import format_html, format_html_join
 
 from ukgrantmaking.admin.csv_upload import CSVUploadModelAdmin
 from ukgrantmaking.admin.funder_financial_year import FunderFinancialYearInline
-from ukgrantmaking.admin.utils import Action, DBViewAdmin, add_admin_actions
+from ukgrantmaking.admin.utils import (
+    Action,
+    DBViewAdmin,
+    DeferredRecomputeAdminMixin,
+    add_admin_actions,
+)
 from ukgrantmaking.management.commands.funders.fetch_ftc import (
     do_ftc_finance,
     do_ftc_funders,
@@ -138,7 +143,7 @@ class FunderNoteInline(GenericTabularInline):
         return False
 
 
-class FunderAdmin(CSVUploadModelAdmin):
+class FunderAdmin(DeferredRecomputeAdminMixin, CSVUploadModelAdmin):
     list_display = (
         "org_id",
         "name",
@@ -2,6 +2,7 @@ from django.contrib import admin
 
 from ukgrantmaking.admin.csv_upload import CSVUploadModelAdmin
 from ukgrantmaking.admin.funder_year import FunderYearInline
+from ukgrantmaking.admin.utils import DeferredRecomputeAdminMixin
 from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
 
 
@@ -16,7 +17,7 @@ class FunderFinancialYearInline(admin.StackedInline):
     ordering = ("-financial_year_id",)
 
 
-class FunderFinancialYearAdmin(CSVUploadModelAdmin):
+class FunderFinancialYearAdmin(DeferredRecomputeAdminMixin, CSVUploadModelAdmin):
     list_display = (
         "funder__org_id",
         "funder__name",
@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.utils.html import format_html
 
 from ukgrantmaking.admin.csv_upload import CSVUploadModelAdmin
+from ukgrantmaking.admin.utils import DeferredRecomputeAdminMixin
 from ukgrantmaking.models.funder_year import FunderYear
 
 
@@ -124,7 +125,7 @@ class FunderYearInline(admin.StackedInline):
         return ""
 
 
-class FunderYearAdmin(CSVUploadModelAdmin):
+class FunderYearAdmin(DeferredRecomputeAdminMixin, CSVUploadModelAdmin):
     list_display = (
         "funder__org_id",
         "funder__name",
@@ -1,5 +1,9 @@
+import json
+from collections import defaultdict
+
 from django.contrib import admin
-from django.db import models
+from django.contrib.admin.models import CHANGE, LogEntry
+from django.db import models, transaction
 from django.db.models import Count, Q
 from django.db.models.aggregates import Sum
 from django.db.models.functions import ExtractYear
@@ -8,7 +12,7 @@ from django.utils.html import format_html
 from ukgrantmaking.admin.csv_upload import CSVUploadModelAdmin
 from ukgrantmaking.admin.utils import Action, add_admin_actions
 from ukgrantmaking.models.financial_years import FinancialYear
-from ukgrantmaking.models.grant import Grant, GrantRecipientYear
+from ukgrantmaking.models.grant import DirtyFunderYear, Grant, GrantRecipientYear
 
 
 class EmptyOrOneFieldListFilter(admin.EmptyFieldListFilter):
@@ -308,13 +312,59 @@ class GrantAdmin(CSVUploadModelAdmin):
 
         return {
             **actions,
-            **add_admin_actions(action_fields),
+            **add_admin_actions(
+                action_fields, before_update=DirtyFunderYear.objects.mark_grants
+            ),
         }
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
         return qs.select_related("funder")
 
+    def bulk_update_rows(self, objs, fields):
+        # save through `Grant.bulk_save` so the funder years the grants
+        # counted towards, before and after the upload, are marked
+        Grant.bulk_save(objs, fields)
+        return len(objs)
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Collect the grants edited on the changelist in `save_model` and
+        `log_change`, then save and log them together with `Grant.bulk_save`
+        rather than one at a time.
+        """
+        if request.method != "POST" or "_save" not in request.POST:
+            return super().changelist_view(request, extra_context)
+        request._changelist_saves = []
+        request._changelist_logs = defaultdict(list)
+        with transaction.atomic():
+            response = super().changelist_view(request, extra_context)
+            grants = [grant for grant, _ in request._changelist_saves]
+            fields = {
+                field for _, changed in request._changelist_saves for field in changed
+            }
+            Grant.bulk_save(grants, fields)
+            for change_message, changed in request._changelist_logs.items():
+                LogEntry.objects.log_actions(
+                    user_id=request.user.pk,
+                    queryset=changed,
+                    action_flag=CHANGE,
+                    change_message=change_message,
+                )
+        return response
+
+    def save_model(self, request, obj, form, change):
+        if change and hasattr(request, "_changelist_saves"):
+            request._changelist_saves.append((obj, form.changed_data))
+            return
+        super().save_model(request, obj, form, change)
+
+    def log_change(self, request, obj, message):
+        if hasattr(request, "_changelist_logs"):
+            request._changelist_logs[json.dumps(message)].append(obj)
+            return
+        return super().log_change(request, obj, message)
+
 
 class GrantRecipientYearAdminInline(admin.TabularInline):
     model = GrantRecipientYear
@@ -1,12 +1,16 @@
 from dataclasses import dataclass
+from typing import Callable
 
 from django.contrib import admin, messages
 from django.contrib.admin.utils import (
     quote,
 )
 from django.contrib.admin.views.main import ChangeList
+from django.db.models import QuerySet
 from django.urls import reverse
 
+from ukgrantmaking.utils.recompute import deferred_recompute
+
 
 @dataclass
 class Action:
@@ -16,9 +20,14 @@ class Action:
     set_null: bool = False
 
 
-def add_admin_actions(action_fields: list[Action]):
+def add_admin_actions(
+    action_fields: list[Action],
+    before_update: Callable[[QuerySet], None] | None = None,
+):
     def make_action_function(field_label, field, value):
         def action_function(modeladmin, request, queryset):
+            if before_update:
+                before_update(queryset)
             queryset.update(**{field: value})
             modeladmin.message_user(
                 request,
@@ -74,3 +83,23 @@ class DBViewAdmin(admin.ModelAdmin):
         Return the ChangeList class for use on the changelist page.
         """
         return AdminViewChangeList
+
+
+class DeferredRecomputeAdminMixin:
+    """
+    Run the updates from saving funders and funder years once per request,
+    rather than once for every object saved by the changelist, change form
+    inlines or a CSV upload.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        with deferred_recompute():
+            return super().changelist_view(request, extra_context)
+
+    def changeform_view(self, request, object_id=None, form_url="", extra_context=None):
+        with deferred_recompute():
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+    def upload_csv_file(self, request):
+        with deferred_recompute():
+            return super().upload_csv_file(request)
@@ -1,7 +1,8 @@
 import djclick as click
 import pandas as pd
+from django.db import connection, transaction
 
-from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.spreadsheet import iter_spreadsheet
 
 FIELDS_TO_UPDATE = [
     ("Employees: Number of permanent employees", "employees_permanent_registered"),
@@ -29,79 +30,103 @@ FIELDS_TO_UPDATE = [
     ),
 ]
 
+CHARITY_NUMBER_COLUMN = "Registered charity number"
+FINANCIAL_YEAR_END_COLUMN = "fin_period_end_date"
+DEBUG_ROWS = 1_000
+
+# Update the funder years that match a charity and financial year end in the
+# file. Values that are missing from the file are left unchanged, and the
+# total employees are only set if the funder year doesn't have a value yet.
+UPDATE_CCEW_FINANCES_QUERY = """
+    UPDATE ukgrantmaking_funderyear AS fy
+    SET {set_fields},
+        employees_registered = CASE
+            WHEN fy.employees IS NULL AND v.employees IS NOT NULL THEN v.employees
+            ELSE fy.employees_registered
+        END,
+        content_hash = NULL
+    FROM ukgrantmaking_funderfinancialyear AS ffy,
+        unnest(
+            %(org_id)s::text[],
+            %(financial_year_end)s::date[],
+            {field_arrays},
+            %(employees)s::numeric[]
+        ) AS v(org_id, financial_year_end, {field_names}, employees)
+    WHERE fy.funder_financial_year_id = ffy.id
+        AND ffy.funder_id = v.org_id
+        AND fy.financial_year_end = v.financial_year_end
+""".format(
+    set_fields=",\n        ".join(
+        f"{field} = COALESCE(v.{field}, fy.{field})" for _, field in FIELDS_TO_UPDATE
+    ),
+    field_arrays=",\n            ".join(
+        f"%({field})s::numeric[]" for _, field in FIELDS_TO_UPDATE
+    ),
+    field_names=", ".join(field for _, field in FIELDS_TO_UPDATE),
+)
 
-@click.command()
-@click.argument("file")
-@click.option("--sheet", default="Sheet1")
-@click.option("--skip-rows", default=0, type=int)
-@click.option("--debug", is_flag=True, default=False)
-def ccew(file, sheet: str, skip_rows: int = 0, debug: bool = False):
-    click.secho("Opening {}".format(file), fg="green")
-    df = pd.read_excel(file, sheet_name=sheet, skiprows=skip_rows)
-    click.secho("{:,.0f} rows in datafile".format(len(df)), fg="green")
 
-    # for employee fields, replace "0 - 2" with None
-    for field_name, _ in FIELDS_TO_UPDATE:
+def prepare_ccew_rows(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.dropna(subset=[CHARITY_NUMBER_COLUMN, FINANCIAL_YEAR_END_COLUMN])
+    values = pd.DataFrame(
+        {
+            "org_id": "GB-CHC-"
+            + pd.to_numeric(df[CHARITY_NUMBER_COLUMN]).astype("int64").astype(str),
+            "financial_year_end": pd.to_datetime(df[FINANCIAL_YEAR_END_COLUMN]).dt.date,
+        },
+        index=df.index,
+    )
+    for field_name, field in FIELDS_TO_UPDATE:
+        column = df[field_name]
+        # for employee fields, replace "0 - 2" with None
         if field_name.startswith("Employees"):
-            df[field_name] = pd.to_numeric(df[field_name].replace("0 - 2", pd.NA))
+            column = column.replace("0 - 2", pd.NA)
+        values[field] = pd.to_numeric(column)
 
-    if debug:
-        df = df.sample(1000)
-    updates = []
-    values = {}
-    org_ids = set()
-    fyes = set()
-    with click.progressbar(
-        df.iterrows(),
-        length=len(df),
-        label="Updating finances from CCEW data",
-    ) as bar:
-        for index, row in bar:
-            org_id = f"GB-CHC-{row['Registered charity number']:.0f}"
-            fye = row["fin_period_end_date"].to_pydatetime().date()
-            org_ids.add(org_id)
-            fyes.add(fye)
-            values[(org_id, fye)] = row
+    employee_fields = [
+        field for _, field in FIELDS_TO_UPDATE if field.startswith("employees")
+    ]
+    values["employees"] = values[employee_fields].sum(axis=1, min_count=1)
 
-    qs = FunderYear.objects.filter(
-        funder_financial_year__funder_id__in=org_ids,
-        financial_year_end__in=fyes,
-    ).select_related("funder_financial_year")
-    with click.progressbar(
-        qs,
-        length=qs.count(),
-        label="Fetching existing rows from database",
-    ) as bar:
-        for funder_year in bar:
-            try:
-                row = values[
-                    (
-                        funder_year.funder_financial_year.funder_id,
-                        funder_year.financial_year_end,
-                    )
-                ]
-            except KeyError:
-                continue
+    # if a charity and year is in the file more than once use the last row
+    return values.drop_duplicates(subset=["org_id", "financial_year_end"], keep="last")
 
-            employees = None
-            for field_name, field in FIELDS_TO_UPDATE:
-                if not pd.isna(row[field_name]):
-                    setattr(funder_year, field, row[field_name])
-                    if field.startswith("employees"):
-                        if employees is None:
-                            employees = 0
-                        employees += int(row[field_name])
 
-            if employees is not None and funder_year.employees is None:
-                funder_year.employees_registered = employees
+def update_ccew_finances(values: pd.DataFrame) -> int:
+    params = {
+        column: [None if pd.isna(value) else value for value in values[column].tolist()]
+        for column in values.columns
+    }
+    with connection.cursor() as cursor:
+        cursor.execute(UPDATE_CCEW_FINANCES_QUERY, params)
+        return cursor.rowcount
 
-            updates.append(funder_year)
 
-    years_updated = FunderYear.objects.bulk_update(
-        updates,
-        [f[1] for f in FIELDS_TO_UPDATE] + ["employees_registered"],
-        batch_size=500,
-    )
+@click.command()
+@click.argument("file")
+@click.option("--sheet", default="Sheet1")
+@click.option("--skip-rows", default=0, type=int)
+@click.option("--debug", is_flag=True, default=False)
+def ccew(file, sheet: str, skip_rows: int = 0, debug: bool = False):
+    click.secho("Opening {}".format(file), fg="green")
+    columns = [CHARITY_NUMBER_COLUMN, FINANCIAL_YEAR_END_COLUMN] + [
+        field_name for field_name, _ in FIELDS_TO_UPDATE
+    ]
+
+    rows = 0
+    years_updated = 0
+    with transaction.atomic():
+        for df in iter_spreadsheet(
+            file, sheet=sheet, skip_rows=skip_rows, columns=columns
+        ):
+            rows += len(df)
+            years_updated += update_ccew_finances(prepare_ccew_rows(df))
+            click.secho(
+                f"{rows:,.0f} rows read, {years_updated:,.0f} funder years updated",
+                fg="green",
+            )
+            if debug and rows >= DEBUG_ROWS:
+                break
 
     click.secho(
         f"Updated {years_updated} charity financial years for funders", fg="green"
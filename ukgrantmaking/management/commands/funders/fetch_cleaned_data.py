@@ -1,10 +1,33 @@
 from glob import glob
 
 import djclick as click
-import numpy as np
 import pandas as pd
+from django.db import transaction
 
 from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.bulk import UpsertKey, bulk_upsert
+from ukgrantmaking.utils.funder_year import (
+    add_funder_year_notes,
+    funder_financial_year_ids,
+    refresh_funder_financial_years,
+)
+from ukgrantmaking.utils.spreadsheet import read_spreadsheet
+
+# columns in the cleaned data files, and the funder year field they update
+CHECKED_FIELDS = {
+    "income_checked": "income_manual",
+    "spending_checked": "spending_manual",
+    "exp_charble_checked": "spending_charitable_manual",
+    "spending_on_grants_to_individuals": "spending_grant_making_individuals_manual",
+    "spending_on_grants_to_institutions": "spending_grant_making_institutions_main_manual",
+    "total_assets_checked": "total_net_assets_manual",
+    "funds_end_checked": "funds_manual",
+    "funds_endowment_checked": "funds_endowment_manual",
+    "funds_restrict_checked": "funds_restricted_manual",
+    "funds_unrestrict_checked": "funds_unrestricted_manual",
+    "employees_checked": "employees_manual",
+    "checked_by": "checked_by",
+}
 
 
 @click.command(deprecated=True)
@@ -35,7 +58,7 @@ def cleaned_data(files):
         for file in glob(globbable):
             click.secho("Opening {}".format(file), fg="green")
             df = (
-                pd.read_excel(file)[index_columns + columns_to_use]
+                read_spreadsheet(file)[index_columns + columns_to_use]
                 .dropna(
                     subset=index_columns,
                     how="any",
@@ -51,31 +74,35 @@ def cleaned_data(files):
     checked_data = pd.concat(checked_data, ignore_index=True)
     click.secho("Found {} records total".format(len(checked_data)), fg="green")
 
-    records = {
-        "Created": 0,
-        "Updated": 0,
-    }
-    for record in checked_data.replace({np.nan: None}).itertuples():
-        funder, created = FunderYear.objects.update_or_create(
-            funder_id=record.org_id,
-            financial_year_end=record.fyend,
-            defaults=dict(
-                income_manual=record.income_checked,
-                spending_manual=record.spending_checked,
-                spending_charitable_manual=record.exp_charble_checked,
-                spending_grant_making_individuals_manual=record.spending_on_grants_to_individuals,
-                spending_grant_making_institutions_main_manual=record.spending_on_grants_to_institutions,
-                total_net_assets_manual=record.total_assets_checked,
-                funds_manual=record.funds_end_checked,
-                funds_endowment_manual=record.funds_end_checked,
-                funds_restricted_manual=record.funds_restrict_checked,
-                funds_unrestricted_manual=record.funds_unrestrict_checked,
-                employees_manual=record.employees_checked,
-                checked_by=record.checked_by,
-                notes=record.notes,
-            ),
+    checked_data["funds_endowment_checked"] = checked_data["funds_end_checked"]
+    checked_data["fyend"] = pd.to_datetime(checked_data["fyend"]).dt.date
+    ffy_ids = funder_financial_year_ids(
+        zip(checked_data["org_id"], checked_data["fyend"])
+    )
+
+    def new_funder_year(row: dict) -> FunderYear | None:
+        ffy_id = ffy_ids.get((row["org_id"], row["fyend"]))
+        if ffy_id is None:
+            return None
+        return FunderYear(
+            funder_financial_year_id=ffy_id, financial_year_end=row["fyend"]
+        )
+
+    with transaction.atomic():
+        counts, funder_year_ids = bulk_upsert(
+            FunderYear.objects.all(),
+            checked_data,
+            keys=[
+                UpsertKey("org_id", "funder_financial_year__funder_id"),
+                UpsertKey("fyend", "financial_year_end"),
+            ],
+            fields=CHECKED_FIELDS,
+            create=new_funder_year,
+        )
+        add_funder_year_notes(
+            funder_year_ids, checked_data["notes"], only_if_empty=False
         )
-        records["Created" if created else "Updated"] += 1
+        refresh_funder_financial_years(set(ffy_ids.values()))
 
-    for key, value in records.items():
-        click.secho("{}: {}".format(key, value), fg="green")
+    for key, value in counts.items():
+        click.secho("{}: {}".format(key.capitalize(), value), fg="green")
@@ -1,72 +1,100 @@
 import djclick as click
 import pandas as pd
+from django.db import transaction
 
 from ukgrantmaking.models.funder import Funder
 from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.bulk import UpsertKey, bulk_upsert
+from ukgrantmaking.utils.funder_year import (
+    add_funder_year_notes,
+    funder_financial_year_ids,
+    refresh_funder_financial_years,
+)
+from ukgrantmaking.utils.spreadsheet import read_spreadsheet
+
+# match funder years with the same year end, or failing that one ending in
+# the same month or the same year
+FUNDER_YEAR_KEYS = [
+    UpsertKey("Org-id", "funder_financial_year__funder_id"),
+    UpsertKey(
+        "Financial Year",
+        "financial_year_end",
+        fallbacks=(lambda d: (d.year, d.month), lambda d: d.year),
+    ),
+]
 
 
 @click.command(deprecated=True)
 @click.argument("file")
 def fgt(file):
     click.secho("Opening {}".format(file), fg="green")
-    df = pd.read_excel(file)
-    with click.progressbar(
-        df.iterrows(),
-        length=len(df),
-        label="Updating finances from FGT",
-    ) as bar:
-        for index, row in bar:
-            try:
-                funder_year = FunderYear.objects.get(
-                    funder_id=row["Org-id"],
-                    financial_year_end=row["Financial Year"],
-                )
-            except FunderYear.DoesNotExist:
-                try:
-                    funder_year = FunderYear.objects.get(
-                        funder_id=row["Org-id"],
-                        financial_year_end__month=row["Financial Year"].month,
-                        financial_year_end__year=row["Financial Year"].year,
-                    )
-                except FunderYear.DoesNotExist:
-                    try:
-                        funder_year = FunderYear.objects.get(
-                            funder_id=row["Org-id"],
-                            financial_year_end__year=row["Financial Year"].year,
-                        )
-                    except FunderYear.DoesNotExist:
-                        funder, funder_created = Funder.objects.get_or_create(
-                            org_id=row["Org-id"],
-                            defaults={"name_registered": row["Name"]},
-                        )
-                        if funder_created:
-                            click.secho(
-                                "Created Funder {} ({})".format(
-                                    funder.name_registered, funder.org_id
-                                ),
-                                fg="green",
-                            )
-                        funder_year = FunderYear(
-                            funder_id=row["Org-id"],
-                            financial_year_end=row["Financial Year"],
-                            notes="Added from Foundation Giving Trends data",
-                        )
+    df = read_spreadsheet(file).dropna(subset=["Org-id", "Financial Year"])
+    df["Financial Year"] = pd.to_datetime(df["Financial Year"]).dt.date
+    df["giving"] = pd.to_numeric(df["Giving £m"]) * 1_000_000
+    df["assets"] = pd.to_numeric(df["Assets £m"]) * 1_000_000
+    click.secho("{:,.0f} rows in datafile".format(len(df)), fg="green")
+
+    with transaction.atomic():
+        # create any funders that don't exist yet
+        existing_funders = set(
+            Funder.objects.filter(org_id__in=df["Org-id"].unique()).values_list(
+                "org_id", flat=True
+            )
+        )
+        new_funders = df[~df["Org-id"].isin(existing_funders)].drop_duplicates(
+            subset=["Org-id"]
+        )
+        for org_id, name in zip(new_funders["Org-id"], new_funders["Name"]):
+            funder = Funder.objects.create(org_id=org_id, name_registered=name)
+            click.secho(
+                "Created Funder {} ({})".format(funder.name_registered, funder.org_id),
+                fg="green",
+            )
+
+        existing_years = set(
+            FunderYear.objects.filter(
+                funder_financial_year__funder_id__in=df["Org-id"].unique()
+            ).values_list("id", flat=True)
+        )
+        ffy_ids = funder_financial_year_ids(zip(df["Org-id"], df["Financial Year"]))
 
-            if (
-                not pd.isna(row["Giving £m"])
-                and not funder_year.spending_grant_making_institutions_main_manual
-            ):
-                funder_year.spending_grant_making_institutions_main_manual = (
-                    row["Giving £m"] * 1_000_000
-                )
+        def new_funder_year(row: dict) -> FunderYear | None:
+            ffy_id = ffy_ids.get((row["Org-id"], row["Financial Year"]))
+            if ffy_id is None:
+                return None
+            return FunderYear(
+                funder_financial_year_id=ffy_id,
+                financial_year_end=row["Financial Year"],
+            )
 
-            if (
-                not pd.isna(row["Assets £m"])
-                and not funder_year.total_net_assets_manual
-            ):
-                funder_year.total_net_assets_manual = row["Assets £m"] * 1_000_000
+        counts, funder_year_ids = bulk_upsert(
+            FunderYear.objects.all(),
+            df,
+            keys=FUNDER_YEAR_KEYS,
+            fields={
+                "giving": "spending_grant_making_institutions_main_manual",
+                "assets": "total_net_assets_manual",
+            },
+            create=new_funder_year,
+            overwrite=False,
+        )
+        created = ~funder_year_ids.isin(existing_years) & funder_year_ids.notna()
+        notes = df["Notes"].where(
+            df["Notes"].notna() | ~created, "Added from Foundation Giving Trends data"
+        )
+        notes_added = add_funder_year_notes(funder_year_ids, notes)
 
-            if not pd.isna(row["Notes"]) and not funder_year.notes:
-                funder_year.notes = row["Notes"]
+        # the funder years were saved in bulk, so update the totals for their
+        # funder financial years
+        refresh_funder_financial_years(
+            FunderYear.objects.filter(
+                id__in=funder_year_ids.dropna().astype(int)
+            ).values_list("funder_financial_year_id", flat=True)
+        )
 
-            funder_year.save()
+    click.secho(
+        "Funder years matched: {matched:,.0f}, created: {created:,.0f}, "
+        "skipped: {skipped:,.0f}".format(**counts),
+        fg="green",
+    )
+    click.secho(f"Notes added: {notes_added:,.0f}", fg="green")
@@ -1,4 +1,5 @@
 import logging
+from collections import Counter
 
 import djclick as click
 import numpy as np
@@ -10,143 +11,141 @@ from django.db import connection, transaction
 
 from ukgrantmaking.management.commands.funders.update_financial_year import (
     SQL_QUERIES,
+    SQL_QUERY_PARAMS,
     format_query,
 )
-from ukgrantmaking.utils import do_batched_update
-from ukgrantmaking.utils.text import to_titlecase
+from ukgrantmaking.utils.bulk import do_copy_update
+from ukgrantmaking.utils.db import log_engine_timings
+from ukgrantmaking.utils.financial_year import financial_year_lookup
+from ukgrantmaking.utils.ftc import (
+    FTC_CHUNK_SIZE,
+    FTC_CLASSIFICATION_CTE,
+    FTC_LOCATION_CTE,
+    FTC_SCALE_CTE,
+    FTC_SMALL_ID_THRESHOLD,
+    read_ftc_chunks,
+)
+from ukgrantmaking.utils.text import to_titlecase_series
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Geographical spread of Scottish charities, from OSCR
+OSCR_LOCATION_CTE = """
+    sc_l AS (
+        SELECT c.id as org_id,
+            CASE WHEN geographical_spread = 'UK and overseas' THEN '{"E92000001", "N92000002", "S92000003", "W92000004"}'::varchar[]
+                WHEN geographical_spread = 'Overseas only' THEN '{}'::varchar[]
+                WHEN geographical_spread = 'A specific local point, community or neighbourhood' THEN '{"S92000003"}'::varchar[]
+                WHEN geographical_spread = 'More than one local authority area in Scotland' THEN '{"S92000003"}'::varchar[]
+                WHEN geographical_spread = 'Wider, but within one local authority area' THEN '{"S92000003"}'::varchar[]
+                WHEN geographical_spread = 'Scotland and other parts of the UK' THEN '{"E92000001", "N92000002", "S92000003", "W92000004"}'::varchar[]
+                WHEN geographical_spread = 'Operations cover all or most of Scotland' THEN '{"S92000003"}'::varchar[]
+                WHEN geographical_spread = 'One or a few bases or facilities serving people who come from a broad area' THEN '{"S92000003"}'::varchar[]
+                ELSE NULL
+            END AS ctry_aoo,
+            CASE WHEN geographical_spread = 'UK and overseas' THEN '{"E92000001": "England", "N92000002": "Northern Ireland", "S92000003": "Scotland", "W92000004": "Wales"}'::json
+                WHEN geographical_spread = 'Overseas only' THEN '{}'::json
+                WHEN geographical_spread = 'A specific local point, community or neighbourhood' THEN '{"S92000003": "Scotland"}'::json
+                WHEN geographical_spread = 'More than one local authority area in Scotland' THEN '{"S92000003": "Scotland"}'::json
+                WHEN geographical_spread = 'Wider, but within one local authority area' THEN '{"S92000003": "Scotland"}'::json
+                WHEN geographical_spread = 'Scotland and other parts of the UK' THEN '{"E92000001": "England", "N92000002": "Northern Ireland", "S92000003": "Scotland", "W92000004": "Wales"}'::json
+                WHEN geographical_spread = 'Operations cover all or most of Scotland' THEN '{"S92000003": "Scotland"}'::json
+                WHEN geographical_spread = 'One or a few bases or facilities serving people who come from a broad area' THEN '{"S92000003": "Scotland"}'::json
+            ELSE NULL END AS ctry_aoo_name
+        FROM charity_charity c
+        WHERE c."source" = 'oscr'
+            AND c.id = ANY(%(org_ids)s::text[])
+    )
+"""
+
+FTC_FUNDERS_QUERY = (
+    "WITH "
+    + ",".join(
+        [FTC_CLASSIFICATION_CTE, FTC_LOCATION_CTE, OSCR_LOCATION_CTE, FTC_SCALE_CTE]
+    )
+    + """
+    SELECT o.org_id,
+        name,
+        "dateRegistered",
+        "dateRemoved",
+        "active",
+        c.how,
+        c.what,
+        c.who,
+        o."postalCode" AS postcode,
+        la_hq[1] as la_hq,
+        la_hq_name->>la_hq[1] as la_hq_name,
+        la_aoo,
+        la_aoo_name,
+        rgn_hq[1] as rgn_hq,
+        rgn_hq_name->>rgn_hq[1] as rgn_hq_name,
+        rgn_aoo,
+        rgn_aoo_name,
+        ctry_hq[1] as ctry_hq,
+        ctry_hq_name->>ctry_hq[1] as ctry_hq_name,
+        coalesce(l.ctry_aoo, sc_l.ctry_aoo) as ctry_aoo,
+        coalesce(l.ctry_aoo_name, sc_l.ctry_aoo_name) as ctry_aoo_name,
+        overseas_aoo,
+        overseas_aoo_name,
+        london_hq,
+        london_aoo,
+        s.scale as scale_registered
+    FROM ftc_organisation o
+        LEFT OUTER JOIN c
+            ON o.org_id = c.org_id
+        LEFT OUTER JOIN l
+            ON o.org_id = l.org_id
+        LEFT OUTER JOIN s
+            ON o.org_id = s.org_id
+        LEFT OUTER JOIN sc_l
+            ON o.org_id = sc_l.org_id
+    WHERE o.org_id = ANY(%(org_ids)s::text[])
+"""
+)
+
+FTC_FUNDER_FINANCE_QUERY = """
+    SELECT charity_id AS org_id,
+        fyend AS financial_year_end,
+        fystart AS financial_year_start,
+        income,
+        inc_invest AS income_investment,
+        spending,
+        exp_invest AS spending_investment,
+        exp_charble AS spending_charitable,
+        exp_grant AS spending_grant_making_institutions_main,
+        funds_total AS total_net_assets,
+        funds_total AS funds,
+        funds_end AS funds_endowment,
+        funds_restrict AS funds_restricted,
+        funds_unrestrict AS funds_unrestricted,
+        employees
+    FROM charity_charityfinancial
+    WHERE charity_id = ANY(%(org_ids)s::text[])
+"""
+
 
 def do_ftc_funders(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
     Funder = apps.get_model("ukgrantmaking", "Funder")
 
     # get updated names and date of registration from FTC
     logging.info("Fetching organisations from FTC")
-    org_records = pd.read_sql(
-        """
-            WITH c AS (
-                SELECT 'GB-CHC-' || registered_charity_number AS org_id,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'How') AS how,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'What') AS what,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'Who') AS who 
-                FROM charity_ccewcharityclassification 
-                WHERE linked_charity_number = 0
-                GROUP BY 1
-            ),
-            l AS (
-                 SELECT org_id,
-                    array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq,
-                    json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq_name,
-                    array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo,
-                    json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo_name,
-                    array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq,
-                    json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq_name,
-                    array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo,
-                    json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo_name,
-                    array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq,
-                    json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq_name,
-                    array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo,
-                    json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo_name,
-                    array_agg(DISTINCT l.geo_iso) FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo,
-                    json_object_agg(DISTINCT l.geo_iso, iso."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo_name,
-                    SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'HQ' THEN 1 ELSE 0 END) > 0 AS london_hq,
-                    SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'AOO' THEN 1 ELSE 0 END) > 0 AS london_aoo
-                FROM ftc_organisationlocation l
-                    LEFT OUTER JOIN geo_geolookup rgn
-                        ON l.geo_rgn = rgn."geoCode" 
-                    LEFT OUTER JOIN geo_geolookup ctry
-                        ON l.geo_ctry = ctry."geoCode" 
-                    LEFT OUTER JOIN geo_geolookup la
-                        ON l.geo_laua = la."geoCode" 
-                    LEFT OUTER JOIN geo_geolookup iso
-                        ON l.geo_iso = iso."geoCode"
-                GROUP BY 1
-            ),
-            sc_l AS (
-                SELECT c.id as org_id,
-                    CASE WHEN geographical_spread = 'UK and overseas' THEN '{"E92000001", "N92000002", "S92000003", "W92000004"}'::varchar[]
-                        WHEN geographical_spread = 'Overseas only' THEN '{}'::varchar[]
-                        WHEN geographical_spread = 'A specific local point, community or neighbourhood' THEN '{"S92000003"}'::varchar[]
-                        WHEN geographical_spread = 'More than one local authority area in Scotland' THEN '{"S92000003"}'::varchar[]
-                        WHEN geographical_spread = 'Wider, but within one local authority area' THEN '{"S92000003"}'::varchar[]
-                        WHEN geographical_spread = 'Scotland and other parts of the UK' THEN '{"E92000001", "N92000002", "S92000003", "W92000004"}'::varchar[]
-                        WHEN geographical_spread = 'Operations cover all or most of Scotland' THEN '{"S92000003"}'::varchar[]
-                        WHEN geographical_spread = 'One or a few bases or facilities serving people who come from a broad area' THEN '{"S92000003"}'::varchar[]
-                        ELSE NULL
-                    END AS ctry_aoo,
-                    CASE WHEN geographical_spread = 'UK and overseas' THEN '{"E92000001": "England", "N92000002": "Northern Ireland", "S92000003": "Scotland", "W92000004": "Wales"}'::json
-                        WHEN geographical_spread = 'Overseas only' THEN '{}'::json
-                        WHEN geographical_spread = 'A specific local point, community or neighbourhood' THEN '{"S92000003": "Scotland"}'::json
-                        WHEN geographical_spread = 'More than one local authority area in Scotland' THEN '{"S92000003": "Scotland"}'::json
-                        WHEN geographical_spread = 'Wider, but within one local authority area' THEN '{"S92000003": "Scotland"}'::json
-                        WHEN geographical_spread = 'Scotland and other parts of the UK' THEN '{"E92000001": "England", "N92000002": "Northern Ireland", "S92000003": "Scotland", "W92000004": "Wales"}'::json
-                        WHEN geographical_spread = 'Operations cover all or most of Scotland' THEN '{"S92000003": "Scotland"}'::json
-                        WHEN geographical_spread = 'One or a few bases or facilities serving people who come from a broad area' THEN '{"S92000003": "Scotland"}'::json
-                    ELSE NULL END AS ctry_aoo_name
-                FROM charity_charity c
-                WHERE c."source" = 'oscr'
-            ),
-            s AS (
-                SELECT c.org_id,
-                    ve.title AS scale
-                FROM ftc_vocabulary v
-                    INNER JOIN ftc_vocabularyentries ve
-                        ON v.id = ve.vocabulary_id 
-                    INNER JOIN ftc_organisationclassification c
-                        ON ve.id = c.vocabulary_id 
-                WHERE v.slug = 'scale'
-            )
-            SELECT o.org_id,
-                name,
-                "dateRegistered",
-                "dateRemoved",
-                "active",
-                c.how,
-                c.what,
-                c.who,
-                o."postalCode" AS postcode,
-                la_hq[1] as la_hq,
-                la_hq_name->>la_hq[1] as la_hq_name,
-                la_aoo,
-                la_aoo_name,
-                rgn_hq[1] as rgn_hq,
-                rgn_hq_name->>rgn_hq[1] as rgn_hq_name,
-                rgn_aoo,
-                rgn_aoo_name,
-                ctry_hq[1] as ctry_hq,
-                ctry_hq_name->>ctry_hq[1] as ctry_hq_name,
-                coalesce(l.ctry_aoo, sc_l.ctry_aoo) as ctry_aoo,
-                coalesce(l.ctry_aoo_name, sc_l.ctry_aoo_name) as ctry_aoo_name,
-                overseas_aoo,
-                overseas_aoo_name,
-                london_hq,
-                london_aoo,
-                s.scale as scale_registered
-            FROM ftc_organisation o
-                LEFT OUTER JOIN c
-                    ON o.org_id = c.org_id
-                LEFT OUTER JOIN l
-                    ON o.org_id = l.org_id
-                LEFT OUTER JOIN s
-                    ON o.org_id = s.org_id
-                LEFT OUTER JOIN sc_l
-                    ON o.org_id = sc_l.org_id
-            WHERE o.org_id IN %(org_id)s
-            """,
-        params={"org_id": org_ids},
-        con=db_con,
-    )
-    logger.info(f"Fetched {len(org_records):,.0f} organisations from FTC")
+    fetched = 0
     with click.progressbar(
-        org_records.itertuples(),
-        length=len(org_records),
+        length=len(org_ids),
         label="Updating organisation data",
     ) as bar:
 
         def iterate_organisations():
-            for org_record in bar:
+            nonlocal fetched
+            for org_records in read_ftc_chunks(db_con, FTC_FUNDERS_QUERY, org_ids):
+                fetched += len(org_records)
+                org_records["name"] = to_titlecase_series(org_records["name"])
+                yield from iterate_org_records(org_records)
+                bar.update(FTC_CHUNK_SIZE)
+
+        def iterate_org_records(org_records: pd.DataFrame):
+            for org_record in org_records.itertuples():
                 ctry_hq = org_record.ctry_hq
                 ctry_hq_name = org_record.ctry_hq_name
                 if ctry_hq is None and org_record.org_id.startswith("GB-SC-"):
@@ -157,7 +156,7 @@ def do_ftc_funders(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
                     ctry_hq_name = "Northern Ireland"
                 yield dict(
                     org_id=org_record.org_id,
-                    name_registered=to_titlecase(org_record.name),
+                    name_registered=org_record.name,
                     date_of_registration=org_record.dateRegistered,
                     date_of_removal=org_record.dateRemoved,
                     active=org_record.active,
@@ -184,7 +183,7 @@ def do_ftc_funders(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
                     scale_registered=org_record.scale_registered,
                 )
 
-        do_batched_update(
+        do_copy_update(
             Funder,
             iterate_organisations(),
             unique_fields=[
@@ -218,7 +217,7 @@ def do_ftc_funders(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
                 "scale_registered",
             ],
         )
-    logger.info(f"Updated {len(org_records):,.0f} organisations in DB")
+    logger.info(f"Fetched and updated {fetched:,.0f} organisations from FTC")
 
 
 def do_ftc_finance(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
@@ -230,6 +229,18 @@ def do_ftc_finance(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
     # get all financial years
     financial_years = pd.DataFrame(FinancialYear.objects.all().values())
 
+    # when only a few funders are being updated, only their records (and those
+    # of their successors) are needed from the DB
+    small_update = debug or len(org_ids) < FTC_SMALL_ID_THRESHOLD
+
+    # get successor lookups
+    logger.info("Fetching successor lookups from DB")
+    successor_qs = Funder.objects.filter(successor__isnull=False)
+    if small_update:
+        successor_qs = successor_qs.filter(org_id__in=org_ids)
+    successor_lookups = dict(successor_qs.values_list("org_id", "successor_id"))
+    logger.info(f"Fetched {len(successor_lookups):,.0f} successor lookups from DB")
+
     # get all funder years
     logger.info("Fetching funder financial years from DB")
     funder_financial_year_qs = FunderFinancialYear.objects.values(
@@ -237,97 +248,74 @@ def do_ftc_finance(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
         "funder_id",
         "financial_year__fy",
     )
-    if debug:
+    if small_update:
         funder_financial_year_qs = funder_financial_year_qs.filter(
-            funder_id__in=org_ids
+            funder_id__in=set(org_ids) | set(successor_lookups.values())
         )
     funder_financial_years = (
-        pd.DataFrame(funder_financial_year_qs)
+        pd.DataFrame.from_records(
+            funder_financial_year_qs,
+            columns=["id", "funder_id", "financial_year__fy"],
+        )
         .set_index(["funder_id", "financial_year__fy"])["id"]
         .rename("funder_financial_year_id")
     )
     logger.info(f"Fetched {len(funder_financial_years):,.0f} financial years from DB")
 
-    # get successor lookups
-    logger.info("Fetching successor lookups from DB")
-    successor_lookups = dict(
-        Funder.objects.filter(successor__isnull=False).values_list(
-            "org_id", "successor_id"
+    def prepare_finance_records(finance_records: pd.DataFrame) -> pd.DataFrame:
+        # replace org IDs with successor IDs
+        finance_records["org_id_successor"] = finance_records["org_id"].map(
+            successor_lookups
         )
-    )
-    logger.info(f"Fetched {len(successor_lookups):,.0f} successor lookups from DB")
-
-    logger.info("Fetching financial records from FTC")
-    finance_records = pd.read_sql(
-        """
-            SELECT charity_id AS org_id,
-                fyend AS financial_year_end,
-                fystart AS financial_year_start,
-                income,
-                inc_invest AS income_investment,
-                spending,
-                exp_invest AS spending_investment,
-                exp_charble AS spending_charitable,
-                exp_grant AS spending_grant_making_institutions_main,
-                funds_total AS total_net_assets,
-                funds_total AS funds,
-                funds_end AS funds_endowment,
-                funds_restrict AS funds_restricted,
-                funds_unrestrict AS funds_unrestricted,
-                employees
-            FROM charity_charityfinancial
-            WHERE charity_id IN %(org_id)s
-            """,
-        params={"org_id": org_ids},
-        con=db_con,
-    )
-    logger.info(f"Fetched {len(finance_records):,.0f} financial records from FTC")
 
-    # replace org IDs with successor IDs
-    finance_records["org_id_successor"] = finance_records["org_id"].map(
-        successor_lookups
-    )
+        finance_records["fy"] = financial_year_lookup(
+            finance_records["financial_year_end"],
+            date_type="funders",
+            financial_years=financial_years,
+        )
 
-    finance_records["fy"] = None
-    for fy in financial_years.itertuples():
+        finance_records = finance_records.join(
+            funder_financial_years,
+            on=["org_id", "fy"],
+            how="left",
+        ).join(
+            funder_financial_years.rename("new_funder_financial_year_id"),
+            on=["org_id_successor", "fy"],
+            how="left",
+        )
         finance_records.loc[
-            (finance_records.financial_year_end >= fy.funders_start_date)
-            & (finance_records.financial_year_end <= fy.funders_end_date),
-            "fy",
-        ] = fy.fy
-
-    finance_records = finance_records.join(
-        funder_financial_years,
-        on=["org_id", "fy"],
-        how="left",
-    ).join(
-        funder_financial_years.rename("new_funder_financial_year_id"),
-        on=["org_id_successor", "fy"],
-        how="left",
-    )
-    finance_records.loc[
-        finance_records["funder_financial_year_id"]
-        == finance_records["new_funder_financial_year_id"],
-        "new_funder_financial_year_id",
-    ] = None
-
-    no_fy = finance_records[finance_records.funder_financial_year_id.isnull()]
-    logger.info(f"Found {len(no_fy):,.0f} records that didn't match a financial year")
-    for fy, count in no_fy["fy"].value_counts().items():
-        logger.info(f"  {fy}: {count:,.0f}")
+            finance_records["funder_financial_year_id"]
+            == finance_records["new_funder_financial_year_id"],
+            "new_funder_financial_year_id",
+        ] = None
+
+        no_fy = finance_records[finance_records.funder_financial_year_id.isnull()]
+        no_fy_counts.update(no_fy["fy"].value_counts().to_dict())
 
-    finance_records = finance_records[
-        ~finance_records.funder_financial_year_id.isnull()
-    ]
+        return finance_records[~finance_records.funder_financial_year_id.isnull()]
 
+    logger.info("Fetching financial records from FTC")
+    fetched = 0
+    no_fy_counts = Counter()
     with click.progressbar(
-        finance_records.replace({np.nan: None}).itertuples(),
-        length=len(finance_records),
+        length=len(org_ids),
         label="Updating organisation finances",
     ) as bar:
 
         def iterate_fy():
-            for financial_record in bar:
+            nonlocal fetched
+            for finance_records in read_ftc_chunks(
+                db_con, FTC_FUNDER_FINANCE_QUERY, org_ids
+            ):
+                fetched += len(finance_records)
+                finance_records = prepare_finance_records(finance_records)
+                yield from iterate_finance_records(finance_records)
+                bar.update(FTC_CHUNK_SIZE)
+
+        def iterate_finance_records(finance_records: pd.DataFrame):
+            for financial_record in finance_records.replace(
+                {np.nan: None}
+            ).itertuples():
                 yield dict(
                     funder_financial_year_id=financial_record.funder_financial_year_id,
                     financial_year_end=financial_record.financial_year_end,
@@ -349,7 +337,7 @@ def do_ftc_finance(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
                     ),
                 )
 
-        do_batched_update(
+        counts = do_copy_update(
             FunderYear,
             iterate_fy(),
             unique_fields=[
@@ -372,10 +360,20 @@ def do_ftc_finance(db_con: str, org_ids: tuple[str, ...], debug: bool = False):
                 "employees_registered",
                 "new_funder_financial_year_id",
             ],
+            hash_field="content_hash",
         )
-        logger.info(
-            f"Created or updated {len(finance_records):,.0f} organisation financial records in DB"
-        )
+    logger.info(f"Fetched {fetched:,.0f} financial records from FTC")
+    logger.info(
+        f"Found {no_fy_counts.total():,.0f} records that didn't match a financial year"
+    )
+    for fy, count in no_fy_counts.most_common():
+        logger.info(f"  {fy}: {count:,.0f}")
+    updated = counts["inserted"] + counts["changed"] + counts["unchanged"]
+    logger.info(
+        f"Created or updated {updated:,.0f} organisation financial records in DB "
+        f"({counts['inserted']:,.0f} inserted, {counts['changed']:,.0f} changed, "
+        f"{counts['unchanged']:,.0f} unchanged)"
+    )
 
 
 def run_sql_queries(cursor, queries: list[str], all_queries: dict[str, str]):
@@ -384,7 +382,9 @@ def run_sql_queries(cursor, queries: list[str], all_queries: dict[str, str]):
             logger.warning(f"Query '{query_name}' not found in SQL_QUERIES")
             continue
         logger.info(f"[Query] Started:  {query_name}")
-        cursor.execute(format_query(all_queries[query_name]))
+        cursor.execute(
+            format_query(all_queries[query_name]), SQL_QUERY_PARAMS.get(query_name)
+        )
         logger.info(f"[Query] Completed: {query_name}")
         logger.info(f"[Query] Rows affected: {cursor.rowcount:,.0f}")
 
@@ -408,6 +408,7 @@ def ftc(db_con: str, debug: bool, do_funders: bool, do_financial: bool):
             do_ftc_funders(db_con, org_ids)
 
         if not do_financial:
+            log_engine_timings(db_con)
             return
 
         # check that we've got a financial year for every funder
@@ -420,6 +421,7 @@ def ftc(db_con: str, debug: bool, do_funders: bool, do_financial: bool):
         )
 
         do_ftc_finance(db_con, org_ids, debug)
+        log_engine_timings(db_con)
 
         # Recompute the aggregated financials for all funders
         run_sql_queries(
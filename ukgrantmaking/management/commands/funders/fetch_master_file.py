@@ -1,8 +1,10 @@
 import djclick as click
+import pandas as pd
 from django.db import transaction
 from openpyxl import load_workbook
 
 from ukgrantmaking.models.funder import Funder, FunderTag
+from ukgrantmaking.utils.bulk import UpsertKey, bulk_upsert
 
 TAG_LOOKUP = {
     "foundation_giving_trends": "Foundation Giving Trends",
@@ -33,53 +35,72 @@ def master_list(file):
 
     funder_tags = {tag.tag: tag for tag in FunderTag.objects.all()}
 
-    records = {
-        "created": 0,
-        "updated": 0,
-    }
+    tables = []
+    for sheet in wb:
+        for table_name, table_range in sheet.tables.items():
+            click.secho(
+                "Sheet: {} | Table: {}".format(sheet.title, table_name), fg="yellow"
+            )
+            header_row, *rows = [
+                [cell.value for cell in row] for row in sheet[table_range]
+            ]
+            tables.append(pd.DataFrame(rows, columns=header_row))
+    if not tables:
+        raise click.ClickException("No tables found in file")
+    df = pd.concat(tables, ignore_index=True)
+
+    def new_funder(record: dict) -> Funder:
+        return Funder(
+            org_id=record["org_id"],
+            name_registered=record["name"],
+            charity_number=record["charityNumber"],
+            segment=record.get("segment_checked", record["segment"]),
+            included=record["inclusion"] in ("non_charities", "included"),
+            makes_grants_to_individuals=record["grants_to_individuals"] is not None,
+            date_of_registration=record["dateRegistered"],
+            activities=record["description"],
+            website=record["url"],
+        )
 
     with transaction.atomic():
-        for sheet in wb:
-            # iterate rows
-            for table_name, table_range in sheet.tables.items():
-                click.secho(
-                    "Sheet: {} | Table: {}".format(sheet.title, table_name), fg="yellow"
-                )
+        existing_funders = set(
+            Funder.objects.filter(
+                org_id__in=df["org_id"].dropna().unique()
+            ).values_list("org_id", flat=True)
+        )
 
-                header_row = None
-                for row in sheet[table_range]:
-                    if header_row is None:
-                        header_row = [cell.value for cell in row]
-                        continue
-                    record = dict(zip(header_row, [cell.value for cell in row]))
+        # existing funders are left unchanged
+        counts, _ = bulk_upsert(
+            Funder.objects.all(),
+            df,
+            keys=[UpsertKey("org_id", "org_id")],
+            fields={},
+            create=new_funder,
+        )
 
-                    # create or update Funder
-                    funder, created = Funder.objects.get_or_create(
-                        org_id=record["org_id"],
-                        defaults={
-                            "name_registered": record["name"],
-                            "charity_number": record["charityNumber"],
-                            "segment": record.get("segment_checked", record["segment"]),
-                            "included": (
-                                record["inclusion"] in ("non_charities", "included")
-                            ),
-                            "makes_grants_to_individuals": (
-                                record["grants_to_individuals"] is not None
-                            ),
-                            "date_of_registration": record["dateRegistered"],
-                            "activities": record["description"],
-                            "website": record["url"],
-                        },
-                    )
-                    if created:
-                        records["created"] += 1
-                        for field, value in TAG_LOOKUP.items():
-                            if record.get(field):
-                                funder.tags.add(funder_tags[value])
-                    else:
-                        records["updated"] += 1
+        # tag the new funders, and save them to set up their financial years
+        new_funders = df[~df["org_id"].isin(existing_funders)].drop_duplicates(
+            subset=["org_id"]
+        )
+        funder_tag_links = set()
+        for field, value in TAG_LOOKUP.items():
+            if field not in new_funders:
+                continue
+            for org_id in new_funders.loc[
+                new_funders[field].fillna(False).astype(bool), "org_id"
+            ]:
+                funder_tag_links.add((org_id, funder_tags[value].pk))
+        Funder.tags.through.objects.bulk_create(
+            [
+                Funder.tags.through(funder_id=org_id, fundertag_id=tag_id)
+                for org_id, tag_id in funder_tag_links
+            ],
+            ignore_conflicts=True,
+        )
+        for funder in Funder.objects.filter(org_id__in=new_funders["org_id"]):
+            funder.save()
 
     click.secho(
-        "Created: {created}, Existing: {updated}".format(**records),
+        "Created: {created}, Existing: {matched}".format(**counts),
         fg="green",
     )
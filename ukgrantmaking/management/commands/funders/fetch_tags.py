@@ -1,8 +1,9 @@
 import djclick as click
-import numpy as np
-import pandas as pd
+from django.db import transaction
 
 from ukgrantmaking.models.funder import Funder, FunderTag
+from ukgrantmaking.utils.bulk import UpsertKey, bulk_upsert
+from ukgrantmaking.utils.spreadsheet import read_spreadsheet
 
 
 @click.command(deprecated=True)
@@ -13,47 +14,66 @@ from ukgrantmaking.models.funder import Funder, FunderTag
 @click.option("--name-column", default="name")
 def tags(file, orgid_column, tag_column, tag, name_column):
     click.secho("Opening {}".format(file), fg="green")
-    df = pd.read_excel(file)
+    df = read_spreadsheet(file)
 
     if not tag and tag_column not in df.columns:
         raise click.ClickException("Tag column not found in file and no tag provided")
 
+    # skip if no orgid
+    df = df[df[orgid_column].notna() & (df[orgid_column] != "")]
+
     funder_tags = {}
     if tag_column in df.columns:
-        for tag_record in df[tag_column].unique():
-            tag_record = tag_record.strip()
-            funder_tag, tag_created = FunderTag.objects.get_or_create(
+        df[tag_column] = df[tag_column].where(
+            df[tag_column].map(lambda value: isinstance(value, str))
+        )
+        df[tag_column] = df[tag_column].str.strip()
+        for tag_record in df[tag_column].dropna().unique():
+            funder_tags[tag_record], _ = FunderTag.objects.get_or_create(
                 tag=tag_record,
             )
-            funder_tags[tag_record] = funder_tag
     if tag:
         tag = tag.strip()
-        funder_tags[tag], tag_created = FunderTag.objects.get_or_create(
+        funder_tags[tag], _ = FunderTag.objects.get_or_create(
             tag=tag,
         )
 
-    records = {
-        "Funder created": 0,
-        "Funder found": 0,
-    }
-    for index, record in df.replace({np.nan: None}).iterrows():
-        # skip if no orgid
-        if not getattr(record, orgid_column, None):
-            continue
-
-        defaults = {}
-        if hasattr(record, name_column):
-            defaults["name_registered"] = getattr(record, name_column)
-        funder, created = Funder.objects.get_or_create(
-            org_id=getattr(record, orgid_column),
-            defaults=defaults,
+    created_funders = []
+
+    def new_funder(row: dict) -> Funder:
+        created_funders.append(row[orgid_column])
+        return Funder(
+            org_id=row[orgid_column],
+            name_registered=row.get(name_column) or "",
+        )
+
+    with transaction.atomic():
+        counts, funder_ids = bulk_upsert(
+            Funder.objects.all(),
+            df,
+            keys=[UpsertKey(orgid_column, "org_id")],
+            fields={},
+            create=new_funder,
+        )
+        # new funders are created in bulk, so save them to set up their
+        # financial years and automatic tags
+        for funder in Funder.objects.filter(org_id__in=created_funders):
+            funder.save()
+
+        funder_tag_links = set()
+        for row_index, funder_id in funder_ids.dropna().items():
+            if tag:
+                funder_tag_links.add((funder_id, funder_tags[tag].pk))
+            tag_value = df.at[row_index, tag_column] if tag_column in df else None
+            if isinstance(tag_value, str):
+                funder_tag_links.add((funder_id, funder_tags[tag_value].pk))
+        Funder.tags.through.objects.bulk_create(
+            [
+                Funder.tags.through(funder_id=funder_id, fundertag_id=tag_id)
+                for funder_id, tag_id in funder_tag_links
+            ],
+            ignore_conflicts=True,
         )
-        if tag:
-            funder.tags.add(funder_tags[tag])
-        if isinstance(getattr(record, tag_column, None), str):
-            tag_value = getattr(record, tag_column).strip()
-            funder.tags.add(funder_tags[tag_value])
-        records["Funder created" if created else "Funder found"] += 1
-
-    for key, value in records.items():
-        click.secho("{}: {}".format(key, value), fg="green")
+
+    click.secho("Funder created: {}".format(counts["created"]), fg="green")
+    click.secho("Funder found: {}".format(counts["matched"]), fg="green")
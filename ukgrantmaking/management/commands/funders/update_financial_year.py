@@ -4,6 +4,8 @@ import djclick as click
 from django.apps import apps
 from django.db import connection, transaction
 
+from ukgrantmaking.models.funder_financial_year import UPDATE_AGGREGATES_QUERY
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -91,99 +93,7 @@ SQL_QUERIES = {
     FROM latest_ffy
     WHERE latest_ffy.funder_id = {ukgrantmaking_funder}.org_id
     """,
-    "Recalculate aggregate values for funder financial years": """
-    WITH fy AS (
-        SELECT
-            *,
-            case when (
-                funds_endowment IS NOT NULL OR  
-                funds_restricted IS NOT NULL OR  
-                funds_unrestricted IS NOT NULL
-            ) then (
-                coalesce(funds_endowment, 0) + 
-                coalesce(funds_restricted, 0) + 
-                coalesce(funds_unrestricted, 0)
-            ) else null end as funds_calculated,
-            case when (
-                employees_permanent IS NOT NULL OR  
-                employees_fixedterm IS NOT NULL OR  
-                employees_selfemployed IS NOT NULL
-            ) then (
-                coalesce(employees_permanent, 0) + 
-                coalesce(employees_fixedterm, 0) + 
-                coalesce(employees_selfemployed, 0)
-            ) else null end as employees_calculated
-        FROM
-            {ukgrantmaking_funderyear} fy
-        ORDER BY
-            financial_year_end DESC
-    ),
-    latest_fields AS (
-        SELECT
-            DISTINCT ON (funder_financial_year_id) funder_financial_year_id,
-            coalesce(total_net_assets, funds_calculated) AS total_net_assets,
-            coalesce(funds, funds_calculated) AS funds,
-            funds_endowment,
-            funds_restricted,
-            funds_unrestricted,
-            coalesce(employees, employees_calculated) AS employees,
-            employees_permanent,
-            employees_fixedterm,
-            employees_selfemployed
-        FROM
-            fy
-    ),
-    summed_fields AS (
-        SELECT
-            funder_financial_year_id,
-            sum(income) AS income,
-            sum(income_investment) AS income_investment,
-            sum(spending) AS spending,
-            sum(spending_investment) AS spending_investment,
-            sum(spending_charitable) AS spending_charitable,
-            sum(spending_grant_making) AS spending_grant_making,
-            sum(spending_grant_making_individuals) AS spending_grant_making_individuals,
-            sum(spending_grant_making_institutions_charitable) AS spending_grant_making_institutions_charitable,
-            sum(spending_grant_making_institutions_noncharitable) AS spending_grant_making_institutions_noncharitable,
-            sum(spending_grant_making_institutions_unknown) AS spending_grant_making_institutions_unknown,
-            sum(spending_grant_making_institutions_main) AS spending_grant_making_institutions_main,
-            sum(spending_grant_making_institutions) AS spending_grant_making_institutions
-        FROM
-            fy
-        GROUP BY
-            1
-    )
-    UPDATE
-        {ukgrantmaking_funderfinancialyear}
-    SET
-        income = summed_fields.income,
-        income_investment = summed_fields.income_investment,
-        spending = summed_fields.spending,
-        spending_investment = summed_fields.spending_investment,
-        spending_charitable = summed_fields.spending_charitable,
-        spending_grant_making = summed_fields.spending_grant_making,
-        spending_grant_making_individuals = summed_fields.spending_grant_making_individuals,
-        spending_grant_making_institutions_charitable = summed_fields.spending_grant_making_institutions_charitable,
-        spending_grant_making_institutions_noncharitable = summed_fields.spending_grant_making_institutions_noncharitable,
-        spending_grant_making_institutions_unknown = summed_fields.spending_grant_making_institutions_unknown,
-        spending_grant_making_institutions_main = summed_fields.spending_grant_making_institutions_main,
-        spending_grant_making_institutions = summed_fields.spending_grant_making_institutions,
-        total_net_assets = latest_fields.total_net_assets,
-        funds = latest_fields.funds,
-        funds_endowment = latest_fields.funds_endowment,
-        funds_restricted = latest_fields.funds_restricted,
-        funds_unrestricted = latest_fields.funds_unrestricted,
-        employees = latest_fields.employees,
-        employees_permanent = latest_fields.employees_permanent,
-        employees_fixedterm = latest_fields.employees_fixedterm,
-        employees_selfemployed = latest_fields.employees_selfemployed
-    FROM
-        latest_fields,
-        summed_fields
-    WHERE
-        {ukgrantmaking_funderfinancialyear}.id = latest_fields.funder_financial_year_id
-        AND {ukgrantmaking_funderfinancialyear}.id = summed_fields.funder_financial_year_id
-    """,
+    "Recalculate aggregate values for funder financial years": UPDATE_AGGREGATES_QUERY,
     "Update funder makes_grants_to_individuals": """
     WITH individual_funders AS (
         SELECT DISTINCT ffy.funder_id
@@ -245,6 +155,14 @@ SQL_QUERIES = {
     """,
 }
 
+# parameters for the queries that take them
+SQL_QUERY_PARAMS = {
+    "Recalculate aggregate values for funder financial years": {
+        "all_funder_financial_years": True,
+        "funder_financial_year_ids": [],
+    },
+}
+
 
 def format_query(query):
     FinancialYear = apps.get_model("ukgrantmaking", "FinancialYear")
@@ -267,6 +185,6 @@ def financial_year():
     with transaction.atomic(), connection.cursor() as cursor:
         for query_name, query in SQL_QUERIES.items():
             logger.info(f"[Query] Started:  {query_name}")
-            cursor.execute(format_query(query))
+            cursor.execute(format_query(query), SQL_QUERY_PARAMS.get(query_name))
             logger.info(f"[Query] Completed: {query_name}")
             logger.info(f"[Query] Rows affected: {cursor.rowcount:,.0f}")
@@ -0,0 +1,108 @@
+import logging
+
+import djclick as click
+from django.db import connection, transaction
+
+from ukgrantmaking.models.funder_financial_year import (
+    AGGREGATE_TRIGGERS,
+    CREATE_AGGREGATE_TRIGGERS_SQL,
+    FunderFinancialYear,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TRIGGER_STATUS_QUERY = """
+    SELECT tgname, tgenabled != 'D'
+    FROM pg_trigger
+    WHERE tgrelid = 'ukgrantmaking_funderyear'::regclass
+        AND tgname = ANY(%(triggers)s)
+"""
+
+
+def aggregate_trigger_status() -> dict[str, bool | None]:
+    """
+    Whether each of the aggregate triggers is enabled, or None if it isn't
+    installed.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(TRIGGER_STATUS_QUERY, {"triggers": list(AGGREGATE_TRIGGERS)})
+        status = dict(cursor.fetchall())
+    return {name: status.get(name) for name in AGGREGATE_TRIGGERS}
+
+
+def set_aggregate_triggers(enabled: bool) -> None:
+    action = "ENABLE" if enabled else "DISABLE"
+    with connection.cursor() as cursor:
+        # the table can't be altered while there are deferred foreign key
+        # checks waiting to run in the transaction
+        cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        for name in AGGREGATE_TRIGGERS:
+            cursor.execute(
+                f"ALTER TABLE ukgrantmaking_funderyear {action} TRIGGER {name}"
+            )
+        cursor.execute("SET CONSTRAINTS ALL DEFERRED")
+
+
+def check_funder_aggregates(fix: bool = False) -> list[tuple]:
+    """
+    Compare the stored aggregate values with a full recalculation, returning
+    the funder financial years that are out of date. Unless `fix` is set the
+    recalculation is rolled back.
+    """
+    with transaction.atomic():
+        stale = FunderFinancialYear.update_aggregates()
+        if not fix:
+            transaction.set_rollback(True)
+    return stale
+
+
+@click.command()
+@click.option(
+    "--enable-trigger",
+    "trigger",
+    flag_value="enable",
+    help="Keep the aggregates up to date with database triggers",
+)
+@click.option(
+    "--disable-trigger",
+    "trigger",
+    flag_value="disable",
+    help="Turn off the database triggers",
+)
+@click.option(
+    "--install-trigger",
+    "trigger",
+    flag_value="install",
+    help="Recreate the trigger function from the current query (disabled)",
+)
+@click.option("--fix", is_flag=True, default=False, help="Update stale aggregates")
+def funder_aggregates(trigger: str | None, fix: bool):
+    """
+    Check the aggregate values of funder financial years against a full
+    recalculation from their funder years.
+    """
+    if trigger == "install":
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_AGGREGATE_TRIGGERS_SQL)
+    elif trigger:
+        set_aggregate_triggers(trigger == "enable")
+
+    for name, enabled in aggregate_trigger_status().items():
+        status = {None: "not installed", True: "enabled", False: "disabled"}[enabled]
+        logger.info(f"Trigger {name}: {status}")
+
+    stale = check_funder_aggregates(fix=fix)
+    if not stale:
+        logger.info("All funder financial year aggregates are up to date")
+        return
+    logger.warning(
+        f"{len(stale):,.0f} funder financial years have out of date aggregates"
+        + (" (fixed)" if fix else "")
+    )
+    for ffy_id, *_ in stale[:20]:
+        logger.warning(f"  Funder financial year {ffy_id}")
+    if not fix:
+        raise click.ClickException(
+            "Aggregates are out of date, run with --fix to update them"
+        )
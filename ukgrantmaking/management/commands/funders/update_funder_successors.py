@@ -0,0 +1,28 @@
+import logging
+
+import djclick as click
+from django.db import transaction
+
+from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
+from ukgrantmaking.utils.recompute import transfer_to_successors
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@click.command()
+@click.argument("org_ids", nargs=-1)
+def funder_successors(org_ids: tuple[str, ...]):
+    """
+    Transfer the funder years of funders that have been taken over to their
+    final successor. Give organisation IDs to only update the chains of
+    successors that include those funders.
+    """
+    with transaction.atomic():
+        changed = transfer_to_successors(org_ids or None)
+        logger.info(f"{len(changed):,.0f} funder financial years affected by transfers")
+        if changed:
+            updated = FunderFinancialYear.update_aggregates(changed)
+            logger.info(
+                f"{len(updated):,.0f} funder financial years with new aggregate values"
+            )
@@ -3,243 +3,224 @@ import logging
 import djclick as click
 import numpy as np
 import pandas as pd
-from django.db import transaction
-from django.db.models import Count, F, Sum
-from django.db.models.functions import Coalesce
+from django.db import connection, transaction
+from django.db.models import F
 
 from ukgrantmaking.models.financial_years import FinancialYear
 from ukgrantmaking.models.grant import Grant, GrantRecipient, GrantRecipientYear
-from ukgrantmaking.utils import do_batched_update
-from ukgrantmaking.utils.text import to_titlecase
+from ukgrantmaking.utils.bulk import do_copy_update
+from ukgrantmaking.utils.db import log_engine_timings
+from ukgrantmaking.utils.fetch import fetch_file
+from ukgrantmaking.utils.financial_year import financial_year_lookup
+from ukgrantmaking.utils.ftc import (
+    FTC_CHUNK_SIZE,
+    FTC_CLASSIFICATION_CTE,
+    FTC_LOCATION_CTE,
+    FTC_SCALE_CTE,
+    read_ftc_chunks,
+)
+from ukgrantmaking.utils.text import to_titlecase_series
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 IMD_FILE = "https://assets.publishing.service.gov.uk/media/691dece32c6b98ecdbc500d5/File_1_IoD2025_Index_of_Multiple_Deprivation.xlsx"
+IMD_LSOA_COLUMN = "LSOA code (2021)"
+IMD_DECILE_COLUMN = (
+    "Index of Multiple Deprivation (IMD) Decile (where 1 is most deprived 10% of LSOA"
+)
 
+FTC_RECIPIENTS_QUERY = (
+    "WITH "
+    + ",".join([FTC_CLASSIFICATION_CTE, FTC_LOCATION_CTE, FTC_SCALE_CTE])
+    + """
+    SELECT o.org_id,
+        name,
+        "dateRegistered",
+        "dateRemoved",
+        "active",
+        c.how,
+        c.what,
+        c.who,
+        o."postalCode" AS postcode,
+        la_hq[1] as la_hq,
+        la_hq_name->>la_hq[1] as la_hq_name,
+        la_aoo,
+        la_aoo_name,
+        rgn_hq[1] as rgn_hq,
+        rgn_hq_name->>rgn_hq[1] as rgn_hq_name,
+        rgn_aoo,
+        rgn_aoo_name,
+        ctry_hq[1] as ctry_hq,
+        ctry_hq_name->>ctry_hq[1] as ctry_hq_name,
+        ctry_aoo,
+        ctry_aoo_name,
+        overseas_aoo,
+        overseas_aoo_name,
+        london_hq,
+        london_aoo,
+        s.scale as scale_registered,
+        lsoa_hq[1] AS lsoa_hq
+    FROM ftc_organisation o
+        LEFT OUTER JOIN c
+            ON o.org_id = c.org_id
+        LEFT OUTER JOIN l
+            ON o.org_id = l.org_id
+        LEFT OUTER JOIN s
+            ON o.org_id = s.org_id
+    WHERE o.org_id = ANY(%(org_ids)s::text[])
+"""
+)
 
-@click.command()
-@click.argument("db_con", envvar="FTC_DB_URL")
-def grant_recipients(db_con):
-    with transaction.atomic():
-        all_recipients_query = (
-            Grant.objects.exclude(recipient_organisation_id__isnull=True)
-            .exclude(recipient_type=Grant.RecipientType.INDIVIDUAL)
-            .exclude(recipient_organisation_name__isnull=True)
-            .values(
-                "recipient_organisation_name",
-            )
-            .order_by("-award_date")
-            .annotate(
-                recipient_id=Coalesce("recipient_id", "recipient_organisation_id"),
-                recipient_type=Coalesce(
-                    "recipient_type_manual", "recipient_type_registered"
-                ),
-                grants=Count("grant_id"),
-                grant_amount=Sum("amount_awarded_GBP"),
+FTC_RECIPIENT_FINANCE_QUERY = """
+    SELECT charity_id AS org_id,
+        fyend AS financial_year_end,
+        fystart AS financial_year_start,
+        income,
+        spending,
+        employees
+    FROM charity_charityfinancial
+    WHERE charity_id = ANY(%(org_ids)s::text[])
+"""
+
+# The latest name and type of each recipient organisation, with the number and
+# total amount of their grants. Recipients that haven't been linked to a grant
+# yet use the recipient organisation ID from the grant.
+RECIPIENT_TOTALS_QUERY = """
+    CREATE TEMPORARY TABLE recipient_totals ON COMMIT DROP AS
+    SELECT DISTINCT ON (recipient_id)
+        recipient_id,
+        recipient_organisation_name,
+        recipient_type,
+        count(*) OVER recipient AS grants,
+        sum("amount_awarded_GBP") OVER recipient AS grant_amount
+    FROM (
+        SELECT COALESCE(recipient_id, recipient_organisation_id) AS recipient_id,
+            recipient_organisation_name,
+            recipient_type,
+            award_date,
+            "amount_awarded_GBP"
+        FROM ukgrantmaking_grant
+        WHERE recipient_organisation_id IS NOT NULL
+            AND recipient_organisation_name IS NOT NULL
+            AND recipient_type IS DISTINCT FROM 'Individual'
+    ) AS g
+    WINDOW recipient AS (PARTITION BY recipient_id)
+    ORDER BY recipient_id, award_date DESC
+"""
+
+INSERT_MISSING_RECIPIENTS_QUERY = """
+    INSERT INTO ukgrantmaking_grantrecipient (recipient_id, name_registered, type_registered)
+    SELECT recipient_id, recipient_organisation_name, recipient_type
+    FROM recipient_totals
+    ON CONFLICT (recipient_id) DO NOTHING
+"""
+
+# Recipients found in FTC (those with a date of registration) keep the name
+# from FTC, which is saved below, rather than the name on their latest grant.
+# Otherwise the name would change back and forth on every run. The content
+# hash is cleared when the name does change, so that the FTC data is saved
+# again for those recipients.
+UPDATE_EXISTING_RECIPIENTS_QUERY = """
+    UPDATE ukgrantmaking_grantrecipient AS r
+    SET name_registered = CASE
+            WHEN r.date_of_registration IS NULL THEN t.recipient_organisation_name
+            ELSE r.name_registered
+        END,
+        type_registered = t.recipient_type,
+        content_hash = CASE
+            WHEN r.date_of_registration IS NULL
+                AND r.name_registered IS DISTINCT FROM t.recipient_organisation_name
+            THEN NULL
+            ELSE r.content_hash
+        END
+    FROM recipient_totals AS t
+    WHERE r.recipient_id = t.recipient_id
+        AND (
+            r.type_registered IS DISTINCT FROM t.recipient_type
+            OR (
+                r.date_of_registration IS NULL
+                AND r.name_registered IS DISTINCT FROM t.recipient_organisation_name
             )
         )
+"""
+
 
+@click.command()
+@click.argument("db_con", envvar="FTC_DB_URL")
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    help="Use the cached copy of the IMD data instead of downloading it",
+)
+def grant_recipients(db_con: str, offline: bool):
+    with transaction.atomic():
         logger.info("Fetching all recipients")
-        all_recipients = (
-            pd.DataFrame(all_recipients_query)
-            .groupby("recipient_id")
-            .agg(
-                {
-                    "recipient_organisation_name": "first",
-                    "recipient_type": "first",
-                    "grants": "sum",
-                    "grant_amount": "sum",
-                }
+        with connection.cursor() as cursor:
+            cursor.execute(RECIPIENT_TOTALS_QUERY)
+            cursor.execute("SELECT count(*), sum(grants) FROM recipient_totals")
+            recipient_count, grant_count = cursor.fetchone()
+            logger.info(
+                f"Fetched {recipient_count:,.0f} recipients from {grant_count or 0:,.0f} grants"
             )
-        )
-        logger.info(f"Fetched {len(all_recipients):,.0f} recipients")
 
-        # create missing recipients
-        existing_recipients = GrantRecipient.objects.values_list(
-            "recipient_id", flat=True
-        )
-        logger.info(f"Found {len(existing_recipients):,.0f} existing recipients")
+            # create missing recipients
+            cursor.execute(INSERT_MISSING_RECIPIENTS_QUERY)
+            logger.info(f"Created {cursor.rowcount:,.0f} missing recipients")
 
-        missing_recipients = all_recipients[
-            ~all_recipients.index.isin(existing_recipients)
-        ]
-        logger.info(
-            f"Need to create recipient records for {len(missing_recipients):,.0f} missing recipients"
-        )
+            # update existing recipients
+            logger.info("Updating existing recipients")
+            cursor.execute(UPDATE_EXISTING_RECIPIENTS_QUERY)
+            logger.info(f"Updated {cursor.rowcount:,.0f} existing recipients")
 
-        to_create = []
-        with click.progressbar(
-            missing_recipients.itertuples(),
-            length=len(missing_recipients),
-            label="Creating new recipients",
-        ) as bar:
-            for recipient in bar:
-                to_create.append(
-                    GrantRecipient(
-                        recipient_id=recipient.Index,
-                        type_registered=recipient.recipient_type,
-                        name_registered=recipient.recipient_organisation_name,
-                    )
-                )
-        GrantRecipient.objects.bulk_create(to_create)
-        logger.info(f"Created {len(to_create):,.0f} missing recipients")
+            cursor.execute("DROP TABLE recipient_totals")
 
         # make sure all recipients are shown in the grants table
         logger.info("Ensure recipients are shown in the grants table")
         Grant.objects.filter(
-            recipient_id__isnull=True, recipient_organisation_id__in=existing_recipients
+            recipient_id__isnull=True,
+            recipient_organisation_id__in=GrantRecipient.objects.values("recipient_id"),
         ).exclude(recipient_organisation_id__isnull=True).exclude(
             recipient_organisation_name__isnull=True
         ).update(recipient_id=F("recipient_organisation_id"))
 
-        # update existing recipients
-        existing_recipient_records = all_recipients[
-            all_recipients.index.isin(existing_recipients)
-        ]
-
-        logger.info("Updating existing recipients")
-        with click.progressbar(
-            existing_recipient_records.itertuples(),
-            length=len(existing_recipient_records),
-            label="Updating recipient records",
-        ) as bar:
-
-            def iterate_existing_recipient():
-                for recipient in bar:
-                    yield dict(
-                        recipient_id=recipient.Index,
-                        type_registered=recipient.recipient_type,
-                        name_registered=recipient.recipient_organisation_name,
-                    )
-
-            do_batched_update(
-                GrantRecipient,
-                iterate_existing_recipient(),
-                unique_fields=["recipient_id"],
-                update_fields=[
-                    "type_registered",
-                    "name_registered",
-                ],
-            )
-        logger.info(f"Updated {len(to_create):,.0f} existing recipients")
-
         # Get English IMD data
         logger.info("Fetching IMD data")
-        imd_data = pd.read_excel(IMD_FILE, sheet_name="IMD25")
-        imd_lookup = imd_data.set_index("LSOA code (2021)")[
-            "Index of Multiple Deprivation (IMD) Decile (where 1 is most deprived 10% of LSOA"
-        ].to_dict()
+        imd_data = pd.read_excel(
+            fetch_file(IMD_FILE, suffix=".xlsx", offline=offline),
+            sheet_name="IMD25",
+            usecols=[IMD_LSOA_COLUMN, IMD_DECILE_COLUMN],
+            dtype={IMD_LSOA_COLUMN: "str"},
+        )
+        imd_lookup = imd_data.set_index(IMD_LSOA_COLUMN)[IMD_DECILE_COLUMN].to_dict()
 
         # get list of org IDs
         org_ids = tuple(GrantRecipient.objects.values_list("recipient_id", flat=True))
 
         # get updated names and date of registration from FTC
         logger.info("Fetching recipient data from FTC")
-        org_records = pd.read_sql(
-            """
-            WITH c AS (
-                SELECT 'GB-CHC-' || registered_charity_number AS org_id,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'How') AS how,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'What') AS what,
-                    array_agg(classification_description) FILTER (WHERE classification_type = 'Who') AS who 
-                FROM charity_ccewcharityclassification 
-                WHERE linked_charity_number = 0
-                GROUP BY 1
-            ),
-            l AS (
-                 SELECT org_id,
-                    array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq,
-                    json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq_name,
-                    array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo,
-                    json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo_name,
-                    array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq,
-                    json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq_name,
-                    array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo,
-                    json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo_name,
-                    array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq,
-                    json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq_name,
-                    array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo,
-                    json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo_name,
-                    array_agg(DISTINCT l.geo_iso) FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo,
-                    json_object_agg(DISTINCT l.geo_iso, iso."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo_name,
-                    SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'HQ' THEN 1 ELSE 0 END) > 0 AS london_hq,
-                    SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'AOO' THEN 1 ELSE 0 END) > 0 AS london_aoo,
-                    array_agg(DISTINCT l.geo_lsoa21) FILTER (WHERE "locationType" = 'HQ' AND l.geo_lsoa21 IS NOT NULL) AS lsoa_hq
-                FROM ftc_organisationlocation l
-                    LEFT OUTER JOIN geo_geolookup rgn
-                        ON l.geo_rgn = rgn."geoCode"
-                    LEFT OUTER JOIN geo_geolookup ctry
-                        ON l.geo_ctry = ctry."geoCode"
-                    LEFT OUTER JOIN geo_geolookup la
-                        ON l.geo_laua = la."geoCode"
-                    LEFT OUTER JOIN geo_geolookup iso
-                        ON l.geo_iso = iso."geoCode"
-                GROUP BY 1
-            ),
-            s AS (
-                SELECT c.org_id,
-                    ve.title AS scale
-                FROM ftc_vocabulary v
-                    INNER JOIN ftc_vocabularyentries ve
-                        ON v.id = ve.vocabulary_id 
-                    INNER JOIN ftc_organisationclassification c
-                        ON ve.id = c.vocabulary_id 
-                WHERE v.slug = 'scale'
-            )
-            SELECT o.org_id,
-                name,
-                "dateRegistered",
-                "dateRemoved",
-                "active",
-                c.how,
-                c.what,
-                c.who,
-                o."postalCode" AS postcode,
-                la_hq[1] as la_hq,
-                la_hq_name->>la_hq[1] as la_hq_name,
-                la_aoo,
-                la_aoo_name,
-                rgn_hq[1] as rgn_hq,
-                rgn_hq_name->>rgn_hq[1] as rgn_hq_name,
-                rgn_aoo,
-                rgn_aoo_name,
-                ctry_hq[1] as ctry_hq,
-                ctry_hq_name->>ctry_hq[1] as ctry_hq_name,
-                ctry_aoo,
-                ctry_aoo_name,
-                overseas_aoo,
-                overseas_aoo_name,
-                london_hq,
-                london_aoo,
-                s.scale as scale_registered,
-                lsoa_hq[1] AS lsoa_hq
-            FROM ftc_organisation o
-                LEFT OUTER JOIN c
-                    ON o.org_id = c.org_id
-                LEFT OUTER JOIN l
-                    ON o.org_id = l.org_id
-                LEFT OUTER JOIN s
-                    ON o.org_id = s.org_id
-            WHERE o.org_id IN %(org_id)s
-            """,
-            params={"org_id": org_ids},
-            con=db_con,
-        )
-        logger.info(f"Fetched {len(org_records):,.0f} recipient records from FTC")
-
-        logger.info("Updating records with data from FTC")
+        fetched = 0
         with click.progressbar(
-            org_records.itertuples(),
-            length=len(org_records),
+            length=len(org_ids),
             label="Updating recipient data from FTC",
         ) as bar:
 
             def iterate_recipient():
-                for org_record in bar:
+                nonlocal fetched
+                for org_records in read_ftc_chunks(
+                    db_con, FTC_RECIPIENTS_QUERY, org_ids
+                ):
+                    fetched += len(org_records)
+                    org_records["name"] = to_titlecase_series(org_records["name"])
+                    yield from iterate_org_records(org_records)
+                    bar.update(FTC_CHUNK_SIZE)
+
+            def iterate_org_records(org_records: pd.DataFrame):
+                for org_record in org_records.itertuples():
                     yield dict(
                         recipient_id=org_record.org_id,
-                        name_registered=to_titlecase(org_record.name),
+                        name_registered=org_record.name,
                         date_of_registration=org_record.dateRegistered,
                         date_of_removal=org_record.dateRemoved,
                         active=org_record.active,
@@ -267,7 +248,7 @@ def grant_recipients(db_con):
                         imd_decile=imd_lookup.get(org_record.lsoa_hq),
                     )
 
-            do_batched_update(
+            counts = do_copy_update(
                 GrantRecipient,
                 iterate_recipient(),
                 unique_fields=["recipient_id"],
@@ -299,50 +280,41 @@ def grant_recipients(db_con):
                     "scale_registered",
                     "imd_decile",
                 ],
+                hash_field="content_hash",
             )
-        logger.info(f"Updated {len(org_records):,.0f} records with data from FTC")
-
-        logger.info("Fetching financial records from FTC")
-        finance_records = pd.read_sql(
-            """
-            SELECT charity_id AS org_id,
-                fyend AS financial_year_end,
-                fystart AS financial_year_start,
-                income,
-                spending,
-                employees
-            FROM charity_charityfinancial
-            WHERE charity_id IN %(org_id)s
-            """,
-            params={"org_id": org_ids},
-            con=db_con,
+        logger.info(
+            f"Updated {fetched:,.0f} records with data from FTC "
+            f"({counts['inserted']:,.0f} inserted, {counts['changed']:,.0f} changed, "
+            f"{counts['unchanged']:,.0f} unchanged)"
         )
-        logger.info(f"Fetched {len(finance_records):,.0f} financial records from FTC")
-
-        # Add in financial year
-        # get all financial years
-        for financial_year in FinancialYear.objects.all():
-            finance_records.loc[
-                (
-                    finance_records["financial_year_end"]
-                    >= financial_year.funders_start_date
-                )
-                & (
-                    finance_records["financial_year_end"]
-                    <= financial_year.funders_end_date
-                ),
-                "financial_year",
-            ] = financial_year.fy
 
-        logger.info("Updating financial records with data from FTC")
+        logger.info("Fetching financial records from FTC")
+        financial_years = pd.DataFrame(FinancialYear.objects.all().values())
+        fetched = 0
         with click.progressbar(
-            finance_records.replace({np.nan: None}).itertuples(),
-            length=len(finance_records),
+            length=len(org_ids),
             label="Updating recipient finances from FTC",
         ) as bar:
 
             def iterate_grant_recipient_year():
-                for financial_record in bar:
+                nonlocal fetched
+                for finance_records in read_ftc_chunks(
+                    db_con, FTC_RECIPIENT_FINANCE_QUERY, org_ids
+                ):
+                    fetched += len(finance_records)
+                    # Add in financial year
+                    finance_records["financial_year"] = financial_year_lookup(
+                        finance_records["financial_year_end"],
+                        date_type="funders",
+                        financial_years=financial_years,
+                    )
+                    yield from iterate_finance_records(finance_records)
+                    bar.update(FTC_CHUNK_SIZE)
+
+            def iterate_finance_records(finance_records: pd.DataFrame):
+                for financial_record in finance_records.replace(
+                    {np.nan: None}
+                ).itertuples():
                     yield dict(
                         recipient_id=financial_record.org_id,
                         financial_year_end=financial_record.financial_year_end,
@@ -353,7 +325,7 @@ def grant_recipients(db_con):
                         financial_year_id=financial_record.financial_year,
                     )
 
-            do_batched_update(
+            counts = do_copy_update(
                 GrantRecipientYear,
                 iterate_grant_recipient_year(),
                 unique_fields=[
@@ -367,7 +339,11 @@ def grant_recipients(db_con):
                     "employees_registered",
                     "financial_year_id",
                 ],
+                hash_field="content_hash",
             )
         logger.info(
-            f"Updated {len(finance_records):,.0f} financial records with data from FTC"
+            f"Updated {fetched:,.0f} financial records with data from FTC "
+            f"({counts['inserted']:,.0f} inserted, {counts['changed']:,.0f} changed, "
+            f"{counts['unchanged']:,.0f} unchanged)"
         )
+        log_engine_timings(db_con)
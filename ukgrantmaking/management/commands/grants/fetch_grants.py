@@ -1,5 +1,6 @@
 import logging
-from collections import defaultdict
+from collections import Counter, defaultdict
+from typing import Iterator
 
 import djclick as click
 import numpy as np
@@ -8,97 +9,322 @@ from django.db import transaction
 from django.db.models import Q
 
 from ukgrantmaking.models.financial_years import FinancialYear
-from ukgrantmaking.models.grant import CurrencyConverter, Grant
-from ukgrantmaking.utils import do_batched_update
+from ukgrantmaking.models.grant import (
+    CurrencyConverter,
+    DirtyFunderYear,
+    Grant,
+    GrantSourceFile,
+)
+from ukgrantmaking.utils.bulk import do_copy_update
+from ukgrantmaking.utils.db import get_engine, log_engine_timings, stream_connection
+from ukgrantmaking.utils.duplicates import DuplicateMatcher
+from ukgrantmaking.utils.fetch import fetch_file
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-
-@click.command()
-@click.argument("db_con", envvar="TSG_DATASTORE_URL")
-@click.option(
-    "--extra-file",
-    multiple=True,
-    help="Additional source files to include in the grants dataset outside of the award dates",
-)
-def grants(db_con: str, extra_file: list[str]):
-    current_fy = FinancialYear.objects.current()
-    datastore_query = """
-        WITH g AS materialized (SELECT * FROM view_latest_grant),
-        location_source AS (
-            SELECT g.grant_id,
-                jsonb_array_elements(g.additional_data->'locationLookup') AS location
-            FROM g
-        ),
-        location AS (
-            SELECT grant_id,
-                array_agg(DISTINCT "location"->>'rgncd') FILTER (WHERE "location"->>'source' like 'recipient%%' AND "location"->>'rgncd' IS NOT NULL) AS recipient_location_rgn,
-                array_agg(DISTINCT "location"->>'ctrycd') FILTER (WHERE "location"->>'source' like 'recipient%%' AND "location"->>'ctrycd' IS NOT NULL) AS recipient_location_ctry,
-                array_agg(DISTINCT "location"->>'rgncd') FILTER (WHERE "location"->>'source' like 'beneficiary%%' AND "location"->>'rgncd' IS NOT NULL) AS beneficiary_location_rgn,
-                array_agg(DISTINCT "location"->>'ctrycd') FILTER (WHERE "location"->>'source' like 'beneficiary%%' AND "location"->>'ctrycd' IS NOT NULL) AS beneficiary_location_ctry
-            FROM location_source
-            GROUP BY grant_id
-        )
-        SELECT g.data->>'id' AS "grant_id",
-            g.data->>'title' AS "title",
-            g.data->>'description' AS "description",
-            g.data->>'currency' AS "currency",
-            g.data->>'amountAwarded' AS "amount_awarded",
-            to_date(g.data->>'awardDate', 'YYYY-MM-DD') AS "award_date_registered",
-            g.data->'plannedDates'->0->>'duration' AS "planned_dates_duration",
-            to_date(g.data->'plannedDates'->0->>'startDate', 'YYYY-MM-DD') AS "planned_dates_startDate",
-            to_date(g.data->'plannedDates'->0->>'endDate', 'YYYY-MM-DD') AS "planned_dates_endDate",
-            g.data->'recipientOrganization'->0->>'id' AS "recipient_organization_id",
-            g.data->'recipientOrganization'->0->>'name' AS "recipient_organization_name",
-            g.data->'recipientIndividual'->>'id' AS "recipient_individual_id",
-            g.data->'recipientIndividual'->>'name' AS "recipient_individual_name",
-            g.data->'toIndividualsDetails'->>'primaryGrantReason' AS "recipient_individual_primary_grant_reason",
-            g.data->'toIndividualsDetails'->>'secondaryGrantReason' AS "recipient_individual_secondary_grant_reason",
-            g.data->'toIndividualsDetails'->>'grantPurpose' AS "recipient_individual_grant_purpose",
-            CASE WHEN g.data->>'recipientOrganization' IS NOT NULL THEN 'Organisation' ELSE 'Individual' END AS "recipient_type",
-            g.data->'fundingOrganization'->0->>'id' AS "funding_organization_id",
-            g.data->'fundingOrganization'->0->>'name' AS "funding_organization_name",
-            g.additional_data->>'TSGFundingOrgType' AS "funding_organization_type",
-            COALESCE(
-                g.data->'Managed by'->>'Organisation Name',
-                g.data->'fundingOrganization'->0->>'department'
-            ) AS "funding_organization_department",
-            g.data->>'regrantType' AS "regrant_type",
-            g.data->>'locationScope' AS "location_scope",
-            g.data->'grantProgramme'->0->>'title' AS "grant_programme_title",
-            g.source_data->'publisher'->>'prefix' AS "publisher_prefix",
-            g.source_data->'publisher'->>'name' AS "publisher_name",
-            g.source_data->>'license' AS "license",
-            g.source_data->>'identifier' AS "file_name",
-            recipient_location_rgn[1] AS "recipient_location_rgn",
-            recipient_location_ctry[1] AS "recipient_location_ctry",
-            beneficiary_location_rgn[1] AS "beneficiary_location_rgn",
-            beneficiary_location_ctry[1] AS "beneficiary_location_ctry"
+DATASTORE_QUERY = """
+    WITH g AS materialized (SELECT * FROM view_latest_grant),
+    location_source AS (
+        SELECT g.grant_id,
+            jsonb_array_elements(g.additional_data->'locationLookup') AS location
         FROM g
-            LEFT OUTER JOIN location
-                ON g.grant_id = location.grant_id
-        WHERE (
+    ),
+    location AS (
+        SELECT grant_id,
+            array_agg(DISTINCT "location"->>'rgncd') FILTER (WHERE "location"->>'source' like 'recipient%%' AND "location"->>'rgncd' IS NOT NULL) AS recipient_location_rgn,
+            array_agg(DISTINCT "location"->>'ctrycd') FILTER (WHERE "location"->>'source' like 'recipient%%' AND "location"->>'ctrycd' IS NOT NULL) AS recipient_location_ctry,
+            array_agg(DISTINCT "location"->>'rgncd') FILTER (WHERE "location"->>'source' like 'beneficiary%%' AND "location"->>'rgncd' IS NOT NULL) AS beneficiary_location_rgn,
+            array_agg(DISTINCT "location"->>'ctrycd') FILTER (WHERE "location"->>'source' like 'beneficiary%%' AND "location"->>'ctrycd' IS NOT NULL) AS beneficiary_location_ctry
+        FROM location_source
+        GROUP BY grant_id
+    )
+    SELECT g.data->>'id' AS "grant_id",
+        g.data->>'title' AS "title",
+        g.data->>'description' AS "description",
+        g.data->>'currency' AS "currency",
+        g.data->>'amountAwarded' AS "amount_awarded",
+        to_date(g.data->>'awardDate', 'YYYY-MM-DD') AS "award_date_registered",
+        g.data->'plannedDates'->0->>'duration' AS "planned_dates_duration",
+        to_date(g.data->'plannedDates'->0->>'startDate', 'YYYY-MM-DD') AS "planned_dates_startDate",
+        to_date(g.data->'plannedDates'->0->>'endDate', 'YYYY-MM-DD') AS "planned_dates_endDate",
+        g.data->'recipientOrganization'->0->>'id' AS "recipient_organization_id",
+        g.data->'recipientOrganization'->0->>'name' AS "recipient_organization_name",
+        g.data->'recipientIndividual'->>'id' AS "recipient_individual_id",
+        g.data->'recipientIndividual'->>'name' AS "recipient_individual_name",
+        g.data->'toIndividualsDetails'->>'primaryGrantReason' AS "recipient_individual_primary_grant_reason",
+        g.data->'toIndividualsDetails'->>'secondaryGrantReason' AS "recipient_individual_secondary_grant_reason",
+        g.data->'toIndividualsDetails'->>'grantPurpose' AS "recipient_individual_grant_purpose",
+        CASE WHEN g.data->>'recipientOrganization' IS NOT NULL THEN 'Organisation' ELSE 'Individual' END AS "recipient_type",
+        g.data->'fundingOrganization'->0->>'id' AS "funding_organization_id",
+        g.data->'fundingOrganization'->0->>'name' AS "funding_organization_name",
+        g.additional_data->>'TSGFundingOrgType' AS "funding_organization_type",
+        COALESCE(
+            g.data->'Managed by'->>'Organisation Name',
+            g.data->'fundingOrganization'->0->>'department'
+        ) AS "funding_organization_department",
+        g.data->>'regrantType' AS "regrant_type",
+        g.data->>'locationScope' AS "location_scope",
+        g.data->'grantProgramme'->0->>'title' AS "grant_programme_title",
+        g.source_data->'publisher'->>'prefix' AS "publisher_prefix",
+        g.source_data->'publisher'->>'name' AS "publisher_name",
+        g.source_data->>'license' AS "license",
+        g.source_data->>'identifier' AS "file_name",
+        recipient_location_rgn[1] AS "recipient_location_rgn",
+        recipient_location_ctry[1] AS "recipient_location_ctry",
+        beneficiary_location_rgn[1] AS "beneficiary_location_rgn",
+        beneficiary_location_ctry[1] AS "beneficiary_location_ctry"
+    FROM g
+        LEFT OUTER JOIN location
+            ON g.grant_id = location.grant_id
+    WHERE (
+            (
                 to_date(g.data->>'awardDate', 'YYYY-MM-DD') >= %(start_date)s
                 AND to_date(g.data->>'awardDate', 'YYYY-MM-DD') <= %(end_date)s
             )
             OR g.source_data->>'identifier' in %(extra_files)s
-    """
-
-    # get updated names and date of registration from FTC
-    logger.info("Fetching grants from datastore")
-    df = pd.read_sql(
-        datastore_query,
-        params={
-            "start_date": current_fy.grants_start_date,
-            "end_date": current_fy.grants_end_date,
-            "extra_files": tuple(extra_file) if extra_file else tuple(),
-        },
-        con=db_con,
-        index_col="grant_id",
+        )
+        {file_filter}
+"""
+
+# Only fetch grants from the given source files
+DATASTORE_FILE_FILTER = "AND g.source_data->>'identifier' in %(file_names)s"
+
+# Source files with grants in the current financial year, and the date they
+# were last modified, used to work out which files have changed since the last run.
+SOURCE_FILES_QUERY = """
+    SELECT g.source_data->>'identifier' AS "file_name",
+        max(COALESCE(g.source_data->>'modified', g.source_data->>'issued')) AS "modified",
+        count(*) AS "grant_count"
+    FROM view_latest_grant g
+    WHERE (
+            to_date(g.data->>'awardDate', 'YYYY-MM-DD') >= %(start_date)s
+            AND to_date(g.data->>'awardDate', 'YYYY-MM-DD') <= %(end_date)s
+        )
+        OR g.source_data->>'identifier' in %(extra_files)s
+    GROUP BY g.source_data->>'identifier'
+"""
+
+NL_COLUMN_RENAME = {
+    "Identifier": "grant_id",
+    "Title": "title",
+    "Description": "description",
+    "Currency": "currency",
+    "Amount Awarded": "amount_awarded",
+    "Award Date": "award_date_registered",
+    "Recipient Org:Identifier": "recipient_organization_id",
+    "Recipient Org:Name": "recipient_organization_name",
+    # 'Recipient Org:Ward': "",
+    # 'Recipient Org:UK Constituency': "",
+    # 'Recipient Org:Local Authority': "",
+    # 'Recipient Org:Region': "",
+    "Funding Org:Identifier": "funding_organization_id",
+    "Funding Org:Name": "funding_organization_name",
+    # 'Good Cause Area': "",
+    # 'Last Modified': "",
+}
+
+NL_DTYPES = {
+    "Identifier": "str",
+    "Title": "str",
+    "Description": "str",
+    "Currency": "str",
+    "Amount Awarded": "float64",
+    "Recipient Org:Identifier": "str",
+    "Recipient Org:Name": "str",
+    "Funding Org:Identifier": "str",
+    "Funding Org:Name": "str",
+}
+
+# Columns from the datastore query that are saved to the Grant model
+GRANT_SOURCE_COLUMNS = [
+    "title",
+    "description",
+    "currency",
+    "amount_awarded",
+    "award_date_registered",
+    "planned_dates_duration",
+    "planned_dates_startDate",
+    "planned_dates_endDate",
+    "recipient_organization_id",
+    "recipient_organization_name",
+    "recipient_individual_id",
+    "recipient_individual_name",
+    "recipient_individual_primary_grant_reason",
+    "recipient_individual_secondary_grant_reason",
+    "recipient_individual_grant_purpose",
+    "recipient_type",
+    "funding_organization_id",
+    "funding_organization_name",
+    "funding_organization_type",
+    "funding_organization_department",
+    "regrant_type",
+    "location_scope",
+    "grant_programme_title",
+    "publisher_prefix",
+    "publisher_name",
+    "license",
+    "file_name",
+]
+
+GRANT_UPDATE_FIELDS = [
+    "title",
+    "description",
+    "currency",
+    "amount_awarded",
+    "amount_awarded_GBP",
+    "award_date_registered",
+    "planned_dates_duration",
+    "planned_dates_startDate",
+    "planned_dates_endDate",
+    "recipient_organisation_id",
+    "recipient_organisation_name",
+    "recipient_individual_id",
+    "recipient_individual_name",
+    "recipient_individual_primary_grant_reason",
+    "recipient_individual_secondary_grant_reason",
+    "recipient_individual_grant_purpose",
+    "recipient_type_registered",
+    "funding_organisation_id",
+    "funding_organisation_name",
+    "funding_organisation_department",
+    "funding_organisation_type",
+    "regrant_type_registered",
+    "location_scope",
+    "grant_programme_title",
+    "publisher_prefix",
+    "publisher_name",
+    "license",
+    "file_name",
+    "financial_year_id",
+]
+
+
+def read_source_files(db_con: str, params: dict) -> pd.DataFrame:
+    with get_engine(db_con).connect() as conn:
+        source_files = pd.read_sql(
+            SOURCE_FILES_QUERY,
+            params=params,
+            con=conn,
+            index_col="file_name",
+        )
+    source_files["modified"] = pd.to_datetime(
+        source_files["modified"], utc=True, format="ISO8601"
     )
-    logger.info(f"Found {len(df):,.0f} grants")
+    return source_files
+
+
+def changed_source_files(
+    source_files: pd.DataFrame, current_fy: FinancialYear
+) -> list[str]:
+    # A file has changed if it hasn't been fetched before, or if its modified
+    # date is different to the one recorded when it was last fetched. Files
+    # without a modified date are always fetched.
+    previous = {
+        file_name: modified
+        for file_name, modified in GrantSourceFile.objects.filter(
+            financial_year=current_fy,
+            file_name__in=source_files.index,
+        ).values_list("file_name", "modified")
+    }
+    return [
+        file_name
+        for file_name, modified in source_files["modified"].items()
+        if pd.isna(modified)
+        or previous.get(file_name) is None
+        or previous[file_name] != modified.to_pydatetime()
+    ]
 
+
+def save_source_files(source_files: pd.DataFrame, current_fy: FinancialYear):
+    do_copy_update(
+        GrantSourceFile,
+        (
+            dict(
+                file_name=file_name,
+                financial_year=current_fy,
+                modified=None
+                if pd.isna(row.modified)
+                else row.modified.to_pydatetime(),
+                grant_count=row.grant_count,
+            )
+            for file_name, row in source_files.iterrows()
+        ),
+        unique_fields=["file_name", "financial_year"],
+        update_fields=["modified", "grant_count", "last_fetched"],
+    )
+    logger.info(f"Recorded {len(source_files):,.0f} source files")
+
+
+def existing_grants(current_fy: FinancialYear) -> pd.DataFrame:
+    # Grants from the datastore that are already in the database, used to
+    # match National Lottery grants when only some files have been fetched.
+    return (
+        pd.DataFrame.from_records(
+            Grant.objects.filter(financial_year=current_fy)
+            .exclude(publisher_prefix="dcms-nationallottery")
+            .values(
+                "grant_id",
+                "title",
+                "amount_awarded",
+                "award_date_registered",
+                "recipient_organisation_name",
+                "funding_organisation_id",
+            ),
+            columns=[
+                "grant_id",
+                "title",
+                "amount_awarded",
+                "award_date_registered",
+                "recipient_organisation_name",
+                "funding_organisation_id",
+            ],
+        )
+        .rename(
+            columns={
+                "recipient_organisation_name": "recipient_organization_name",
+                "funding_organisation_id": "funding_organization_id",
+            }
+        )
+        .set_index("grant_id")
+    )
+
+
+def read_datastore_grants(
+    db_con: str,
+    params: dict,
+    chunk_size: int | None = None,
+    file_names: list[str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    query = DATASTORE_QUERY.format(
+        file_filter=DATASTORE_FILE_FILTER if file_names is not None else ""
+    )
+    if file_names is not None:
+        params = {**params, "file_names": tuple(file_names)}
+
+    if not chunk_size:
+        with get_engine(db_con).connect() as conn:
+            yield pd.read_sql(
+                query,
+                params=params,
+                con=conn,
+                index_col="grant_id",
+            )
+        return
+
+    # use a server-side cursor so that only one chunk of rows is held in
+    # memory at a time
+    with stream_connection(db_con, chunk_size) as conn:
+        yield from pd.read_sql(
+            query,
+            params=params,
+            con=conn,
+            index_col="grant_id",
+            chunksize=chunk_size,
+        )
+
+
+def clean_datastore_grants(df: pd.DataFrame) -> pd.DataFrame:
     # strip any whitespace from the index
     df.index = df.index.str.strip()
 
@@ -122,8 +348,10 @@ def grants(db_con: str, extra_file: list[str]):
     duration = np.abs(np.ceil(duration))
 
     df["planned_dates_duration"] = df["planned_dates_duration"].fillna(duration)
+    return df
 
-    # add National Lottery data
+
+def fetch_nl_grants(current_fy: FinancialYear, offline: bool = False) -> pd.DataFrame:
     nl_api_vars = {
         "page": 1,
         "limit": 10,
@@ -146,29 +374,16 @@ def grants(db_con: str, extra_file: list[str]):
         + "&".join([f"{k}={v}" for k, v in nl_api_vars.items()])
     )
     logger.info("Fetching grants from National Lottery")
-    nl = pd.read_csv(nl_api_url, parse_dates=["Award Date"])
+    nl = pd.read_csv(
+        fetch_file(nl_api_url, suffix=".csv", offline=offline),
+        usecols=list(NL_COLUMN_RENAME.keys()),
+        dtype=NL_DTYPES,
+        parse_dates=["Award Date"],
+    )
     logger.info(f"Found {len(nl):,.0f} National Lottery grants")
 
-    nl_column_rename = {
-        "Identifier": "grant_id",
-        "Title": "title",
-        "Description": "description",
-        "Currency": "currency",
-        "Amount Awarded": "amount_awarded",
-        "Award Date": "award_date_registered",
-        "Recipient Org:Identifier": "recipient_organization_id",
-        "Recipient Org:Name": "recipient_organization_name",
-        # 'Recipient Org:Ward': "",
-        # 'Recipient Org:UK Constituency': "",
-        # 'Recipient Org:Local Authority': "",
-        # 'Recipient Org:Region': "",
-        "Funding Org:Identifier": "funding_organization_id",
-        "Funding Org:Name": "funding_organization_name",
-        # 'Good Cause Area': "",
-        # 'Last Modified': "",
-    }
     nl = (
-        nl.rename(columns=nl_column_rename)[nl_column_rename.values()]
+        nl.rename(columns=NL_COLUMN_RENAME)[NL_COLUMN_RENAME.values()]
         .assign(
             recipient_type="Organisation",
             funding_oganization_type="National Lottery Distributor",
@@ -195,91 +410,51 @@ def grants(db_con: str, extra_file: list[str]):
         ),
         "recipient_type",
     ] = "Individual"
+    return nl
 
-    # We want to exclude any grants from the National Lottery dataset that are
-    # present in the main Dataframe, so we can merge them without duplicating grants.
 
-    # Setup the exclusion variable with False as the default value.
-    nl.loc[:, "exclude"] = False
+def exclude_nl_duplicates(nl: pd.DataFrame, matcher: DuplicateMatcher) -> pd.DataFrame:
+    # We want to exclude any grants from the National Lottery dataset that are
+    # present in the 360Giving data, so we can merge them without duplicating grants.
 
-    # Next, look for any rows where the grant ID is the same.
+    # Grants are matched if the grant ID is the same, or if the title, amount,
+    # award date, recipient organisation name and funding organisation ID are the same.
+    duplicates = matcher.match(nl)
+    for rule, count in duplicates["rule"].value_counts().items():
+        logger.info(f"   {rule}: {count:,.0f} matches")
 
-    # National Lottery Community Fund grants have a slightly different format, but the same ID.
-    index_match = pd.Index(
-        [x.replace("DCMS-tnlcomfund-", "360G-tnlcomfund-") for x in nl.index]
+    logger.info(
+        f"Excluding {len(duplicates):,.0f} grants from National Lottery dataset"
     )
+    return nl[~nl.index.isin(duplicates.index)]
 
-    # set any grants where the index match is the same to exclude
-    nl.loc[index_match.isin(df.index), "exclude"] = True
-
-    # Next merge the two datasets together based on `amount_awarded`, `award_date_registered`,
-    # `recipient_organization_name` and `funding_organization_id`.
 
-    # Any grants where these fields match are marked as excluded.
-    match_fields = [
-        "title",
-        "amount_awarded",
-        "award_date_registered",
-        "recipient_organization_name",
-        "funding_organization_id",
-    ]
-    merged = (
-        nl.assign(
-            amount_awarded=nl.amount_awarded.astype(float),
-            award_date_registered=pd.to_datetime(
-                nl.award_date_registered, utc=True, format="ISO8601"
-            ),
-            grant_id=nl.index,
-            title=nl.title.str.strip().str.lower(),
-            recipient_organization_name=nl.recipient_organization_name.str.strip().str.lower(),
-        )
-        .merge(
-            df.assign(
-                amount_awarded=df.amount_awarded.astype(float),
-                award_date_registered=pd.to_datetime(
-                    df.award_date_registered, utc=True, format="ISO8601"
-                ),
-                grant_id=df.index,
-                title=df.title.str.strip().str.lower(),
-                recipient_organization_name=df.recipient_organization_name.str.strip().str.lower(),
-            ),
-            how="left",
-            left_on=match_fields,
-            right_on=match_fields,
-            suffixes=("_nl", "_df"),
+def drop_duplicate_grants(df: pd.DataFrame, grant_ids: set[str]) -> pd.DataFrame:
+    # drop any duplicate by grant_id (the index), including any grant_id
+    # that has already been saved from an earlier chunk
+    # @TODO: could redo the grant_id so that it's a unique identifier
+    duplicated = df[df.index.duplicated(keep=False) | df.index.isin(grant_ids)]
+    if len(duplicated):
+        logger.info(
+            f"Dropping {len(duplicated):,.0f} duplicate grants based on grant_id"
         )
-        .query("grant_id_df.notnull() & grant_id_nl.notnull()")
-        .drop_duplicates()
-    )
-
-    # set any grants which appear in both datasets to exclude
-    nl.loc[nl.index.isin(merged["grant_id_nl"]), "exclude"] = True
+        for funder_id, funder_name, count in (
+            duplicated.groupby(["funding_organization_id", "funding_organization_name"])
+            .size()
+            .reset_index()
+            .values
+        ):
+            logger.info(f"   {funder_id}: {funder_name}: {count:,.0f} duplicates")
+    return df[~df.index.duplicated(keep="first") & ~df.index.isin(grant_ids)]
 
-    logger.info(
-        f"Excluding {len(nl[nl['exclude']]):,.0f} grants from National Lottery dataset"
-    )
 
-    # Merge the National Lottery dataset into the main dataset.
-    df = pd.concat(
-        [
-            df,
-            nl[~nl["exclude"]].drop(columns=["exclude"]),
-        ]
+def prepare_grants(df: pd.DataFrame, current_fy: FinancialYear) -> pd.DataFrame:
+    # National Lottery grants don't have all the columns found in the
+    # datastore, so make sure they are all present before saving.
+    df = df.reindex(
+        columns=df.columns.union(GRANT_SOURCE_COLUMNS, sort=False),
     )
 
-    # drop any duplicate by grant_id (the index)
-    # @TODO: could redo the grant_id so that it's a unique identifier
-    duplicated = df[df.index.duplicated(keep=False)]
-    logger.info(f"Dropping {len(duplicated):,.0f} duplicate grants based on grant_id")
-    for funder_id, funder_name, count in (
-        duplicated.groupby(["funding_organization_id", "funding_organization_name"])
-        .size()
-        .reset_index()
-        .values
-    ):
-        logger.info(f"   {funder_id}: {funder_name}: {count:,.0f} duplicates")
-    df = df[~df.index.duplicated(keep="first")]
-
     # Start with the `amount_awarded` column, which should be an integer.
     df["amount_awarded"] = df["amount_awarded"].astype(float)
 
@@ -298,117 +473,231 @@ def grants(db_con: str, extra_file: list[str]):
 
     # Add in financial year - set to the current financial year
     df.loc[:, "financial_year"] = current_fy.fy
+    return df
+
+
+def mark_changed_grants(rows: list[tuple]):
+    # funder years for these grants need their totals recalculating, both
+    # for their new values and the values changed grants had before
+    DirtyFunderYear.objects.mark(
+        (
+            funder_id or funding_organisation_id,
+            award_date_registered if award_date_manual is None else award_date_manual,
+            financial_year_id,
+        )
+        for (
+            funder_id,
+            funding_organisation_id,
+            award_date_registered,
+            award_date_manual,
+            financial_year_id,
+        ) in rows
+    )
+
+
+def save_grants(df: pd.DataFrame) -> Counter:
+    logger.info("Saving currencies to database")
+    currency_dates = set(
+        df[~df["currency"].eq("GBP")]
+        .groupby(["currency", "award_date_registered"])
+        .size()
+        .index
+    )
+    existing = currency_dates & set(
+        CurrencyConverter.objects.filter(
+            currency__in={currency for currency, _ in currency_dates},
+            date__in={awarddate for _, awarddate in currency_dates},
+        ).values_list("currency", "date")
+    )
+    CurrencyConverter.objects.bulk_create(
+        [
+            CurrencyConverter(currency=currency, date=awarddate, rate=1)
+            for currency, awarddate in sorted(currency_dates - existing)
+        ],
+        ignore_conflicts=True,
+    )
+    currency_result = defaultdict(lambda: defaultdict(int))
+    for currency, awarddate in currency_dates:
+        if (currency, awarddate) in existing:
+            currency_result[currency]["found"] += 1
+        else:
+            currency_result[currency]["created"] += 1
+    for currency, result in sorted(currency_result.items()):
+        logger.info(
+            f"CurrencyConverter {currency}: {result['created']:,.0f} created, {result['found']:,.0f} found"
+        )
+
+    logger.info(f"Saving {len(df):,.0f} grants to database")
+    with click.progressbar(
+        df.replace({np.nan: None}).itertuples(),
+        length=len(df),
+        label="Saving Grant records",
+    ) as bar:
+
+        def iterate_grants():
+            for grant in bar:
+                yield dict(
+                    grant_id=grant.Index,
+                    title=grant.title,
+                    description=grant.description,
+                    currency=grant.currency,
+                    amount_awarded=grant.amount_awarded,
+                    amount_awarded_GBP=grant.amount_awarded_gbp,
+                    award_date_registered=grant.award_date_registered,
+                    planned_dates_duration=grant.planned_dates_duration,
+                    planned_dates_startDate=(
+                        None
+                        if pd.isnull(grant.planned_dates_startDate)
+                        else grant.planned_dates_startDate
+                    ),
+                    planned_dates_endDate=(
+                        None
+                        if pd.isnull(grant.planned_dates_endDate)
+                        else grant.planned_dates_endDate
+                    ),
+                    recipient_organisation_id=grant.recipient_organization_id,
+                    recipient_organisation_name=grant.recipient_organization_name,
+                    recipient_individual_id=grant.recipient_individual_id,
+                    recipient_individual_name=grant.recipient_individual_name,
+                    recipient_individual_primary_grant_reason=grant.recipient_individual_primary_grant_reason,
+                    recipient_individual_secondary_grant_reason=grant.recipient_individual_secondary_grant_reason,
+                    recipient_individual_grant_purpose=grant.recipient_individual_grant_purpose,
+                    recipient_type_registered=grant.recipient_type,
+                    funding_organisation_id=grant.funding_organization_id,
+                    funding_organisation_name=grant.funding_organization_name,
+                    funding_organisation_department=grant.funding_organization_department,
+                    funding_organisation_type=grant.funding_organization_type,
+                    regrant_type_registered=grant.regrant_type,
+                    location_scope=grant.location_scope,
+                    grant_programme_title=grant.grant_programme_title,
+                    publisher_prefix=grant.publisher_prefix,
+                    publisher_name=grant.publisher_name,
+                    license=grant.license,
+                    file_name=grant.file_name,
+                    financial_year_id=grant.financial_year,
+                )
+
+        counts = do_copy_update(
+            Grant,
+            iterate_grants(),
+            unique_fields=[
+                "grant_id",
+            ],
+            update_fields=GRANT_UPDATE_FIELDS,
+            hash_field="content_hash",
+            returning=[
+                "funder",
+                "funding_organisation_id",
+                "award_date_registered",
+                "award_date_manual",
+                "financial_year",
+            ],
+            on_returning=mark_changed_grants,
+        )
+    logger.info(
+        f"Saved {len(df):,.0f} grants to database "
+        f"({counts['inserted']:,.0f} inserted, {counts['changed']:,.0f} changed, "
+        f"{counts['unchanged']:,.0f} unchanged)"
+    )
+    return counts
+
+
+@click.command()
+@click.argument("db_con", envvar="TSG_DATASTORE_URL")
+@click.option(
+    "--extra-file",
+    multiple=True,
+    help="Additional source files to include in the grants dataset outside of the award dates",
+)
+@click.option(
+    "--chunk-size",
+    type=int,
+    default=None,
+    help="Stream grants from the datastore in chunks of this many rows, saving each chunk before the next is read",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Fetch grants from every source file, not just those that have changed since the last run",
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    help="Use the cached copy of the National Lottery data instead of downloading it",
+)
+def grants(
+    db_con: str,
+    extra_file: list[str],
+    chunk_size: int | None,
+    full: bool,
+    offline: bool,
+):
+    current_fy = FinancialYear.objects.current()
+    params = {
+        "start_date": current_fy.grants_start_date,
+        "end_date": current_fy.grants_end_date,
+        "extra_files": tuple(extra_file) if extra_file else tuple(),
+    }
+
+    logger.info("Fetching source files from datastore")
+    source_files = read_source_files(db_con, params)
+    logger.info(f"Found {len(source_files):,.0f} source files")
+    if full:
+        file_names = None
+    else:
+        file_names = changed_source_files(source_files, current_fy)
+        logger.info(
+            f"{len(file_names):,.0f} source files are new or have changed since the last run"
+        )
 
     with transaction.atomic():
-        logger.info("Saving currencies to database")
-        currency_result = defaultdict(int)
-        for currency, awarddate in (
-            df[~df["currency"].eq("GBP")]
-            .groupby(["currency", "award_date_registered"])
-            .size()
-            .index
-        ):
-            _, created = CurrencyConverter.objects.get_or_create(
-                currency=currency,
-                date=awarddate,
-                defaults={"rate": 1},
-            )
-            if created:
-                currency_result["CurrencyConverter created"] += 1
-            else:
-                currency_result["CurrencyConverter found"] += 1
-        for key, value in currency_result.items():
-            logger.info(f"{key}: {value:,.0f}")
-
-        logger.info(f"Saving {len(df):,.0f} grants to database")
-        with click.progressbar(
-            df.replace({np.nan: None}).itertuples(),
-            length=len(df),
-            label="Saving Grant records",
-        ) as bar:
-
-            def iterate_grants():
-                for grant in bar:
-                    yield dict(
-                        grant_id=grant.Index,
-                        title=grant.title,
-                        description=grant.description,
-                        currency=grant.currency,
-                        amount_awarded=grant.amount_awarded,
-                        amount_awarded_GBP=grant.amount_awarded_gbp,
-                        award_date_registered=grant.award_date_registered,
-                        planned_dates_duration=grant.planned_dates_duration,
-                        planned_dates_startDate=(
-                            None
-                            if pd.isnull(grant.planned_dates_startDate)
-                            else grant.planned_dates_startDate
-                        ),
-                        planned_dates_endDate=(
-                            None
-                            if pd.isnull(grant.planned_dates_endDate)
-                            else grant.planned_dates_endDate
-                        ),
-                        recipient_organisation_id=grant.recipient_organization_id,
-                        recipient_organisation_name=grant.recipient_organization_name,
-                        recipient_individual_id=grant.recipient_individual_id,
-                        recipient_individual_name=grant.recipient_individual_name,
-                        recipient_individual_primary_grant_reason=grant.recipient_individual_primary_grant_reason,
-                        recipient_individual_secondary_grant_reason=grant.recipient_individual_secondary_grant_reason,
-                        recipient_individual_grant_purpose=grant.recipient_individual_grant_purpose,
-                        recipient_type_registered=grant.recipient_type,
-                        funding_organisation_id=grant.funding_organization_id,
-                        funding_organisation_name=grant.funding_organization_name,
-                        funding_organisation_department=grant.funding_organization_department,
-                        funding_organisation_type=grant.funding_organization_type,
-                        regrant_type_registered=grant.regrant_type,
-                        location_scope=grant.location_scope,
-                        grant_programme_title=grant.grant_programme_title,
-                        publisher_prefix=grant.publisher_prefix,
-                        publisher_name=grant.publisher_name,
-                        license=grant.license,
-                        file_name=grant.file_name,
-                        financial_year_id=grant.financial_year,
-                    )
-
-            do_batched_update(
-                Grant,
-                iterate_grants(),
-                unique_fields=[
-                    "grant_id",
-                ],
-                update_fields=[
-                    "title",
-                    "description",
-                    "currency",
-                    "amount_awarded",
-                    "amount_awarded_GBP",
-                    "award_date_registered",
-                    "planned_dates_duration",
-                    "planned_dates_startDate",
-                    "planned_dates_endDate",
-                    "recipient_organisation_id",
-                    "recipient_organisation_name",
-                    "recipient_individual_id",
-                    "recipient_individual_name",
-                    "recipient_individual_primary_grant_reason",
-                    "recipient_individual_secondary_grant_reason",
-                    "recipient_individual_grant_purpose",
-                    "recipient_type_registered",
-                    "funding_organisation_id",
-                    "funding_organisation_name",
-                    "funding_organisation_department",
-                    "funding_organisation_type",
-                    "regrant_type_registered",
-                    "location_scope",
-                    "grant_programme_title",
-                    "publisher_prefix",
-                    "publisher_name",
-                    "license",
-                    "file_name",
-                    "financial_year_id",
-                ],
-            )
-        logger.info(f"Saved {len(df):,.0f} grants to database")
+        # Each chunk of grants from the datastore is cleaned and saved before
+        # the next one is read. We only keep the grant IDs and a hashed index
+        # of the fields needed to match against the National Lottery data.
+        grant_ids = set()
+        matcher = DuplicateMatcher()
+        total_grants = 0
+        counts = Counter()
+
+        if file_names is None or file_names:
+            logger.info("Fetching grants from datastore")
+            for df in read_datastore_grants(db_con, params, chunk_size, file_names):
+                logger.info(f"Found {len(df):,.0f} grants")
+                total_grants += len(df)
+
+                df = clean_datastore_grants(df)
+                matcher.add(df)
+                df = drop_duplicate_grants(df, grant_ids)
+                grant_ids.update(df.index)
+
+                counts += save_grants(prepare_grants(df, current_fy))
+                del df
+
+            if chunk_size:
+                logger.info(f"Found {total_grants:,.0f} grants in total from datastore")
+
+        if file_names is not None:
+            # Grants from unchanged files weren't fetched, so use the grants
+            # already in the database to check for National Lottery duplicates
+            existing = existing_grants(current_fy)
+            grant_ids.update(existing.index)
+            matcher = DuplicateMatcher()
+            matcher.add(existing)
+
+        # add National Lottery data
+        nl = fetch_nl_grants(current_fy, offline=offline)
+        nl = exclude_nl_duplicates(nl, matcher)
+        nl = drop_duplicate_grants(nl, grant_ids)
+        counts += save_grants(prepare_grants(nl, current_fy))
+        logger.info(
+            f"{counts['inserted']:,.0f} grants inserted, {counts['changed']:,.0f} changed "
+            f"and {counts['unchanged']:,.0f} unchanged"
+        )
+
+        # record the source files so unchanged files can be skipped next time
+        save_source_files(source_files, current_fy)
 
         # update grant inclusions
         logger.info("Updating grant inclusions")
@@ -454,19 +743,31 @@ def grants(db_con: str, extra_file: list[str]):
             logger.info(
                 "Updating award dates for any grants from extra files that are outside the current financial year"
             )
-            updated_lt = Grant.objects.filter(
+            grants_lt = Grant.objects.filter(
                 file_name__in=extra_file,
                 award_date_registered__lt=current_fy.grants_start_date,
                 award_date_manual__isnull=True,
-            ).update(award_date_manual=current_fy.grants_start_date)
+            )
+            DirtyFunderYear.objects.mark_grants(
+                grants_lt, award_date=current_fy.grants_start_date
+            )
+            updated_lt = grants_lt.update(
+                award_date_manual=current_fy.grants_start_date
+            )
             logger.info(
                 f"{updated_lt:,.0f} grants from extra files updated to current financial year start date"
             )
-            updated_gt = Grant.objects.filter(
+            grants_gt = Grant.objects.filter(
                 file_name__in=extra_file,
                 award_date_registered__gt=current_fy.grants_end_date,
                 award_date_manual__isnull=True,
-            ).update(award_date_manual=current_fy.grants_end_date)
+            )
+            DirtyFunderYear.objects.mark_grants(
+                grants_gt, award_date=current_fy.grants_end_date
+            )
+            updated_gt = grants_gt.update(award_date_manual=current_fy.grants_end_date)
             logger.info(
                 f"{updated_gt:,.0f} grants from extra files updated to current financial year end date"
             )
+
+    log_engine_timings(db_con)
@@ -1,49 +1,93 @@
 import logging
-from collections import defaultdict
-from datetime import date, timedelta
 
 import djclick as click
-from django.db import models, transaction
-from django.db.models import F, Sum
+from django.db import connection, models, transaction
+from django.db.models import F
 
 from ukgrantmaking.models.financial_years import FinancialYear, FinancialYearStatus
 from ukgrantmaking.models.funder import Funder
-from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
-from ukgrantmaking.models.funder_year import FunderYear
-from ukgrantmaking.models.grant import CurrencyConverter, Grant
+from ukgrantmaking.models.grant import (
+    MARK_DIRTY_FUNDER_YEARS_SQL,
+    DirtyFunderYear,
+    Grant,
+)
+from ukgrantmaking.utils.financial_year import update_financial_year
+from ukgrantmaking.utils.funder_year import (
+    clear_dirty_funder_years,
+    update_dirty_funder_year_grants,
+    update_funder_year_grants,
+)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Convert the amount awarded to GBP using the rate for the currency on the award date.
+# Only grants where the amount changes are updated, and their funder years are
+# marked for recalculation.
+UPDATE_CURRENCY_QUERY = f"""
+    WITH updated AS (
+        UPDATE ukgrantmaking_grant AS g
+        SET "amount_awarded_GBP" = round(g.amount_awarded * c.rate, 2)
+        FROM ukgrantmaking_currencyconverter AS c
+        WHERE c.currency = g.currency
+            AND c.date = g.award_date
+            AND c.rate IS NOT NULL
+            AND g."amount_awarded_GBP" IS DISTINCT FROM round(g.amount_awarded * c.rate, 2)
+        RETURNING g.currency,
+            COALESCE(g.funder_id, g.funding_organisation_id) AS funder_id,
+            g.award_date,
+            g.financial_year_id
+    ),
+    marked AS ({MARK_DIRTY_FUNDER_YEARS_SQL.format(changed="updated")})
+    SELECT currency, count(*)
+    FROM updated
+    GROUP BY currency
+    ORDER BY currency
+"""
+
+# Grants that move to a new financial year are marked for both the old and new
+# financial years.
+MARK_FINANCIAL_YEAR_CHANGES_SQL = MARK_DIRTY_FUNDER_YEARS_SQL.format(
+    changed="""(
+        SELECT COALESCE(funder_id, funding_organisation_id) AS funder_id,
+            award_date,
+            financial_year_id
+        FROM updated
+        UNION ALL
+        SELECT COALESCE(funder_id, funding_organisation_id),
+            award_date,
+            old_financial_year
+        FROM updated
+    )"""
+)
+
 
 @click.command()
 @click.option("--financial-year", type=str, required=False)
+@click.option(
+    "--all",
+    "all_funders",
+    is_flag=True,
+    default=False,
+    help="Recalculate funder years for all funders, not just those with changed grants",
+)
 @click.argument("funder_ids", type=str, required=False, nargs=-1)
-def grants(financial_year, funder_ids):
+def grants(financial_year, all_funders, funder_ids):
     with transaction.atomic():
         logger.info("Update financial year end based on award date")
-        for fy in FinancialYear.objects.all():
-            updated = Grant.objects.filter(
-                award_date__gte=fy.grants_start_date,
-                award_date__lte=fy.grants_end_date,
-            ).update(financial_year=fy)
-            logger.info(f"{updated} grants updated to financial year {fy.fy}")
+        for fy, updated in update_financial_year(
+            Grant,
+            "award_date",
+            date_type="grants",
+            on_update=MARK_FINANCIAL_YEAR_CHANGES_SQL,
+        ).items():
+            logger.info(f"{updated} grants updated to financial year {fy}")
 
         logger.info("Updating amount awarded not in GBP")
-        currencies = {
-            (currency.currency, currency.date): currency.rate
-            for currency in CurrencyConverter.objects.filter(rate__isnull=False)
-        }
-        currency_results = defaultdict(lambda: 0)
-        for currency, rate in currencies.items():
-            result = Grant.objects.filter(
-                currency=currency[0],
-                award_date=currency[1],
-            ).update(amount_awarded_GBP=F("amount_awarded") * rate)
-            currency_results[currency[0]] += result
-
-        for key, value in currency_results.items():
-            logger.info(f"   - {key}: {value:,.0f} grants updated")
+        with connection.cursor() as cursor:
+            cursor.execute(UPDATE_CURRENCY_QUERY)
+            for currency, result in cursor.fetchall():
+                logger.info(f"   - {currency}: {result:,.0f} grants updated")
 
         logger.info("Update funders based on departments for government grants")
         funding_department_filter = models.Q(
@@ -66,26 +110,36 @@ def grants(financial_year, funder_ids):
                     f"Department {department} not found in funder records, unable to update grants with this department"
                 )
                 continue
-            result = Grant.objects.filter(
+            department_grants = Grant.objects.filter(
                 funder_id__isnull=True,
                 publisher_prefix="360G-cabinetoffice",
                 funding_organisation_department=department,
-            ).update(funder_id=funding_department_lookup[department])
+            )
+            DirtyFunderYear.objects.mark(
+                (funding_department_lookup[department], award_date, financial_year_id)
+                for award_date, financial_year_id in department_grants.values_list(
+                    "award_date", "financial_year_id"
+                )
+                .distinct()
+                .order_by()
+            )
+            result = department_grants.update(
+                funder_id=funding_department_lookup[department]
+            )
             logger.info(
                 f"{result} grants updated with funder ID for department {department}"
             )
 
         logger.info("Match funders to funder records")
+        selected_funder_ids = list(funder_ids)
         if not funder_ids:
             funder_ids = Funder.objects.values_list("org_id", flat=True)
-        result = (
-            Grant.objects.filter(
-                funder_id__isnull=True,
-                funding_organisation_id__in=funder_ids,
-            )
-            .exclude(funding_department_filter)
-            .update(funder_id=F("funding_organisation_id"))
-        )
+        unmatched_grants = Grant.objects.filter(
+            funder_id__isnull=True,
+            funding_organisation_id__in=funder_ids,
+        ).exclude(funding_department_filter)
+        DirtyFunderYear.objects.mark_grants(unmatched_grants)
+        result = unmatched_grants.update(funder_id=F("funding_organisation_id"))
         logger.info(f"{result} grants updated with funder ID")
 
         missing_funder_ids = Grant.objects.filter(funder_id__isnull=True).count()
@@ -99,195 +153,21 @@ def grants(financial_year, funder_ids):
 
         # update funder years
         logger.info("Updating funder years")
-        if funder_ids:
-            funders = (
-                Grant.objects.filter(funder_id__in=funder_ids)
-                .values_list("funder_id", flat=True)
-                .distinct()
-            )
-        else:
-            funders = (
-                Grant.objects.filter(funder_id__isnull=False)
-                .values_list("funder_id", flat=True)
-                .distinct()
-            )
         if financial_year:
-            financial_years = FinancialYear.objects.filter(fy=financial_year)
+            financial_years = [financial_year]
         else:
-            financial_years = FinancialYear.objects.filter(
-                current=True, status=FinancialYearStatus.OPEN
+            # closed financial years are only recalculated when asked for, and
+            # any changes marked in them are kept until then
+            financial_years = list(
+                FinancialYear.objects.filter(
+                    current=True, status=FinancialYearStatus.OPEN
+                ).values_list("fy", flat=True)
             )
-        bulk_update = []
-        results = defaultdict(lambda: 0)
-        for funder_id in funders:
-            try:
-                funder = Funder.objects.get(org_id=funder_id)
-            except Funder.DoesNotExist:
-                logger.info(f"Funder {funder_id} not found")
-                continue
-            for year in financial_years:
-                funder_years = FunderYear.objects.filter(
-                    funder_financial_year__funder=funder,
-                    funder_financial_year__financial_year=year,
-                )
-
-                # if we've got existing data then use it
-                if funder_years:
-                    for funder_year in funder_years:
-                        financial_year_start = funder_year.financial_year_start
-                        if financial_year_start is None:
-                            financial_year_start = (
-                                funder_year.financial_year_end - timedelta(days=365)
-                            )
-                        grants_amount_by_recipient = (
-                            Grant.objects.filter(
-                                funder_id=funder.org_id,
-                                award_date__lte=funder_year.financial_year_end,
-                                award_date__gte=financial_year_start,
-                                inclusion__in=[
-                                    Grant.InclusionStatus.INCLUDED,
-                                    Grant.InclusionStatus.UNSURE,
-                                ],
-                            )
-                            .values("recipient_type")
-                            .annotate(grants_amount=Sum("amount_awarded_GBP"))
-                        )
-                        grant_amounts = {
-                            "Organisation": 0,
-                            "Individual": 0,
-                        }
-                        changed = True
-                        for grant_amount in grants_amount_by_recipient:
-                            if grant_amount["recipient_type"] != "Individual":
-                                grant_amounts["Organisation"] += grant_amount[
-                                    "grants_amount"
-                                ]
-                                changed = True
-                            if grant_amount["recipient_type"] == "Individual":
-                                grant_amounts["Individual"] += grant_amount[
-                                    "grants_amount"
-                                ]
-                                changed = True
-                        if changed:
-                            funder_year.spending_grant_making_institutions_main_360Giving = grant_amounts[
-                                "Organisation"
-                            ]
-                            funder_year.spending_grant_making_individuals_360Giving = (
-                                grant_amounts["Individual"]
-                            )
-                            logger.info(
-                                f"Updating {funder.name} [{funder.org_id}] {funder_year.financial_year_end}",
-                            )
-                            results["Funder years updated"] += 1
-                            bulk_update.append(funder_year)
-
-                # otherwise check for grants data and add it if it exists and the funder isn't a charity
-                elif funder.org_id_schema not in ("GB-CHC", "GB-SC", "GB-NIC"):
-                    grants_amount_by_recipient = (
-                        Grant.objects.filter(
-                            funder_id=funder.org_id,
-                            award_date__lte=year.grants_end_date,
-                            award_date__gte=year.grants_start_date,
-                            inclusion__in=[
-                                Grant.InclusionStatus.INCLUDED,
-                                Grant.InclusionStatus.UNSURE,
-                            ],
-                        )
-                        .values("recipient_type")
-                        .annotate(grants_amount=Sum("amount_awarded_GBP"))
-                    )
-                    if grants_amount_by_recipient:
-                        funder_financial_year = (
-                            FunderFinancialYear.objects.get_or_create(
-                                funder=funder, financial_year=year
-                            )[0]
-                        )
-
-                        fystart = year.grants_start_date
-                        fyend = year.grants_end_date
-
-                        # We should first check the latest funder financial data and use the same year end rather than the default
-                        previous_funder_year = funder.funder_years().first()
-                        if previous_funder_year and (
-                            year.contains_date_grant(
-                                previous_funder_year.financial_year_end
-                            )
-                            or year.contains_date_funder(
-                                previous_funder_year.financial_year_end
-                            )
-                        ):
-                            fyend = (
-                                date(
-                                    previous_funder_year.financial_year_end.year + 1,
-                                    previous_funder_year.financial_year_end.month,
-                                    previous_funder_year.financial_year_end.day - 1,
-                                )
-                                if (
-                                    previous_funder_year.financial_year_end.month == 2
-                                    and previous_funder_year.financial_year_end.day
-                                    == 29
-                                )
-                                else date(
-                                    previous_funder_year.financial_year_end.year + 1,
-                                    previous_funder_year.financial_year_end.month,
-                                    previous_funder_year.financial_year_end.day,
-                                )
-                            )
-                            fystart = (
-                                previous_funder_year.financial_year_end
-                                + timedelta(days=1)
-                            )
-
-                        funder_year = FunderYear(
-                            funder_financial_year=funder_financial_year,
-                            financial_year_start=fystart,
-                            financial_year_end=fyend,
-                        )
-                        logger.info(
-                            f"Creating {funder_financial_year.funder} {funder_year.financial_year_end}",
-                        )
-                        grant_amounts = {
-                            "Organisation": 0,
-                            "Individual": 0,
-                        }
-                        changed = True
-                        for grant_amount in grants_amount_by_recipient:
-                            if grant_amount["recipient_type"] != "Individual":
-                                grant_amounts["Organisation"] += grant_amount[
-                                    "grants_amount"
-                                ]
-                                changed = True
-                            if grant_amount["recipient_type"] == "Individual":
-                                grant_amounts["Individual"] += grant_amount[
-                                    "grants_amount"
-                                ]
-                                changed = True
-                        if changed:
-                            funder_year.spending_grant_making_institutions_main_360Giving = grant_amounts[
-                                "Organisation"
-                            ]
-                            funder_year.spending_grant_making_individuals_360Giving = (
-                                grant_amounts["Individual"]
-                            )
-                            logger.info(
-                                f"Updating {funder.name} [{funder.org_id}] {funder_year.financial_year_end}",
-                            )
-                            results["Funder years created"] += 1
-                            funder_year.save()
-                else:
-                    logger.info(
-                        f"Skipping {funder.name} [{funder.org_id}] as it's a charity and doesn't have funder years",
-                    )
-                    results["Funders skipped (charities)"] += 1
-
-        updated = FunderYear.objects.bulk_update(
-            bulk_update,
-            [
-                "spending_grant_making_institutions_main_360Giving",
-                "spending_grant_making_individuals_360Giving",
-            ],
-        )
-
+        if not (all_funders or selected_funder_ids):
+            # only recalculate funder years where the grants have changed
+            results = update_dirty_funder_year_grants(financial_years)
+        else:
+            results = update_funder_year_grants(financial_years, selected_funder_ids)
+            clear_dirty_funder_years(financial_years, selected_funder_ids)
         for key, value in results.items():
             logger.info(f"{value}: {key}")
-        logger.info(f"Updated {updated} funder years")
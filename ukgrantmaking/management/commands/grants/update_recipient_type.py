@@ -1,21 +1,310 @@
 import logging
+from collections import Counter
+from datetime import timedelta
 
 import djclick as click
+import numpy as np
 import pandas as pd
-from django.db import transaction
-from django.db.models import Count, OuterRef, Q, Subquery
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+from sqlalchemy import text
 
-from ukgrantmaking.models.grant import GOVERNMENT_EXCLUSIONS, Grant, GrantRecipient
-from ukgrantmaking.utils import batched
+from ukgrantmaking.models.grant import (
+    GOVERNMENT_EXCLUSIONS,
+    GOVERNMENT_FUNDER_TYPES,
+    MARK_DIRTY_FUNDER_YEARS_SQL,
+    RECIPIENT_TYPE_RULES,
+    CompanyCategory,
+    Grant,
+    GrantRecipient,
+)
+from ukgrantmaking.utils import DEFAULT_BATCH_SIZE, batched
+from ukgrantmaking.utils.db import get_engine, log_engine_timings
+from ukgrantmaking.utils.recipient_type import update_recipient_types
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# Find that Charity organisation types for companies that are also registered
+# as another type of organisation. These take precedence over the company
+# category.
+FTC_ORGANISATION_TYPES = {
+    "registered-charity": Grant.RecipientType.CHARITY,
+}
+
+COMPANY_CATEGORY_TYPES = {
+    **{
+        category: Grant.RecipientType.NON_PROFIT_COMPANY
+        for category in (
+            "royal-charter-company",
+            "royal-charter",
+            "private-limited-guarant-nsc",
+            "private-limited-guarant-nsc-limited-exemption",
+            "company-limited-by-guarantee",
+        )
+    },
+    "community-interest-company": Grant.RecipientType.COMMUNITY_INTEREST_COMPANY,
+    **{
+        category: Grant.RecipientType.CHARITY
+        for category in (
+            "charitable-incorporated-organisation",
+            "scottish-charitable-incorporated-organisation",
+        )
+    },
+    **{
+        category: Grant.RecipientType.MUTUAL
+        for category in (
+            "registered-society",
+            "registered-society-non-jurisdictional",
+            "industrial-and-provident-society",
+        )
+    },
+    **{
+        category: Grant.RecipientType.PRIVATE_COMPANY
+        for category in (
+            "ltd",
+            "other",
+            "plc",
+            "llp",
+            "private-unlimited",
+            "limited-partnership",
+            "registered-overseas-entity",
+            "private-limited-shares-section-30-exemption",
+        )
+    },
+}
+
+# Look up the company numbers loaded into a temporary table. Every company
+# number is returned, even if it isn't found, so that it isn't looked up again
+# until it is stale.
+COMPANY_CATEGORY_QUERY = """
+    SELECT 'GB-COH-' || n.company_number AS company_id,
+        cc."CompanyCategory" AS company_category,
+        ftc."organisationTypePrimary_id" AS ftc_organisation_type
+    FROM company_numbers AS n
+        LEFT OUTER JOIN companies_company AS cc
+            ON cc."CompanyNumber" = n.company_number
+        LEFT OUTER JOIN ftc_organisation AS ftc
+            ON ftc."companyNumber" = n.company_number
+            AND left(ftc.org_id, 7) <> 'GB-COH-'
+"""
+
+# Set the type of recipients with a company number from the local copy of the
+# company categories. Only recipients without a type are updated.
+UPDATE_COMPANY_RECIPIENT_TYPE_QUERY = """
+    WITH ftc_types AS (
+        SELECT *
+        FROM unnest(%(ftc_types)s::text[], %(ftc_recipient_types)s::text[])
+            AS t(organisation_type, recipient_type)
+    ),
+    category_types AS (
+        SELECT *
+        FROM unnest(%(categories)s::text[], %(category_recipient_types)s::text[])
+            AS t(category, recipient_type)
+    ),
+    updated AS (
+        UPDATE ukgrantmaking_grantrecipient AS r
+        SET type_manual = COALESCE(ft.recipient_type, ct.recipient_type)
+        FROM ukgrantmaking_companycategory AS c
+            LEFT OUTER JOIN ftc_types AS ft
+                ON ft.organisation_type = c.ftc_organisation_type
+            LEFT OUTER JOIN category_types AS ct
+                ON ct.category = c.company_category
+        WHERE r.recipient_id = c.company_id
+            AND r.type_manual IS NULL
+            AND COALESCE(ft.recipient_type, ct.recipient_type) IS NOT NULL
+        RETURNING r.type_manual
+    )
+    SELECT type_manual, count(*)
+    FROM updated
+    GROUP BY type_manual
+    ORDER BY type_manual
+"""
+
+# Copy the recipient type from the recipient to a batch of grants, and apply the
+# government exclusions based on the new recipient type, in a single pass. The
+# funder years of any grants that change are marked for recalculation.
+PROPAGATE_RECIPIENT_TYPE_QUERY = f"""
+    WITH exclusions AS (
+        SELECT *
+        FROM unnest(%(exclusion_types)s::text[], %(exclusion_statuses)s::text[])
+            AS t(recipient_type, inclusion)
+    ),
+    chunk AS (
+        SELECT g.grant_id,
+            g.recipient_type_manual AS old_recipient_type_manual,
+            g.inclusion AS old_inclusion,
+            g.funding_organisation_type,
+            COALESCE(
+                g.recipient_type_manual,
+                CASE
+                    WHEN r.type_manual = ANY(%(recipient_types)s) THEN r.type_manual
+                END
+            ) AS recipient_type_manual
+        FROM ukgrantmaking_grant AS g
+            LEFT OUTER JOIN ukgrantmaking_grantrecipient AS r
+                ON r.recipient_id = g.recipient_id
+        WHERE g.grant_id > %(after)s
+        ORDER BY g.grant_id
+        LIMIT %(batch_size)s
+    ),
+    new_values AS (
+        SELECT chunk.*,
+            CASE
+                WHEN chunk.old_inclusion = %(unsure)s
+                    AND chunk.funding_organisation_type = ANY(%(government_types)s)
+                THEN COALESCE(e.inclusion, chunk.old_inclusion)
+                ELSE chunk.old_inclusion
+            END AS inclusion
+        FROM chunk
+            LEFT OUTER JOIN exclusions AS e
+                ON e.recipient_type = chunk.recipient_type_manual
+    ),
+    updated AS (
+        UPDATE ukgrantmaking_grant AS g
+        SET recipient_type_manual = n.recipient_type_manual,
+            inclusion = n.inclusion
+        FROM new_values AS n
+        WHERE g.grant_id = n.grant_id
+            AND (n.old_recipient_type_manual, n.old_inclusion)
+                IS DISTINCT FROM (n.recipient_type_manual, n.inclusion)
+        RETURNING g.inclusion,
+            n.old_recipient_type_manual IS DISTINCT FROM n.recipient_type_manual
+                AS type_changed,
+            n.old_inclusion IS DISTINCT FROM n.inclusion AS inclusion_changed,
+            COALESCE(g.funder_id, g.funding_organisation_id) AS funder_id,
+            g.award_date,
+            g.financial_year_id
+    ),
+    marked AS ({MARK_DIRTY_FUNDER_YEARS_SQL.format(changed="updated")})
+    SELECT (SELECT max(grant_id) FROM chunk),
+        (SELECT count(*) FROM updated WHERE type_changed),
+        (SELECT array_agg(inclusion) FROM updated WHERE inclusion_changed)
+"""
+
+
+def propagate_recipient_types(
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> tuple[int, Counter]:
+    """
+    Copy recipient types to grants that don't have a manual recipient type,
+    and apply the government exclusions, in batches of grants ordered by grant
+    ID. Each batch is committed separately.
+
+    Returns the number of grants with a new recipient type, and the number of
+    grants given each inclusion status.
+    """
+    exclusions = {}
+    for inclusion, recipient_types in GOVERNMENT_EXCLUSIONS:
+        for recipient_type in recipient_types:
+            exclusions.setdefault(recipient_type, inclusion)
+    params = {
+        "recipient_types": Grant.RecipientType.values,
+        "exclusion_types": list(exclusions.keys()),
+        "exclusion_statuses": list(exclusions.values()),
+        "unsure": Grant.InclusionStatus.UNSURE,
+        "government_types": GOVERNMENT_FUNDER_TYPES,
+        "batch_size": batch_size,
+    }
+
+    types_updated = 0
+    inclusions = Counter()
+    after = ""
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(PROPAGATE_RECIPIENT_TYPE_QUERY, {**params, "after": after})
+            last_grant_id, updated, changed_inclusions = cursor.fetchone()
+        if last_grant_id is None:
+            break
+        after = last_grant_id
+        types_updated += updated
+        inclusions.update(changed_inclusions or [])
+    return types_updated, inclusions
+
+
+def fetch_company_categories(
+    db_con: str, company_ids: set[str], batch_size: int = 1_000
+) -> pd.DataFrame:
+    """
+    Fetch the company category and Find that Charity organisation type for
+    each company, and save them to the local copy.
+
+    The company numbers are loaded into a temporary table on the Find that
+    Charity database and joined to the company and organisation tables in a
+    single query.
+    """
+    # the temporary table is dropped at the end of the transaction, as the
+    # connection goes back to the shared pool
+    with get_engine(db_con).begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TEMPORARY TABLE company_numbers (company_number text PRIMARY KEY) "
+            "ON COMMIT DROP"
+        )
+        for company_numbers in batched(sorted(company_ids), batch_size):
+            conn.execute(
+                text("INSERT INTO company_numbers VALUES (:company_number)"),
+                [{"company_number": c.replace("GB-COH-", "")} for c in company_numbers],
+            )
+        companies = pd.read_sql(COMPANY_CATEGORY_QUERY, con=conn)
+
+    # a company can be linked to more than one organisation in Find that
+    # Charity, so use the one with a known type if there is one
+    companies = (
+        companies.assign(
+            known_type=companies["ftc_organisation_type"].isin(
+                FTC_ORGANISATION_TYPES.keys()
+            )
+        )
+        .sort_values(["company_id", "known_type"], ascending=[True, False])
+        .drop_duplicates(subset=["company_id"])
+        .replace({np.nan: None})
+    )
+
+    refreshed = timezone.now()
+    CompanyCategory.objects.bulk_create(
+        [
+            CompanyCategory(
+                company_id=company.company_id,
+                company_category=company.company_category,
+                ftc_organisation_type=company.ftc_organisation_type,
+                refreshed=refreshed,
+            )
+            for company in companies.itertuples()
+        ],
+        update_conflicts=True,
+        unique_fields=["company_id"],
+        update_fields=["company_category", "ftc_organisation_type", "refreshed"],
+        batch_size=batch_size,
+    )
+    return companies
+
 
 @click.command()
-@click.argument("db_con", envvar="FTC_DB_URL")
+@click.argument("db_con", envvar="FTC_DB_URL", required=False)
 @click.option("--company-batch-size", default=1_000)
-def recipient_type(db_con, company_batch_size):
+@click.option(
+    "--grant-batch-size",
+    default=DEFAULT_BATCH_SIZE,
+    help="Number of grants to update in each transaction when applying recipient types",
+)
+@click.option(
+    "--max-age",
+    default=90,
+    help="Fetch company categories again from Find that Charity if they are older than this many days",
+)
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    help="Only use the local copy of company categories, without connecting to Find that Charity",
+)
+def recipient_type(db_con, company_batch_size, grant_batch_size, max_age, offline):
+    if not offline and not db_con:
+        raise click.UsageError(
+            "A Find that Charity database connection is needed unless --offline is used"
+        )
+
     with transaction.atomic():
         logging.info("Update recipient types")
 
@@ -28,205 +317,64 @@ def recipient_type(db_con, company_batch_size):
         )
         logging.info(f"{updated} grants updated to individual")
 
-        filters = [
-            (
-                Grant.RecipientType.CHARITY,
-                (
-                    Q(recipient_id__startswith="GB-CHC-")
-                    | Q(recipient_id__startswith="GB-SC-")
-                    | Q(recipient_id__startswith="GB-NIC-")
-                ),
-            ),
-            (
-                Grant.RecipientType.LOCAL_AUTHORITY,
-                (
-                    Q(recipient_id__startswith="GB-LAE-")
-                    | Q(recipient_id__startswith="GB-LAS-")
-                    | Q(recipient_id__startswith="GB-PLA-")
-                    | Q(recipient_id__startswith="GB-LANI-")
-                    | Q(recipient_id__startswith="GB-UKLA-")
-                ),
-            ),
-            (
-                Grant.RecipientType.COMMUNITY_INTEREST_COMPANY,
-                Q(name__icontains="community interest company"),
-            ),
-            (
-                Grant.RecipientType.COMMUNITY_INTEREST_COMPANY,
-                Q(name__iendswith=" cic") & Q(recipient_id__startswith="GB-CIC-"),
-            ),
-            (
-                Grant.RecipientType.LOCAL_AUTHORITY,
-                (
-                    Q(recipient_id__startswith="GB-UKPRN-")
-                    | Q(recipient_id__startswith="GB-EDU-")
-                )
-                & Q(name__icontains="council"),
-            ),
-            (
-                Grant.RecipientType.NHS,
-                (
-                    Q(recipient_id__startswith="GB-UKPRN-")
-                    | Q(recipient_id__startswith="GB-EDU-")
-                )
-                & Q(name__icontains="nhs"),
-            ),
-            (
-                Grant.RecipientType.UNIVERSITY,
-                Q(name__icontains="university") & ~Q(name__icontains="third age"),
-            ),
-            (
-                Grant.RecipientType.NHS,
-                Q(recipient_id__startswith="GB-NHS-"),
-            ),
-            (
-                Grant.RecipientType.EDUCATION,
-                (
-                    Q(recipient_id__startswith="GB-UKPRN-")
-                    | Q(recipient_id__startswith="GB-EDU-")
-                    | Q(recipient_id__startswith="GB-SCOTEDU-")
-                    | Q(recipient_id__startswith="GB-WALEDU-")
-                    | Q(recipient_id__startswith="GB-NIEDU-")
-                ),
-            ),
-            (
-                Grant.RecipientType.SPORTS_CLUB,
-                Q(recipient_id__startswith="GB-CASC-"),
-            ),
-            (
-                Grant.RecipientType.LOCAL_AUTHORITY,
-                Q(name__iregex="(town|parish|community|county|district) Council"),
+        logging.info("Finding recipient types from ID and name")
+        updated = update_recipient_types(
+            GrantRecipient.objects.filter(
+                type_registered=Grant.RecipientType.ORGANISATION,
+                type_manual__isnull=True,
             ),
-        ]
-        for recipient_type, filter in filters:
-            logging.info(f"Finding {recipient_type}")
-            updated = GrantRecipient.objects.filter(
-                Q(type_registered=Grant.RecipientType.ORGANISATION)
-                & Q(type_manual__isnull=True)
-                & filter
-            ).update(
-                type_manual=recipient_type,
-            )
-            logging.info(f"{updated:,.0f} grants updated to {recipient_type}")
+            RECIPIENT_TYPE_RULES,
+        )
+        logging.info(f"{updated:,.0f} grants updated from ID and name")
 
         logging.info("Sort out company numbers")
-        all_company_numbers = (
+        company_ids = set(
             GrantRecipient.objects.filter(
                 recipient_id__startswith="GB-COH-",
                 type_manual__isnull=True,
-            )
-            .values_list("recipient_id", flat=True)
-            .distinct()
+            ).values_list("recipient_id", flat=True)
         )
-        logging.info(f"{len(all_company_numbers)} company numbers to check")
-
-        # process company numbers in batches
-        for company_numbers in batched(all_company_numbers, company_batch_size):
-            logging.info(f"Processing {len(company_numbers)} company numbers")
+        logging.info(f"{len(company_ids):,.0f} company numbers to check")
 
-            charitable_companies = pd.read_sql(
-                """
-                SELECT org_id,
-                    "organisationTypePrimary_id",
-                    'GB-COH-' || "companyNumber" as company_id
-                FROM ftc_organisation
-                WHERE "companyNumber" IN %(org_ids)s
-                    AND org_id NOT LIKE 'GB-COH-%%'
-                """,
-                con=db_con,
-                params={
-                    "org_ids": tuple(
-                        c.replace("GB-COH-", "")
-                        for c in company_numbers
-                        if isinstance(c, str)
-                    )
-                },
+        to_fetch = company_ids - set(
+            CompanyCategory.objects.filter(
+                company_id__in=company_ids,
+                refreshed__gte=timezone.now() - timedelta(days=max_age),
+            ).values_list("company_id", flat=True)
+        )
+        if offline:
+            logging.info(
+                f"{len(to_fetch):,.0f} company numbers are new or stale, but not fetching them"
             )
-            for org_type in charitable_companies["organisationTypePrimary_id"].unique():
-                recipient_type = None
-                if org_type == "registered-charity":
-                    recipient_type = Grant.RecipientType.CHARITY
-                else:
-                    logging.warning(f"Unknown org type {org_type}")
-                    continue
-
-                updated = GrantRecipient.objects.filter(
-                    recipient_id__in=charitable_companies.loc[
-                        charitable_companies["organisationTypePrimary_id"] == org_type,
-                        "company_id",
-                    ].unique(),
-                    type_manual__isnull=True,
-                ).update(
-                    type_manual=recipient_type,
-                )
-                logging.info(f"{updated} grants to charitable companies found")
+        elif to_fetch:
+            logging.info(f"Fetching {len(to_fetch):,.0f} new or stale company numbers")
+            companies = fetch_company_categories(db_con, to_fetch, company_batch_size)
+            logging.info(f"{len(companies):,.0f} company numbers fetched")
+            log_engine_timings(db_con)
 
-            all_companies = pd.read_sql(
-                """
-                SELECT "CompanyCategory",
-                    'GB-COH-' || "CompanyNumber" as company_id
-                FROM companies_company
-                WHERE "CompanyNumber" IN %(org_ids)s
-                """,
-                con=db_con,
-                params={
-                    "org_ids": tuple(
-                        c.replace("GB-COH-", "")
-                        for c in company_numbers
-                        if isinstance(c, str)
-                    )
+        logging.info("Updating recipient types from company categories")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                UPDATE_COMPANY_RECIPIENT_TYPE_QUERY,
+                {
+                    "ftc_types": list(FTC_ORGANISATION_TYPES.keys()),
+                    "ftc_recipient_types": list(FTC_ORGANISATION_TYPES.values()),
+                    "categories": list(COMPANY_CATEGORY_TYPES.keys()),
+                    "category_recipient_types": list(COMPANY_CATEGORY_TYPES.values()),
                 },
             )
-            for org_type in all_companies["CompanyCategory"].unique():
-                recipient_type = None
-                if org_type in (
-                    "royal-charter-company",
-                    "royal-charter",
-                    "private-limited-guarant-nsc",
-                    "private-limited-guarant-nsc-limited-exemption",
-                    "company-limited-by-guarantee",
-                ):
-                    recipient_type = Grant.RecipientType.NON_PROFIT_COMPANY
-                elif org_type in ("community-interest-company",):
-                    recipient_type = Grant.RecipientType.COMMUNITY_INTEREST_COMPANY
-                elif org_type in (
-                    "charitable-incorporated-organisation",
-                    "scottish-charitable-incorporated-organisation",
-                ):
-                    recipient_type = Grant.RecipientType.CHARITY
-                elif org_type in (
-                    "registered-society",
-                    "registered-society-non-jurisdictional",
-                    "industrial-and-provident-society",
-                ):
-                    recipient_type = Grant.RecipientType.MUTUAL
-                elif org_type in (
-                    "ltd",
-                    "other",
-                    "plc",
-                    "llp",
-                    "private-unlimited",
-                    "limited-partnership",
-                    "registered-overseas-entity",
-                    "private-limited-shares-section-30-exemption",
-                ):
-                    recipient_type = Grant.RecipientType.PRIVATE_COMPANY
-                else:
-                    logging.warning(f"Unknown org type {org_type}")
-                    continue
-
-                updated = GrantRecipient.objects.filter(
-                    recipient_id__in=all_companies.loc[
-                        all_companies["CompanyCategory"] == org_type,
-                        "company_id",
-                    ].unique(),
-                    type_manual__isnull=True,
-                ).update(
-                    type_manual=recipient_type,
-                )
+            for recipient_type, updated in cursor.fetchall():
                 logging.info(
-                    f"{updated:,.0f} grants to nonprofit companies found as {recipient_type}",
+                    f"{updated:,.0f} grants to companies found as {recipient_type}"
                 )
+        for org_type in (
+            CompanyCategory.objects.filter(company_id__in=company_ids)
+            .exclude(company_category__isnull=True)
+            .exclude(company_category__in=COMPANY_CATEGORY_TYPES.keys())
+            .values_list("company_category", flat=True)
+            .distinct()
+        ):
+            logging.warning(f"Unknown org type {org_type}")
 
         progress = GrantRecipient.objects.values("type_manual").annotate(
             count=Count("recipient_id")
@@ -234,49 +382,19 @@ def recipient_type(db_con, company_batch_size):
         for p in progress:
             logging.info(f"{p['type_manual']}: {p['count']}")
 
-        logging.info("Applying manual overrides from GrantRecipient to Grant")
-        updated = (
-            Grant.objects.select_related("recipient")
-            .select_for_update()
-            .filter(
-                Q(recipient_type_manual__isnull=True)
-                & Q(recipient__type_manual__in=Grant.RecipientType.values)
-            )
-            .update(
-                recipient_type_manual=Subquery(
-                    GrantRecipient.objects.filter(
-                        recipient_id=OuterRef("recipient_id")
-                    ).values("type_manual")[:1]
-                ),
-            )
-        )
-        logging.info(f"{updated} grants updated with recipient type manual")
-
-        logging.info("Update government exclusion list")
-        for inclusion, filter in GOVERNMENT_EXCLUSIONS:
-            updated = Grant.objects.filter(
-                inclusion=Grant.InclusionStatus.UNSURE,
-                funding_organisation_type__in=[
-                    Grant.FunderType.CENTRAL_GOVERNMENT,
-                    Grant.FunderType.LOCAL_GOVERNMENT,
-                    Grant.FunderType.DEVOLVED_GOVERNMENT,
-                ],
-                recipient_type_manual__in=filter,
-            ).update(
-                inclusion=inclusion,
-            )
-            logging.info(f"{updated} grants updated to {inclusion}")
+    # grants are updated in separately committed batches, so that rows in the
+    # grants table are only locked for one batch at a time
+    logging.info("Applying manual overrides from GrantRecipient to Grant")
+    logging.info("Update government exclusion list")
+    updated, inclusions = propagate_recipient_types(grant_batch_size)
+    logging.info(f"{updated:,.0f} grants updated with recipient type manual")
+    for inclusion, count in sorted(inclusions.items()):
+        logging.info(f"{count:,.0f} grants updated to {inclusion}")
 
-        progress = (
-            Grant.objects.filter(
-                funding_organisation_type__in=[
-                    Grant.FunderType.CENTRAL_GOVERNMENT,
-                    Grant.FunderType.LOCAL_GOVERNMENT,
-                    Grant.FunderType.DEVOLVED_GOVERNMENT,
-                ]
-            )
-            .values("inclusion")
-            .annotate(count=Count("grant_id"))
-        )
-        for p in progress:
-            logging.info(f"{p['inclusion']}: {p['count']}")
+    progress = (
+        Grant.objects.filter(funding_organisation_type__in=GOVERNMENT_FUNDER_TYPES)
+        .values("inclusion")
+        .annotate(count=Count("grant_id"))
+    )
+    for p in progress:
+        logging.info(f"{p['inclusion']}: {p['count']}")
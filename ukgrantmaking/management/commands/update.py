@@ -3,6 +3,12 @@ import djclick as click
 from ukgrantmaking.management.commands.funders.update_financial_year import (
     financial_year,
 )
+from ukgrantmaking.management.commands.funders.update_funder_aggregates import (
+    funder_aggregates,
+)
+from ukgrantmaking.management.commands.funders.update_funder_successors import (
+    funder_successors,
+)
 from ukgrantmaking.management.commands.grants.update_grants import grants
 from ukgrantmaking.management.commands.grants.update_recipient_type import (
     recipient_type,
@@ -15,5 +21,7 @@ def main():
 
 
 main.add_command(financial_year, "financial-year")
+main.add_command(funder_aggregates, "funder-aggregates")
+main.add_command(funder_successors, "funder-successors")
 main.add_command(grants, "grants")
 main.add_command(recipient_type, "grant-recipient-type")
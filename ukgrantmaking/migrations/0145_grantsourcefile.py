@@ -0,0 +1,44 @@
+# Generated by Django 6.0.3 on 2026-10-18 00:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ukgrantmaking", "0144_grantrecipient_imd_decile"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="GrantSourceFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("file_name", models.CharField(max_length=255)),
+                ("modified", models.DateTimeField(blank=True, null=True)),
+                ("grant_count", models.IntegerField(default=0)),
+                ("last_fetched", models.DateTimeField(auto_now=True)),
+                (
+                    "financial_year",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="source_files",
+                        to="ukgrantmaking.financialyear",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["financial_year", "file_name"],
+                "unique_together": {("file_name", "financial_year")},
+            },
+        ),
+    ]
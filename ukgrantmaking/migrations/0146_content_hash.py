@@ -0,0 +1,56 @@
+# Generated by Django 6.0.3 on 2026-10-18 00:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ukgrantmaking", "0145_grantsourcefile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="funderyear",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+                max_length=32,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="grant",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+                max_length=32,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="grantrecipient",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+                max_length=32,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="grantrecipientyear",
+            name="content_hash",
+            field=models.CharField(
+                blank=True,
+                editable=False,
+                help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+                max_length=32,
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 6.0.3 on 2026-10-18 00:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ukgrantmaking", "0146_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DirtyFunderYear",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("marked", models.DateTimeField(auto_now_add=True)),
+                (
+                    "financial_year",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="ukgrantmaking.financialyear",
+                    ),
+                ),
+                (
+                    "funder",
+                    models.ForeignKey(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="ukgrantmaking.funder",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("funder", "financial_year")},
+            },
+        ),
+    ]
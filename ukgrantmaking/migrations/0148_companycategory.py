@@ -0,0 +1,33 @@
+# Generated by Django 6.0.3 on 2026-10-18 00:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ukgrantmaking", "0147_dirtyfunderyear"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CompanyCategory",
+            fields=[
+                (
+                    "company_id",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                (
+                    "company_category",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                (
+                    "ftc_organisation_type",
+                    models.CharField(blank=True, max_length=255, null=True),
+                ),
+                ("refreshed", models.DateTimeField()),
+            ],
+            options={
+                "verbose_name_plural": "company categories",
+            },
+        ),
+    ]
@@ -0,0 +1,190 @@
+from django.db import migrations
+
+CREATE_AGGREGATE_TRIGGERS_SQL = """
+    CREATE OR REPLACE FUNCTION ukgrantmaking_funderyear_update_aggregates()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        ffy_ids bigint[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM old_rows;
+        ELSE
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM (
+                SELECT funder_financial_year_id FROM new_rows
+                UNION
+                SELECT funder_financial_year_id FROM old_rows
+            ) AS changed;
+        END IF;
+        IF ffy_ids IS NOT NULL THEN
+            WITH target AS (
+        SELECT id
+        FROM ukgrantmaking_funderfinancialyear
+        WHERE FALSE
+            OR id = ANY(ffy_ids::bigint[])
+    ),
+    fy AS (
+        SELECT fyr.*,
+            CASE WHEN (
+                fyr.funds_endowment IS NOT NULL
+                OR fyr.funds_restricted IS NOT NULL
+                OR fyr.funds_unrestricted IS NOT NULL
+            ) THEN (
+                COALESCE(fyr.funds_endowment, 0)
+                + COALESCE(fyr.funds_restricted, 0)
+                + COALESCE(fyr.funds_unrestricted, 0)
+            ) END AS funds_calculated,
+            CASE WHEN (
+                fyr.employees_permanent IS NOT NULL
+                OR fyr.employees_fixedterm IS NOT NULL
+                OR fyr.employees_selfemployed IS NOT NULL
+            ) THEN (
+                COALESCE(fyr.employees_permanent, 0)
+                + COALESCE(fyr.employees_fixedterm, 0)
+                + COALESCE(fyr.employees_selfemployed, 0)
+            ) END AS employees_calculated
+        FROM ukgrantmaking_funderyear AS fyr
+            INNER JOIN target
+                ON fyr.funder_financial_year_id = target.id
+    ),
+    latest_fields AS (
+        SELECT DISTINCT ON (funder_financial_year_id)
+            funder_financial_year_id,
+            COALESCE(total_net_assets, funds_calculated) AS total_net_assets,
+            COALESCE(funds, funds_calculated) AS funds,
+            funds_endowment,
+            funds_restricted,
+            funds_unrestricted,
+            COALESCE(employees, employees_calculated) AS employees,
+            employees_permanent,
+            employees_fixedterm,
+            employees_selfemployed
+        FROM fy
+        ORDER BY funder_financial_year_id, financial_year_end DESC
+    ),
+    summed_fields AS (
+        SELECT funder_financial_year_id,
+            SUM(income) AS income,
+            SUM(income_investment) AS income_investment,
+            SUM(spending) AS spending,
+            SUM(spending_investment) AS spending_investment,
+            SUM(spending_charitable) AS spending_charitable,
+            SUM(spending_grant_making) AS spending_grant_making,
+            SUM(spending_grant_making_individuals) AS spending_grant_making_individuals,
+            SUM(spending_grant_making_institutions_charitable) AS spending_grant_making_institutions_charitable,
+            SUM(spending_grant_making_institutions_noncharitable) AS spending_grant_making_institutions_noncharitable,
+            SUM(spending_grant_making_institutions_unknown) AS spending_grant_making_institutions_unknown,
+            SUM(spending_grant_making_institutions_main) AS spending_grant_making_institutions_main,
+            SUM(spending_grant_making_institutions) AS spending_grant_making_institutions
+        FROM fy
+        GROUP BY funder_financial_year_id
+    ),
+    new_values AS (
+        SELECT target.id,
+            s.income,
+            s.income_investment,
+            s.spending,
+            s.spending_investment,
+            s.spending_charitable,
+            s.spending_grant_making,
+            s.spending_grant_making_individuals,
+            s.spending_grant_making_institutions_charitable,
+            s.spending_grant_making_institutions_noncharitable,
+            s.spending_grant_making_institutions_unknown,
+            s.spending_grant_making_institutions_main,
+            s.spending_grant_making_institutions,
+            l.total_net_assets,
+            l.funds,
+            l.funds_endowment,
+            l.funds_restricted,
+            l.funds_unrestricted,
+            l.employees,
+            l.employees_permanent,
+            l.employees_fixedterm,
+            l.employees_selfemployed
+        FROM target
+            LEFT OUTER JOIN summed_fields AS s
+                ON s.funder_financial_year_id = target.id
+            LEFT OUTER JOIN latest_fields AS l
+                ON l.funder_financial_year_id = target.id
+    )
+    UPDATE ukgrantmaking_funderfinancialyear AS ffy
+    SET income = v.income,
+        income_investment = v.income_investment,
+        spending = v.spending,
+        spending_investment = v.spending_investment,
+        spending_charitable = v.spending_charitable,
+        spending_grant_making = v.spending_grant_making,
+        spending_grant_making_individuals = v.spending_grant_making_individuals,
+        spending_grant_making_institutions_charitable = v.spending_grant_making_institutions_charitable,
+        spending_grant_making_institutions_noncharitable = v.spending_grant_making_institutions_noncharitable,
+        spending_grant_making_institutions_unknown = v.spending_grant_making_institutions_unknown,
+        spending_grant_making_institutions_main = v.spending_grant_making_institutions_main,
+        spending_grant_making_institutions = v.spending_grant_making_institutions,
+        total_net_assets = v.total_net_assets,
+        funds = v.funds,
+        funds_endowment = v.funds_endowment,
+        funds_restricted = v.funds_restricted,
+        funds_unrestricted = v.funds_unrestricted,
+        employees = v.employees,
+        employees_permanent = v.employees_permanent,
+        employees_fixedterm = v.employees_fixedterm,
+        employees_selfemployed = v.employees_selfemployed
+    FROM new_values AS v
+    WHERE ffy.id = v.id
+        AND (ffy.income, ffy.income_investment, ffy.spending, ffy.spending_investment, ffy.spending_charitable, ffy.spending_grant_making, ffy.spending_grant_making_individuals, ffy.spending_grant_making_institutions_charitable, ffy.spending_grant_making_institutions_noncharitable, ffy.spending_grant_making_institutions_unknown, ffy.spending_grant_making_institutions_main, ffy.spending_grant_making_institutions, ffy.total_net_assets, ffy.funds, ffy.funds_endowment, ffy.funds_restricted, ffy.funds_unrestricted, ffy.employees, ffy.employees_permanent, ffy.employees_fixedterm, ffy.employees_selfemployed) IS DISTINCT FROM (v.income, v.income_investment, v.spending, v.spending_investment, v.spending_charitable, v.spending_grant_making, v.spending_grant_making_individuals, v.spending_grant_making_institutions_charitable, v.spending_grant_making_institutions_noncharitable, v.spending_grant_making_institutions_unknown, v.spending_grant_making_institutions_main, v.spending_grant_making_institutions, v.total_net_assets, v.funds, v.funds_endowment, v.funds_restricted, v.funds_unrestricted, v.employees, v.employees_permanent, v.employees_fixedterm, v.employees_selfemployed);
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_insert ON ukgrantmaking_funderyear;
+    CREATE TRIGGER ukgrantmaking_funderyear_aggregates_insert
+        AFTER INSERT ON ukgrantmaking_funderyear
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION ukgrantmaking_funderyear_update_aggregates();
+    ALTER TABLE ukgrantmaking_funderyear DISABLE TRIGGER ukgrantmaking_funderyear_aggregates_insert;
+
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_update ON ukgrantmaking_funderyear;
+    CREATE TRIGGER ukgrantmaking_funderyear_aggregates_update
+        AFTER UPDATE ON ukgrantmaking_funderyear
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION ukgrantmaking_funderyear_update_aggregates();
+    ALTER TABLE ukgrantmaking_funderyear DISABLE TRIGGER ukgrantmaking_funderyear_aggregates_update;
+
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_delete ON ukgrantmaking_funderyear;
+    CREATE TRIGGER ukgrantmaking_funderyear_aggregates_delete
+        AFTER DELETE ON ukgrantmaking_funderyear
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION ukgrantmaking_funderyear_update_aggregates();
+    ALTER TABLE ukgrantmaking_funderyear DISABLE TRIGGER ukgrantmaking_funderyear_aggregates_delete;
+"""
+
+DROP_AGGREGATE_TRIGGERS_SQL = """
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_insert ON ukgrantmaking_funderyear;
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_update ON ukgrantmaking_funderyear;
+    DROP TRIGGER IF EXISTS ukgrantmaking_funderyear_aggregates_delete ON ukgrantmaking_funderyear;
+    DROP FUNCTION IF EXISTS ukgrantmaking_funderyear_update_aggregates();
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("ukgrantmaking", "0148_companycategory"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            CREATE_AGGREGATE_TRIGGERS_SQL,
+            reverse_sql=DROP_AGGREGATE_TRIGGERS_SQL,
+        ),
+    ]
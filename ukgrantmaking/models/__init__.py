@@ -22,10 +22,13 @@ from ukgrantmaking.models.funder_utils import (
 )
 from ukgrantmaking.models.funder_year import FunderYear
 from ukgrantmaking.models.grant import (
+    CompanyCategory,
     CurrencyConverter,
+    DirtyFunderYear,
     Grant,
     GrantRecipient,
     GrantRecipientYear,
+    GrantSourceFile,
 )
 from ukgrantmaking.models.views.funders import FundersView
 from ukgrantmaking.models.views.funders_analysis import FundersAnalysisView
@@ -53,7 +56,10 @@ __all__ = [
     "Grant",
     "GrantRecipient",
     "GrantRecipientYear",
+    "GrantSourceFile",
+    "CompanyCategory",
     "CurrencyConverter",
+    "DirtyFunderYear",
     "CleaningStatus",
     "CleaningStatusQuery",
     "CleaningStatusType",
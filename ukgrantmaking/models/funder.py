@@ -23,6 +23,7 @@ from ukgrantmaking.models.funder_utils import (
 )
 from ukgrantmaking.models.funder_year import FunderYear
 from ukgrantmaking.models.grant import InclusionStatus
+from ukgrantmaking.utils.recompute import defer_funder, transfer_to_successors
 
 
 class FunderTag(models.Model):
@@ -421,7 +422,6 @@ class Funder(models.Model):
     def update_funder_financial_year(self):
         self.current_year = self.get_latest_funder_financial_year()
         self.current_year.update_fields()
-        self.current_year.save()
 
         current_fy = FinancialYear.objects.current()
         if current_fy.status == FinancialYearStatus.OPEN:
@@ -434,22 +434,11 @@ class Funder(models.Model):
             self.current_year.tags.set(self.tags.all())
 
     def transfer_funder_financial_years_to_successor(self):
-        # transfer financial years to successor
-        if self.successor:
-            for funder_financial_year in self.funder_financial_years.all():
-                for funder_year in funder_financial_year.funder_years.all():
-                    funder_year.new_funder_financial_year, created = (
-                        FunderFinancialYear.objects.get_or_create(
-                            funder=self.successor,
-                            financial_year=funder_financial_year.financial_year,
-                            defaults={
-                                "segment": funder_financial_year.segment,
-                                "included": funder_financial_year.included,
-                                "makes_grants_to_individuals": funder_financial_year.makes_grants_to_individuals,
-                            },
-                        )
-                    )
-                    funder_year.save()
+        # transfer financial years to the final successor, along with the
+        # financial years of any predecessors
+        changed = transfer_to_successors([self.org_id])
+        if changed:
+            FunderFinancialYear.update_aggregates(changed)
 
     @property
     def grants_by_year(self):
@@ -542,6 +531,10 @@ class Funder(models.Model):
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
+        # inside `deferred_recompute` the rest is done once when the block exits
+        if defer_funder(self.org_id):
+            return
+
         # make sure the funder has last five funder financial years
         self.ensure_funder_financial_years()
 
@@ -551,10 +544,5 @@ class Funder(models.Model):
         # update the funder financial year with the latest values
         self.update_funder_financial_year()
 
-        # transfer financial years to successor
+        # transfer financial years to successor, and from predecessors
         self.transfer_funder_financial_years_to_successor()
-
-        # transfer financial years from predecessors
-        if self.predecessors.exists():
-            for predecessor in self.predecessors.all():
-                predecessor.save()
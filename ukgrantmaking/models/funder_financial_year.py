@@ -1,5 +1,7 @@
+from typing import Iterable
+
 from django.conf import settings
-from django.db import models
+from django.db import connection, models
 from django.db.models.functions import Coalesce
 
 from ukgrantmaking.models.funder_utils import (
@@ -8,6 +10,202 @@ from ukgrantmaking.models.funder_utils import (
     RecordStatus,
 )
 
+# fields totalled across all the funder years in a funder financial year
+AGGREGATE_SUMMED_FIELDS = [
+    "income",
+    "income_investment",
+    "spending",
+    "spending_investment",
+    "spending_charitable",
+    "spending_grant_making",
+    "spending_grant_making_individuals",
+    "spending_grant_making_institutions_charitable",
+    "spending_grant_making_institutions_noncharitable",
+    "spending_grant_making_institutions_unknown",
+    "spending_grant_making_institutions_main",
+    "spending_grant_making_institutions",
+]
+
+# fields taken from the latest funder year, with the totals falling back to
+# the sum of their parts
+AGGREGATE_LATEST_FIELDS = {
+    "total_net_assets": "COALESCE(total_net_assets, funds_calculated)",
+    "funds": "COALESCE(funds, funds_calculated)",
+    "funds_endowment": "funds_endowment",
+    "funds_restricted": "funds_restricted",
+    "funds_unrestricted": "funds_unrestricted",
+    "employees": "COALESCE(employees, employees_calculated)",
+    "employees_permanent": "employees_permanent",
+    "employees_fixedterm": "employees_fixedterm",
+    "employees_selfemployed": "employees_selfemployed",
+}
+
+AGGREGATE_FIELDS = AGGREGATE_SUMMED_FIELDS + list(AGGREGATE_LATEST_FIELDS)
+
+# Recalculate the aggregate values of the selected funder financial years
+# from their funder years. Funder financial years without any funder years
+# are set to null, and only rows where a value changes are updated.
+UPDATE_AGGREGATES_STATEMENT = """
+    WITH target AS (
+        SELECT id
+        FROM ukgrantmaking_funderfinancialyear
+        WHERE %(all_funder_financial_years)s
+            OR id = ANY(%(funder_financial_year_ids)s::bigint[])
+    ),
+    fy AS (
+        SELECT fyr.*,
+            CASE WHEN (
+                fyr.funds_endowment IS NOT NULL
+                OR fyr.funds_restricted IS NOT NULL
+                OR fyr.funds_unrestricted IS NOT NULL
+            ) THEN (
+                COALESCE(fyr.funds_endowment, 0)
+                + COALESCE(fyr.funds_restricted, 0)
+                + COALESCE(fyr.funds_unrestricted, 0)
+            ) END AS funds_calculated,
+            CASE WHEN (
+                fyr.employees_permanent IS NOT NULL
+                OR fyr.employees_fixedterm IS NOT NULL
+                OR fyr.employees_selfemployed IS NOT NULL
+            ) THEN (
+                COALESCE(fyr.employees_permanent, 0)
+                + COALESCE(fyr.employees_fixedterm, 0)
+                + COALESCE(fyr.employees_selfemployed, 0)
+            ) END AS employees_calculated
+        FROM ukgrantmaking_funderyear AS fyr
+            INNER JOIN target
+                ON fyr.funder_financial_year_id = target.id
+    ),
+    latest_fields AS (
+        SELECT DISTINCT ON (funder_financial_year_id)
+            funder_financial_year_id,
+            {latest_fields}
+        FROM fy
+        ORDER BY funder_financial_year_id, financial_year_end DESC
+    ),
+    summed_fields AS (
+        SELECT funder_financial_year_id,
+            {summed_fields}
+        FROM fy
+        GROUP BY funder_financial_year_id
+    ),
+    new_values AS (
+        SELECT target.id,
+            {new_values}
+        FROM target
+            LEFT OUTER JOIN summed_fields AS s
+                ON s.funder_financial_year_id = target.id
+            LEFT OUTER JOIN latest_fields AS l
+                ON l.funder_financial_year_id = target.id
+    )
+    UPDATE ukgrantmaking_funderfinancialyear AS ffy
+    SET {set_fields}
+    FROM new_values AS v
+    WHERE ffy.id = v.id
+        AND ({ffy_fields}) IS DISTINCT FROM ({v_fields})
+""".format(
+    latest_fields=",\n            ".join(
+        expression if expression == field else f"{expression} AS {field}"
+        for field, expression in AGGREGATE_LATEST_FIELDS.items()
+    ),
+    summed_fields=",\n            ".join(
+        f"SUM({field}) AS {field}" for field in AGGREGATE_SUMMED_FIELDS
+    ),
+    new_values=",\n            ".join(
+        [f"s.{field}" for field in AGGREGATE_SUMMED_FIELDS]
+        + [f"l.{field}" for field in AGGREGATE_LATEST_FIELDS]
+    ),
+    set_fields=",\n        ".join(f"{field} = v.{field}" for field in AGGREGATE_FIELDS),
+    ffy_fields=", ".join(f"ffy.{field}" for field in AGGREGATE_FIELDS),
+    v_fields=", ".join(f"v.{field}" for field in AGGREGATE_FIELDS),
+)
+
+UPDATE_AGGREGATES_QUERY = (
+    UPDATE_AGGREGATES_STATEMENT
+    + "    RETURNING ffy.id, "
+    + ", ".join(f"ffy.{field}" for field in AGGREGATE_FIELDS)
+)
+
+# Optional triggers that keep the aggregate values up to date when funder
+# years are written in bulk. Each statement recalculates the funder financial
+# years of the rows it touched. The triggers are created disabled, and are
+# turned on with `update funder-aggregates --enable-trigger`.
+AGGREGATE_TRIGGERS = {
+    "ukgrantmaking_funderyear_aggregates_insert": (
+        "INSERT",
+        "NEW TABLE AS new_rows",
+    ),
+    "ukgrantmaking_funderyear_aggregates_update": (
+        "UPDATE",
+        "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    ),
+    "ukgrantmaking_funderyear_aggregates_delete": (
+        "DELETE",
+        "OLD TABLE AS old_rows",
+    ),
+}
+
+CREATE_AGGREGATE_TRIGGERS_SQL = (
+    """
+    CREATE OR REPLACE FUNCTION ukgrantmaking_funderyear_update_aggregates()
+    RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        ffy_ids bigint[];
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM new_rows;
+        ELSIF TG_OP = 'DELETE' THEN
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM old_rows;
+        ELSE
+            SELECT array_agg(DISTINCT funder_financial_year_id) INTO ffy_ids
+            FROM (
+                SELECT funder_financial_year_id FROM new_rows
+                UNION
+                SELECT funder_financial_year_id FROM old_rows
+            ) AS changed;
+        END IF;
+        IF ffy_ids IS NOT NULL THEN
+            {update_statement};
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+""".format(
+        update_statement=UPDATE_AGGREGATES_STATEMENT.strip()
+        % {
+            "all_funder_financial_years": "FALSE",
+            "funder_financial_year_ids": "ffy_ids",
+        }
+    )
+    + "".join(
+        f"""
+    DROP TRIGGER IF EXISTS {name} ON ukgrantmaking_funderyear;
+    CREATE TRIGGER {name}
+        AFTER {event} ON ukgrantmaking_funderyear
+        REFERENCING {transition_tables}
+        FOR EACH STATEMENT
+        EXECUTE FUNCTION ukgrantmaking_funderyear_update_aggregates();
+    ALTER TABLE ukgrantmaking_funderyear DISABLE TRIGGER {name};
+"""
+        for name, (event, transition_tables) in AGGREGATE_TRIGGERS.items()
+    )
+)
+
+DROP_AGGREGATE_TRIGGERS_SQL = (
+    "".join(
+        f"""
+    DROP TRIGGER IF EXISTS {name} ON ukgrantmaking_funderyear;"""
+        for name in AGGREGATE_TRIGGERS
+    )
+    + """
+    DROP FUNCTION IF EXISTS ukgrantmaking_funderyear_update_aggregates();
+"""
+)
+
 
 class FunderFinancialYear(models.Model):
     funder = models.ForeignKey(
@@ -124,48 +322,27 @@ class FunderFinancialYear(models.Model):
     def __str__(self):
         return f"{self.funder.name} ({self.financial_year.fy})"
 
+    @classmethod
+    def update_aggregates(cls, ids: int | Iterable[int] | None = None) -> list[tuple]:
+        """
+        Recalculate the values of funder financial years from their funder
+        years, for one ID, a list of IDs, or every funder financial year if
+        `ids` is None.
+
+        Returns the ID and new values of the funder financial years that
+        changed.
+        """
+        if isinstance(ids, int):
+            ids = [ids]
+        params = {
+            "all_funder_financial_years": ids is None,
+            "funder_financial_year_ids": [] if ids is None else list(ids),
+        }
+        with connection.cursor() as cursor:
+            cursor.execute(UPDATE_AGGREGATES_QUERY, params)
+            return cursor.fetchall()
+
     def update_fields(self):
-        summed_fields = [
-            "income",
-            "income_investment",
-            "spending",
-            "spending_investment",
-            "spending_charitable",
-            "spending_grant_making",
-            "spending_grant_making_individuals",
-            "spending_grant_making_institutions_charitable",
-            "spending_grant_making_institutions_noncharitable",
-            "spending_grant_making_institutions_unknown",
-            "spending_grant_making_institutions_main",
-            "spending_grant_making_institutions",
-        ]
-        latest_fields = [
-            "total_net_assets",
-            "funds",
-            "funds_endowment",
-            "funds_restricted",
-            "funds_unrestricted",
-            "employees",
-            "employees_permanent",
-            "employees_fixedterm",
-            "employees_selfemployed",
-        ]
-        fys = list(
-            self.funder_years.order_by("-financial_year_end").values(
-                *(summed_fields + latest_fields)
-            )
-        )
-        if fys:
-            for field in summed_fields:
-                values = [fy[field] for fy in fys if fy[field] is not None]
-                if values:
-                    setattr(self, field, sum(values))
-                else:
-                    setattr(self, field, None)
-            for field in latest_fields:
-                setattr(self, field, fys[0][field])
-        else:
-            for field in summed_fields:
-                setattr(self, field, None)
-            for field in latest_fields:
-                setattr(self, field, None)
+        for _, *values in self.update_aggregates(self.pk):
+            for field, value in zip(AGGREGATE_FIELDS, values):
+                setattr(self, field, value)
@@ -6,6 +6,7 @@ from django.db.models.lookups import IsNull
 
 from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
 from ukgrantmaking.models.funder_utils import EditableField
+from ukgrantmaking.utils.recompute import defer_funder_financial_years
 
 
 class FunderYear(models.Model):
@@ -582,6 +583,13 @@ class FunderYear(models.Model):
     notes = GenericRelation("FunderNote")
     date_added = models.DateTimeField(auto_now_add=True, db_index=True)
     date_updated = models.DateTimeField(auto_now=True)
+    content_hash = models.CharField(
+        max_length=32,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+    )
 
     class Meta:
         ordering = ["funder_financial_year", "-financial_year_end"]
@@ -602,11 +610,13 @@ class FunderYear(models.Model):
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
+        if defer_funder_financial_years(
+            self.funder_financial_year_id, self.new_funder_financial_year_id
+        ):
+            return
         self.funder_financial_year.update_fields()
-        self.funder_financial_year.save()
         if self.new_funder_financial_year:
             self.new_funder_financial_year.update_fields()
-            self.new_funder_financial_year.save()
 
     @property
     def funds_calc(self):
@@ -1,8 +1,10 @@
 from django.contrib.contenttypes.fields import GenericRelation
-from django.db import models
+from django.db import connection, models
 from django.db.models.functions import Coalesce, Left, Length, Right, StrIndex
+from django.db.models.lookups import In
 
 from ukgrantmaking.models.financial_years import FinancialYear
+from ukgrantmaking.utils.recipient_type import RecipientTypeRule
 
 
 class RecipientType(models.TextChoices):
@@ -272,6 +274,104 @@ GOVERNMENT_EXCLUSIONS: list[tuple[InclusionStatus, list[RecipientType]]] = [
         [RecipientType.OVERSEAS_GOVERNMENT],
     ),
 ]
+GOVERNMENT_FUNDER_TYPES = [
+    FunderType.CENTRAL_GOVERNMENT,
+    FunderType.LOCAL_GOVERNMENT,
+    FunderType.DEVOLVED_GOVERNMENT,
+]
+
+
+def resolve_inclusion(
+    inclusion: str, funding_organisation_type: str | None, recipient_type: str | None
+) -> str:
+    """
+    Find the exclusion status of a grant. Unsure grants from government
+    funders are given the status for their recipient type in
+    `GOVERNMENT_EXCLUSIONS`, other grants keep their current status.
+    """
+    if (
+        inclusion != InclusionStatus.UNSURE
+        or funding_organisation_type not in GOVERNMENT_FUNDER_TYPES
+    ):
+        return inclusion
+    for exclusion_status, recipient_types in GOVERNMENT_EXCLUSIONS:
+        if recipient_type in recipient_types:
+            return exclusion_status
+    return inclusion
+
+
+def government_exclusion_case(recipient_type: models.Expression) -> models.Case:
+    """
+    A `CASE` expression giving the same status as `resolve_inclusion` for
+    grants with the given recipient type expression.
+    """
+    return models.Case(
+        *[
+            models.When(
+                In(recipient_type, recipient_types),
+                inclusion=InclusionStatus.UNSURE,
+                funding_organisation_type__in=GOVERNMENT_FUNDER_TYPES,
+                then=models.Value(exclusion_status),
+            )
+            for exclusion_status, recipient_types in GOVERNMENT_EXCLUSIONS
+        ],
+        default=models.F("inclusion"),
+    )
+
+
+# Rules for finding the type of a recipient organisation from its ID and name.
+# These are checked in order, and the first rule that matches is used.
+EDUCATION_ID_PREFIXES = ("GB-UKPRN-", "GB-EDU-")
+RECIPIENT_TYPE_RULES: list[RecipientTypeRule] = [
+    RecipientTypeRule(
+        RecipientType.CHARITY,
+        id_prefixes=("GB-CHC-", "GB-SC-", "GB-NIC-"),
+    ),
+    RecipientTypeRule(
+        RecipientType.LOCAL_AUTHORITY,
+        id_prefixes=("GB-LAE-", "GB-LAS-", "GB-PLA-", "GB-LANI-", "GB-UKLA-"),
+    ),
+    RecipientTypeRule(
+        RecipientType.COMMUNITY_INTEREST_COMPANY,
+        name_contains=("community interest company",),
+    ),
+    RecipientTypeRule(
+        RecipientType.COMMUNITY_INTEREST_COMPANY,
+        id_prefixes=("GB-CIC-",),
+        name_endswith=(" cic",),
+    ),
+    RecipientTypeRule(
+        RecipientType.LOCAL_AUTHORITY,
+        id_prefixes=EDUCATION_ID_PREFIXES,
+        name_contains=("council",),
+    ),
+    RecipientTypeRule(
+        RecipientType.NHS,
+        id_prefixes=EDUCATION_ID_PREFIXES,
+        name_contains=("nhs",),
+    ),
+    RecipientTypeRule(
+        RecipientType.UNIVERSITY,
+        name_contains=("university",),
+        name_excludes=("third age",),
+    ),
+    RecipientTypeRule(
+        RecipientType.NHS,
+        id_prefixes=("GB-NHS-",),
+    ),
+    RecipientTypeRule(
+        RecipientType.EDUCATION,
+        id_prefixes=EDUCATION_ID_PREFIXES + ("GB-SCOTEDU-", "GB-WALEDU-", "GB-NIEDU-"),
+    ),
+    RecipientTypeRule(
+        RecipientType.SPORTS_CLUB,
+        id_prefixes=("GB-CASC-",),
+    ),
+    RecipientTypeRule(
+        RecipientType.LOCAL_AUTHORITY,
+        name_regex="(town|parish|community|county|district) Council",
+    ),
+]
 
 
 class Grant(models.Model):
@@ -414,6 +514,13 @@ class Grant(models.Model):
         blank=True,
         db_constraint=False,
     )
+    content_hash = models.CharField(
+        max_length=32,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+    )
 
     annual_amount = models.GeneratedField(
         expression=models.Case(
@@ -447,25 +554,81 @@ class Grant(models.Model):
             self.award_date.year if self.award_date else "unknown",
         )
 
+    def resolve_inclusion(self) -> bool:
+        """
+        Work out the generated recipient type and the exclusion status of the
+        grant before it is saved, so that `save` doesn't need to read them
+        back from the database. Returns True if the exclusion status changed.
+        """
+        if self.recipient_type_manual is not None:
+            self.recipient_type = self.recipient_type_manual
+        else:
+            self.recipient_type = self.recipient_type_registered
+        inclusion = resolve_inclusion(
+            self.inclusion, self.funding_organisation_type, self.recipient_type
+        )
+        if inclusion == self.inclusion:
+            return False
+        self.inclusion = inclusion
+        return True
+
+    @classmethod
+    def from_db(cls, db, field_names, values, **kwargs):
+        # kwargs passes through `fetch_mode` on Django versions that have it
+        instance = super().from_db(db, field_names, values, **kwargs)
+        # keep the funder and dates the grant was loaded with, so that if they
+        # change the funder years it used to count towards are marked too
+        loaded = dict(zip(field_names, values))
+        instance._loaded_funder_year = (
+            loaded.get("funder_id") or loaded.get("funding_organisation_id"),
+            loaded.get("award_date"),
+            loaded.get("financial_year_id"),
+        )
+        return instance
+
+    def funder_year(self) -> tuple:
+        """
+        The funder, award date and financial year used to find the funder
+        years this grant counts towards, for `DirtyFunderYear.objects.mark`.
+        """
+        if self.award_date_manual is not None:
+            award_date = self.award_date_manual
+        else:
+            award_date = self.award_date_registered
+        return (
+            self.funder_id or self.funding_organisation_id,
+            award_date,
+            self.financial_year_id,
+        )
+
     def save(self, *args, **kwargs):
+        if self.resolve_inclusion() and kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "inclusion"}
         super().save(*args, **kwargs)
-        self.refresh_from_db(
-            fields=["inclusion", "funding_organisation_type", "recipient_type"]
+        funder_year = self.funder_year()
+        DirtyFunderYear.objects.mark(
+            [funder_year, getattr(self, "_loaded_funder_year", None)]
         )
-        if (
-            self.inclusion == self.InclusionStatus.UNSURE
-            and self.funding_organisation_type
-            in [
-                FunderType.CENTRAL_GOVERNMENT,
-                FunderType.LOCAL_GOVERNMENT,
-                FunderType.DEVOLVED_GOVERNMENT,
-            ]
-        ):
-            for exclusion_status, recipient_types in GOVERNMENT_EXCLUSIONS:
-                if self.recipient_type in recipient_types:
-                    self.inclusion = exclusion_status
-                    super().save(update_fields=["inclusion"])
-                    break
+        self._loaded_funder_year = funder_year
+
+    @classmethod
+    def bulk_save(cls, grants: list["Grant"], fields: list[str]) -> None:
+        """
+        Save changes to `fields` for a list of existing grants, with the same
+        outcome as calling `save` on each of them but in a fixed number of
+        statements.
+        """
+        if not grants:
+            return
+        for grant in grants:
+            grant.resolve_inclusion()
+        cls.objects.bulk_update(grants, {*fields, "inclusion"})
+        funder_years = []
+        for grant in grants:
+            funder_years.append(getattr(grant, "_loaded_funder_year", None))
+            grant._loaded_funder_year = grant.funder_year()
+            funder_years.append(grant._loaded_funder_year)
+        DirtyFunderYear.objects.mark(funder_years)
 
 
 class CurrencyConverter(models.Model):
@@ -481,6 +644,183 @@ class CurrencyConverter(models.Model):
         ordering = ["currency", "-date"]
 
 
+class GrantSourceFile(models.Model):
+    """
+    A source file in the 360Giving Datastore that grants have been fetched from.
+
+    `modified` records the modified date of the file when its grants were last
+    fetched, so that unchanged files can be skipped on the next run.
+    """
+
+    file_name = models.CharField(max_length=255)
+    financial_year = models.ForeignKey(
+        FinancialYear,
+        on_delete=models.CASCADE,
+        related_name="source_files",
+        db_constraint=False,
+    )
+    modified = models.DateTimeField(null=True, blank=True)
+    grant_count = models.IntegerField(default=0)
+    last_fetched = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.file_name
+
+    class Meta:
+        unique_together = [["file_name", "financial_year"]]
+        ordering = ["financial_year", "file_name"]
+
+
+# Mark the funder years that could include the grants in `{changed}`, which
+# has `funder_id`, `award_date` and `financial_year_id` columns. A funder year
+# belongs to the financial year whose funders date range contains its end,
+# and covers the year before that (or from its own start date), so a grant is
+# marked in:
+#  - its own financial year, where a funder year is created if it's missing
+#  - every financial year whose funders date range overlaps the year from the
+#    award date
+#  - the financial year of any existing funder year that covers the award date
+MARK_DIRTY_FUNDER_YEARS_SQL = """
+    INSERT INTO ukgrantmaking_dirtyfunderyear (funder_id, financial_year_id, marked)
+    SELECT DISTINCT c.funder_id, fy.fy, now()
+    FROM {changed} AS c
+        INNER JOIN ukgrantmaking_financialyear AS fy
+            ON fy.fy = c.financial_year_id
+            OR (
+                fy.funders_start_date <= c.award_date + 365
+                AND fy.funders_end_date >= c.award_date
+            )
+            OR EXISTS (
+                SELECT 1
+                FROM ukgrantmaking_funderyear AS fyr
+                    INNER JOIN ukgrantmaking_funderfinancialyear AS ffy
+                        ON fyr.funder_financial_year_id = ffy.id
+                WHERE ffy.funder_id = c.funder_id
+                    AND ffy.financial_year_id = fy.fy
+                    AND c.award_date >= COALESCE(
+                        fyr.financial_year_start,
+                        fyr.financial_year_end - 365
+                    )
+                    AND c.award_date <= fyr.financial_year_end
+            )
+    WHERE c.funder_id IS NOT NULL
+    ON CONFLICT (funder_id, financial_year_id) DO NOTHING
+"""
+
+
+class DirtyFunderYearManager(models.Manager):
+    def mark(self, funder_years) -> None:
+        """
+        Mark the funder years that could include grants as needing their
+        grant totals recalculated. Takes the funder ID, award date and
+        financial year of each grant (see `Grant.funder_year`); rows that are
+        None or have no funder are ignored.
+        """
+        funder_years = {
+            funder_year
+            for funder_year in funder_years
+            if funder_year is not None and funder_year[0]
+        }
+        if not funder_years:
+            return
+        funder_ids, award_dates, financial_year_ids = zip(*funder_years)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                MARK_DIRTY_FUNDER_YEARS_SQL.format(
+                    changed="""(
+                        SELECT *
+                        FROM unnest(
+                            %(funder_ids)s::text[],
+                            %(award_dates)s::date[],
+                            %(financial_year_ids)s::text[]
+                        ) AS changed (funder_id, award_date, financial_year_id)
+                    )"""
+                ),
+                {
+                    "funder_ids": list(funder_ids),
+                    "award_dates": list(award_dates),
+                    "financial_year_ids": list(financial_year_ids),
+                },
+            )
+
+    def mark_grants(self, grants: models.QuerySet, award_date=None) -> None:
+        """
+        Mark the funder years of a queryset of grants. Grants that haven't
+        been matched to a funder yet use the funding organisation ID, which is
+        what they'll be matched on. If the grants are about to be moved to a
+        new `award_date`, the funder years for that date are marked as well.
+        """
+        funder_years = set(
+            grants.annotate(
+                dirty_funder_id=Coalesce("funder_id", "funding_organisation_id")
+            )
+            .values_list("dirty_funder_id", "award_date", "financial_year_id")
+            .distinct()
+            .order_by()
+        )
+        if award_date is not None:
+            funder_years |= {
+                (funder_id, award_date, financial_year_id)
+                for funder_id, _, financial_year_id in funder_years
+            }
+        self.mark(funder_years)
+
+
+class DirtyFunderYear(models.Model):
+    """
+    A funder and financial year with grants that have changed since the
+    funder year grant totals were last calculated.
+
+    These are recorded when grants are fetched or edited, and `update grants`
+    recalculates just these funders and years before clearing them.
+    """
+
+    funder = models.ForeignKey(
+        "Funder",
+        on_delete=models.DO_NOTHING,
+        related_name="+",
+        db_constraint=False,
+    )
+    financial_year = models.ForeignKey(
+        FinancialYear,
+        on_delete=models.CASCADE,
+        related_name="+",
+        db_constraint=False,
+    )
+    marked = models.DateTimeField(auto_now_add=True)
+
+    objects = DirtyFunderYearManager()
+
+    def __str__(self):
+        return f"{self.funder_id} {self.financial_year_id}"
+
+    class Meta:
+        unique_together = [["funder", "financial_year"]]
+
+
+class CompanyCategory(models.Model):
+    """
+    A local copy of the Companies House category and Find that Charity
+    organisation type of a company, used to find the type of recipients with
+    a company number.
+
+    `refreshed` records when the company was last looked up, so that only new
+    or stale companies need to be fetched from Find that Charity. Companies
+    that weren't found are stored with empty values.
+    """
+
+    company_id = models.CharField(max_length=255, primary_key=True)
+    company_category = models.CharField(max_length=255, null=True, blank=True)
+    ftc_organisation_type = models.CharField(max_length=255, null=True, blank=True)
+    refreshed = models.DateTimeField()
+
+    def __str__(self):
+        return self.company_id
+
+    class Meta:
+        verbose_name_plural = "company categories"
+
+
 class GrantRecipient(models.Model):
     class RecipientScale(models.TextChoices):
         LOCAL = "Local", "Local"
@@ -722,27 +1062,44 @@ class GrantRecipient(models.Model):
         output_field=models.CharField(max_length=255),
         db_persist=True,
     )
+    content_hash = models.CharField(
+        max_length=32,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+    )
 
     def __str__(self):
         return self.name
 
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
-        self.grants.filter(recipient_type_manual__isnull=True).update(
-            recipient_type_manual=self.type_manual
+
+        # set the type of grants without their own type, and apply the
+        # government exclusions using the new type, in a single update
+        recipient_type = Coalesce(
+            "recipient_type_manual",
+            models.Value(self.type_manual, output_field=models.CharField()),
         )
-        for inclusion, filter in GOVERNMENT_EXCLUSIONS:
-            self.grants.filter(
+        excluded_types = [
+            excluded_type
+            for _, recipient_types in GOVERNMENT_EXCLUSIONS
+            for excluded_type in recipient_types
+        ]
+        grants = self.grants.filter(
+            models.Q(recipient_type_manual__isnull=True)
+            | models.Q(
                 inclusion=Grant.InclusionStatus.UNSURE,
-                funding_organisation_type__in=[
-                    Grant.FunderType.CENTRAL_GOVERNMENT,
-                    Grant.FunderType.LOCAL_GOVERNMENT,
-                    Grant.FunderType.DEVOLVED_GOVERNMENT,
-                ],
-                recipient_type_manual__in=filter,
-            ).update(
-                inclusion=inclusion,
+                funding_organisation_type__in=GOVERNMENT_FUNDER_TYPES,
+                recipient_type_manual__in=excluded_types,
             )
+        )
+        DirtyFunderYear.objects.mark_grants(grants)
+        grants.update(
+            recipient_type_manual=recipient_type,
+            inclusion=government_exclusion_case(recipient_type),
+        )
 
 
 class GrantRecipientYear(models.Model):
@@ -789,6 +1146,13 @@ class GrantRecipientYear(models.Model):
         output_field=models.BigIntegerField(),
         db_persist=True,
     )
+    content_hash = models.CharField(
+        max_length=32,
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="Hash of the registered fields, used to skip unchanged records when loading data",
+    )
 
     def __str__(self):
         return f"{self.recipient}:  {self.financial_year_end}"
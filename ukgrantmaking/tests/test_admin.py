@@ -1,7 +1,13 @@
 # test whether the admin pages for all the models in the ukgrantmaking app are working
+import datetime
+
 import pytest
+from django.contrib.admin.models import LogEntry
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.urls import reverse
 
+from ukgrantmaking.models.grant import DirtyFunderYear, Grant
+
 
 @pytest.mark.parametrize(
     "model",
@@ -80,3 +86,96 @@ def test_admin_fundersview_page(client_logged_in, funder_with_py):
     response = client_logged_in.get(url)
     assert response.status_code == 200
     assert funder.name_registered in response.content.decode()
+
+
+def test_admin_grant_changelist_save(
+    client_logged_in, funder, financial_year, django_assert_max_num_queries, mocker
+):
+    grants = Grant.objects.bulk_create(
+        [
+            Grant(
+                grant_id=f"360G-test-{n}",
+                title=f"Grant {n}",
+                amount_awarded=100,
+                award_date_registered=datetime.date(2022, 6, 1),
+                funder=funder,
+                funding_organisation_type=Grant.FunderType.CENTRAL_GOVERNMENT,
+                financial_year=financial_year,
+            )
+            for n in range(50)
+        ]
+    )
+    data = {
+        "form-TOTAL_FORMS": len(grants),
+        "form-INITIAL_FORMS": len(grants),
+        "_save": "Save",
+    }
+    for i, grant in enumerate(grants):
+        data[f"form-{i}-grant_id"] = grant.grant_id
+        data[f"form-{i}-inclusion"] = grant.inclusion
+        data[f"form-{i}-recipient_type_manual"] = (
+            Grant.RecipientType.NHS if i % 2 else ""
+        )
+        data[f"form-{i}-lottery_grant_type"] = ""
+
+    bulk_save = mocker.spy(Grant, "bulk_save")
+    save = mocker.spy(Grant, "save")
+
+    # the number of queries doesn't depend on the number of grants edited
+    url = reverse("admin:ukgrantmaking_grant_changelist")
+    with django_assert_max_num_queries(30):
+        response = client_logged_in.post(url, data)
+    assert response.status_code == 302
+
+    # the edited grants are saved together rather than one at a time
+    bulk_save.assert_called_once()
+    assert len(bulk_save.call_args.args[0]) == len(grants) // 2
+    save.assert_not_called()
+
+    assert (
+        Grant.objects.filter(
+            inclusion=Grant.InclusionStatus.GOVERNMENT_TRANSFER,
+            recipient_type=Grant.RecipientType.NHS,
+        ).count()
+        == len(grants) // 2
+    )
+    assert Grant.objects.filter(inclusion=Grant.InclusionStatus.UNSURE).count() == (
+        len(grants) // 2
+    )
+    assert LogEntry.objects.count() == len(grants) // 2
+    assert DirtyFunderYear.objects.filter(
+        funder=funder, financial_year=financial_year
+    ).exists()
+
+
+def test_admin_grant_upload_marks_funder_years(
+    client_logged_in, funder, make_funder, financial_year
+):
+    other_funder = make_funder(2)
+    Grant.objects.create(
+        grant_id="360G-test-1",
+        title="Grant 1",
+        amount_awarded=100,
+        award_date_registered=datetime.date(2022, 6, 1),
+        funder=funder,
+        financial_year=financial_year,
+    )
+    DirtyFunderYear.objects.all().delete()
+
+    url = reverse("admin:ukgrantmaking_grant_upload")
+    file = SimpleUploadedFile(
+        "grants.csv",
+        f"grant_id,funder_id\n360G-test-1,{other_funder.org_id}\n".encode(),
+        content_type="text/csv",
+    )
+    response = client_logged_in.post(
+        url, {"file": file, "handle_blanks": "skip", "add_new_rows": "false"}
+    )
+    assert response.status_code == 302
+
+    assert Grant.objects.get(grant_id="360G-test-1").funder_id == other_funder.org_id
+    # the funder years the grant moved from and to are both recalculated
+    assert {
+        (funder.org_id, financial_year.fy),
+        (other_funder.org_id, financial_year.fy),
+    } <= set(DirtyFunderYear.objects.values_list("funder_id", "financial_year_id"))
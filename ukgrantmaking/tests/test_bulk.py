@@ -0,0 +1,205 @@
+import datetime
+from collections import Counter
+
+import pandas as pd
+import pytest
+
+from ukgrantmaking.models.funder import Funder
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.models.grant import Grant
+from ukgrantmaking.utils.bulk import UpsertKey, bulk_upsert, do_copy_update
+
+
+def make_grant(grant_id: str, title: str, amount: float, financial_year) -> dict:
+    return dict(
+        grant_id=grant_id,
+        title=title,
+        description="Line one\nLine two\twith a tab and a \\ backslash",
+        amount_awarded=amount,
+        award_date_registered=datetime.date(2022, 6, 1),
+        funding_organisation_id="GB-CHC-00000001",
+        recipient_organisation_name=None,
+        financial_year_id=financial_year.fy,
+    )
+
+
+@pytest.mark.django_db
+def test_do_copy_update(financial_year):
+    do_copy_update(
+        Grant,
+        (
+            make_grant(f"360G-test-{n}", f"Grant {n}", n * 100, financial_year)
+            for n in range(1, 4)
+        ),
+        unique_fields=["grant_id"],
+        update_fields=["title", "amount_awarded"],
+        batch_size=2,
+    )
+    assert Grant.objects.count() == 3
+
+    grant = Grant.objects.get(grant_id="360G-test-1")
+    assert grant.title == "Grant 1"
+    assert grant.amount_awarded == 100
+    assert grant.description == "Line one\nLine two\twith a tab and a \\ backslash"
+    assert grant.recipient_organisation_name is None
+    # default values are used for fields that aren't given
+    assert grant.currency == "GBP"
+    assert grant.inclusion == Grant.InclusionStatus.UNSURE
+
+    grant.inclusion = Grant.InclusionStatus.INCLUDED
+    grant.save()
+
+    do_copy_update(
+        Grant,
+        [make_grant("360G-test-1", "Updated grant", 150, financial_year)],
+        unique_fields=["grant_id"],
+        update_fields=["title", "amount_awarded"],
+    )
+    assert Grant.objects.count() == 3
+
+    grant.refresh_from_db()
+    assert grant.title == "Updated grant"
+    assert grant.amount_awarded == 150
+    # fields that aren't in update_fields are not changed
+    assert grant.inclusion == Grant.InclusionStatus.INCLUDED
+
+
+@pytest.mark.django_db
+def test_do_copy_update_content_hash(financial_year):
+    update_fields = ["title", "amount_awarded"]
+
+    counts = do_copy_update(
+        Grant,
+        (
+            make_grant(f"360G-test-{n}", f"Grant {n}", n * 100, financial_year)
+            for n in range(1, 4)
+        ),
+        unique_fields=["grant_id"],
+        update_fields=update_fields,
+        hash_field="content_hash",
+    )
+    assert counts == Counter(inserted=3)
+    assert Grant.objects.filter(content_hash__isnull=True).count() == 0
+
+    counts = do_copy_update(
+        Grant,
+        [
+            make_grant("360G-test-1", "Updated grant", 100, financial_year),
+            make_grant("360G-test-2", "Grant 2", 200, financial_year),
+            make_grant("360G-test-3", "Grant 3", 300, financial_year),
+            make_grant("360G-test-4", "Grant 4", 400, financial_year),
+        ],
+        unique_fields=["grant_id"],
+        update_fields=update_fields,
+        hash_field="content_hash",
+    )
+    assert counts == Counter(inserted=1, changed=1, unchanged=2)
+    assert Grant.objects.get(grant_id="360G-test-1").title == "Updated grant"
+
+
+FUNDER_YEAR_KEYS = [
+    UpsertKey("org_id", "funder_financial_year__funder_id"),
+    UpsertKey(
+        "fyend",
+        "financial_year_end",
+        fallbacks=(lambda d: (d.year, d.month), lambda d: d.year),
+    ),
+]
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_fallbacks(funder, financial_year):
+    funder_year = FunderYear.objects.get(funder_financial_year__funder=funder)
+    funder_year.total_net_assets_manual = 500
+    funder_year.save()
+    year_end = funder_year.financial_year_end
+
+    df = pd.DataFrame(
+        [
+            # exact match
+            (funder.org_id, year_end, 100, 1000),
+            # same month
+            (funder.org_id, year_end.replace(day=1), 200, None),
+            # same year
+            (funder.org_id, year_end.replace(month=1, day=1), 300, None),
+            # different year
+            (funder.org_id, year_end.replace(year=year_end.year - 5), 400, None),
+            # unknown funder
+            ("GB-CHC-99999999", year_end, 500, None),
+        ],
+        columns=["org_id", "fyend", "giving", "assets"],
+    )
+    counts, pks = bulk_upsert(
+        FunderYear.objects.all(),
+        df,
+        keys=FUNDER_YEAR_KEYS,
+        fields={
+            "giving": "spending_grant_making_institutions_main_manual",
+            "assets": "total_net_assets_manual",
+        },
+        overwrite=False,
+    )
+    assert counts == Counter(matched=3, created=0, skipped=2)
+    assert pks.tolist() == [funder_year.pk] * 3 + [None, None]
+
+    funder_year.refresh_from_db()
+    # only empty fields are filled in
+    assert funder_year.spending_grant_making_institutions_main_manual == 100
+    assert funder_year.total_net_assets_manual == 500
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_create(funder):
+    df = pd.DataFrame(
+        [
+            (funder.org_id, "Updated name"),
+            ("GB-CHC-99999999", "New funder"),
+            ("GB-CHC-99999999", None),
+        ],
+        columns=["org_id", "name"],
+    )
+    counts, pks = bulk_upsert(
+        Funder.objects.all(),
+        df,
+        keys=[UpsertKey("org_id", "org_id")],
+        fields={"name": "name_manual"},
+        create=lambda row: Funder(org_id=row["org_id"], name_registered=row["name"]),
+    )
+    assert counts == Counter(matched=2, created=1, skipped=0)
+    assert pks.tolist() == [funder.org_id, "GB-CHC-99999999", "GB-CHC-99999999"]
+    assert Funder.objects.get(org_id=funder.org_id).name_manual == "Updated name"
+    new_funder = Funder.objects.get(org_id="GB-CHC-99999999")
+    assert new_funder.name_registered == "New funder"
+    assert new_funder.name_manual == "New funder"
+
+
+@pytest.mark.django_db
+def test_bulk_upsert_ambiguous_fallback(funder, financial_year):
+    funder_year = FunderYear.objects.get(funder_financial_year__funder=funder)
+    year_end = funder_year.financial_year_end
+    assert year_end.month not in (1, 6)
+    # a second year ending in the same calendar year, in a different month
+    other_year = funder_year.funder_financial_year.funder_years.create(
+        financial_year_end=year_end.replace(month=1, day=31),
+    )
+
+    df = pd.DataFrame(
+        [
+            # same month as one of the years
+            (funder.org_id, year_end.replace(day=1), 100),
+            # same year as both of them
+            (funder.org_id, year_end.replace(month=6, day=30), 200),
+        ],
+        columns=["org_id", "fyend", "giving"],
+    )
+    counts, pks = bulk_upsert(
+        FunderYear.objects.all(),
+        df,
+        keys=FUNDER_YEAR_KEYS,
+        fields={"giving": "spending_grant_making_institutions_main_manual"},
+    )
+    # the row that could be either year is skipped rather than guessed
+    assert counts == Counter(matched=1, created=0, skipped=1)
+    assert pks.tolist() == [funder_year.pk, None]
+    other_year.refresh_from_db()
+    assert other_year.spending_grant_making_institutions_main_manual is None
@@ -0,0 +1,51 @@
+import pandas as pd
+import pytest
+
+from ukgrantmaking.utils.db import (
+    dispose_engines,
+    engine_timings,
+    get_engine,
+    get_external_engine,
+    stream_connection,
+)
+
+
+@pytest.fixture
+def db_con(tmp_path):
+    yield f"sqlite:///{tmp_path / 'external.db'}"
+    dispose_engines()
+
+
+def test_get_engine_is_shared(db_con):
+    engine = get_engine(db_con)
+    assert get_engine(db_con) is engine
+
+    for _ in range(3):
+        with engine.connect() as conn:
+            assert pd.read_sql("SELECT 1 AS a", con=conn)["a"].tolist() == [1]
+
+    # the connection is reused from the pool
+    timings = engine_timings(db_con)
+    assert timings["connections"] == 1
+    assert timings["queries"] >= 3
+
+
+def test_stream_connection(db_con):
+    with stream_connection(db_con, chunk_size=2) as conn:
+        chunks = list(
+            pd.read_sql(
+                "SELECT 1 AS a UNION SELECT 2 UNION SELECT 3",
+                con=conn,
+                chunksize=2,
+            )
+        )
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+
+
+def test_get_external_engine(db_con, monkeypatch):
+    monkeypatch.setenv("FTC_DB_URL", db_con)
+    assert get_external_engine("ftc") is get_engine(db_con)
+
+    monkeypatch.delenv("TSG_DATASTORE_URL", raising=False)
+    with pytest.raises(ValueError):
+        get_external_engine("datastore")
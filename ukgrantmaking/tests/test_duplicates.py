@@ -0,0 +1,97 @@
+import datetime
+
+import pandas as pd
+
+from ukgrantmaking.utils.duplicates import DuplicateMatcher
+
+
+def make_grants(records: list[dict]) -> pd.DataFrame:
+    return pd.DataFrame.from_records(
+        records,
+        columns=[
+            "grant_id",
+            "title",
+            "amount_awarded",
+            "award_date_registered",
+            "recipient_organization_name",
+            "funding_organization_id",
+        ],
+    ).set_index("grant_id")
+
+
+def test_duplicate_matcher():
+    matcher = DuplicateMatcher()
+    # add grants in two chunks, as they would be from the datastore
+    matcher.add(
+        make_grants(
+            [
+                (
+                    "360G-tnlcomfund-1",
+                    "Project",
+                    "100",
+                    datetime.date(2024, 5, 1),
+                    "Org A",
+                    "GB-1",
+                ),
+                (
+                    "360G-other-2",
+                    "Big Project ",
+                    "250.0",
+                    "2024-06-01",
+                    "Org B",
+                    "GB-2",
+                ),
+            ]
+        )
+    )
+    matcher.add(
+        make_grants(
+            [
+                ("360G-other-3", "Other", "10", "2024-07-01", "Org C", "GB-3"),
+            ]
+        )
+    )
+
+    nl = make_grants(
+        [
+            # same ID in a different format
+            (
+                "DCMS-tnlcomfund-1",
+                "Different",
+                1,
+                pd.Timestamp("2024-05-01"),
+                "Org A",
+                "GB-1",
+            ),
+            # same details with different case and whitespace
+            (
+                "DCMS-other-2",
+                "big project",
+                250,
+                pd.Timestamp("2024-06-01"),
+                " org b",
+                "GB-2",
+            ),
+            # different amount
+            ("DCMS-other-3", "Other", 11, pd.Timestamp("2024-07-01"), "Org C", "GB-3"),
+        ]
+    )
+    duplicates = matcher.match(nl)
+
+    assert duplicates.to_dict("index") == {
+        "DCMS-tnlcomfund-1": {
+            "duplicate_of": "360G-tnlcomfund-1",
+            "rule": "Grant ID",
+        },
+        "DCMS-other-2": {
+            "duplicate_of": "360G-other-2",
+            "rule": "Title, amount, award date, recipient and funder",
+        },
+    }
+
+
+def test_duplicate_matcher_empty():
+    nl = make_grants(
+        [("DCMS-other-3", "Other", 11, pd.Timestamp("2024-07-01"), "Org C", "GB-3")]
+    )
+    assert len(DuplicateMatcher().match(nl)) == 0
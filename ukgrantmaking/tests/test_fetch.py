@@ -0,0 +1,50 @@
+import pytest
+
+from ukgrantmaking.utils.fetch import fetch_file
+
+URL = "https://example.com/grants.csv"
+
+
+def test_fetch_file(tmp_path, requests_mock):
+    requests_mock.get(
+        URL,
+        text="a,b\n1,2\n",
+        headers={"ETag": '"abc"', "Last-Modified": "Wed, 01 Jan 2025 00:00:00 GMT"},
+    )
+    path = fetch_file(URL, suffix=".csv", cache_dir=tmp_path)
+    assert path.parent == tmp_path
+    assert path.suffix == ".csv"
+    assert path.read_text() == "a,b\n1,2\n"
+
+    # the server says the file hasn't changed, so the cached copy is used
+    requests_mock.get(URL, status_code=304)
+    assert fetch_file(URL, suffix=".csv", cache_dir=tmp_path) == path
+    assert requests_mock.last_request.headers["If-None-Match"] == '"abc"'
+    assert (
+        requests_mock.last_request.headers["If-Modified-Since"]
+        == "Wed, 01 Jan 2025 00:00:00 GMT"
+    )
+    assert path.read_text() == "a,b\n1,2\n"
+
+    # the file has changed
+    requests_mock.get(URL, text="a,b\n3,4\n")
+    assert fetch_file(URL, suffix=".csv", cache_dir=tmp_path) == path
+    assert path.read_text() == "a,b\n3,4\n"
+
+
+def test_fetch_file_offline(tmp_path, requests_mock):
+    with pytest.raises(FileNotFoundError):
+        fetch_file(URL, offline=True, cache_dir=tmp_path)
+
+    requests_mock.get(URL, text="a,b\n1,2\n")
+    path = fetch_file(URL, cache_dir=tmp_path)
+
+    requests_mock.get(URL, status_code=500)
+    assert fetch_file(URL, offline=True, cache_dir=tmp_path) == path
+    assert path.read_text() == "a,b\n1,2\n"
+
+
+def test_fetch_file_local(tmp_path):
+    local_file = tmp_path / "grants.csv"
+    local_file.write_text("a,b\n1,2\n")
+    assert fetch_file(str(local_file), offline=True) == local_file
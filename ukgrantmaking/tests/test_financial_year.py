@@ -0,0 +1,41 @@
+import datetime
+
+import pandas as pd
+
+from ukgrantmaking.utils.financial_year import financial_year_lookup
+
+
+def test_financial_year_lookup():
+    financial_years = pd.DataFrame(
+        {
+            "fy": ["2023-24", "2024-25"],
+            "funders_start_date": [
+                datetime.date(2023, 5, 1),
+                datetime.date(2024, 5, 1),
+            ],
+            "funders_end_date": [
+                datetime.date(2024, 4, 30),
+                datetime.date(2025, 4, 30),
+            ],
+        }
+    )
+    dates = pd.Series(
+        [
+            datetime.date(2023, 5, 1),
+            datetime.date(2024, 4, 30),
+            datetime.date(2024, 5, 1),
+            None,
+            datetime.date(2020, 1, 1),
+        ],
+        index=["a", "b", "c", "d", "e"],
+    )
+    result = financial_year_lookup(
+        dates, date_type="funders", financial_years=financial_years
+    )
+    assert result.to_dict() == {
+        "a": "2023-24",
+        "b": "2023-24",
+        "c": "2024-25",
+        "d": None,
+        "e": None,
+    }
@@ -0,0 +1,129 @@
+import datetime
+import time
+
+import pandas as pd
+import pytest
+
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.ftc import (
+    FTC_SMALL_ID_THRESHOLD,
+    ftc_query_params,
+    read_ftc_chunks,
+)
+
+FTC_ORGANISATION = {
+    "name": "TEST FUNDER FROM FTC",
+    "dateRegistered": datetime.date(2000, 1, 1),
+    "dateRemoved": None,
+    "active": True,
+    "how": ["Makes Grants To Organisations"],
+    "what": ["General Charitable Purposes"],
+    "who": ["Other Charities Or Voluntary Bodies"],
+    "postcode": "SW1A 1AA",
+    "la_hq": "E09000033",
+    "la_hq_name": "Westminster",
+    "la_aoo": ["E09000033"],
+    "la_aoo_name": {"E09000033": "Westminster"},
+    "rgn_hq": "E12000007",
+    "rgn_hq_name": "London",
+    "rgn_aoo": ["E12000007"],
+    "rgn_aoo_name": {"E12000007": "London"},
+    "ctry_hq": "E92000001",
+    "ctry_hq_name": "England",
+    "ctry_aoo": ["E92000001"],
+    "ctry_aoo_name": {"E92000001": "England"},
+    "overseas_aoo": None,
+    "overseas_aoo_name": None,
+    "london_hq": True,
+    "london_aoo": True,
+    "scale_registered": "Local",
+}
+
+FTC_FINANCE = {
+    "financial_year_end": datetime.date(2023, 3, 31),
+    "financial_year_start": datetime.date(2022, 4, 1),
+    "income": 1000,
+    "income_investment": 100,
+    "spending": 900,
+    "spending_investment": 0,
+    "spending_charitable": 800,
+    "spending_grant_making_institutions_main": 500,
+    "total_net_assets": 10000,
+    "funds": 10000,
+    "funds_endowment": 5000,
+    "funds_restricted": 1000,
+    "funds_unrestricted": 4000,
+    "employees": 2,
+}
+
+
+def fake_read_sql(query, con, params):
+    record = FTC_FINANCE if "charity_charityfinancial" in query else FTC_ORGANISATION
+    return pd.DataFrame([{"org_id": org_id, **record} for org_id in params["org_ids"]])
+
+
+def test_ftc_query_params():
+    assert ftc_query_params(["GB-CHC-1234567", "GB-COH-12345678", "GB-CHC-X1"]) == {
+        "org_ids": ["GB-CHC-1234567", "GB-COH-12345678", "GB-CHC-X1"],
+        "charity_numbers": [1234567],
+    }
+
+
+def test_read_ftc_chunks_small(mocker):
+    read_sql = mocker.patch("pandas.read_sql", side_effect=fake_read_sql)
+    mocker.patch("ukgrantmaking.utils.ftc.get_engine")
+    executor = mocker.patch("ukgrantmaking.utils.ftc.ThreadPoolExecutor")
+
+    chunks = list(read_ftc_chunks("postgresql://ftc", "SELECT", ["GB-CHC-1234567"]))
+
+    # a single query, without any worker threads
+    assert len(chunks) == 1
+    assert chunks[0]["org_id"].tolist() == ["GB-CHC-1234567"]
+    read_sql.assert_called_once()
+    executor.assert_not_called()
+
+
+def test_read_ftc_chunks_large(mocker):
+    read_sql = mocker.patch("pandas.read_sql", side_effect=fake_read_sql)
+    mocker.patch("ukgrantmaking.utils.ftc.get_engine")
+    org_ids = [f"GB-CHC-{n}" for n in range(FTC_SMALL_ID_THRESHOLD * 5)]
+
+    chunks = list(
+        read_ftc_chunks(
+            "postgresql://ftc",
+            "SELECT",
+            org_ids,
+            chunk_size=FTC_SMALL_ID_THRESHOLD,
+            workers=2,
+        )
+    )
+
+    # chunks come back in order
+    assert len(chunks) == 5
+    assert pd.concat(chunks)["org_id"].tolist() == org_ids
+    assert read_sql.call_count == 5
+
+
+@pytest.mark.django_db
+def test_update_from_ftc_single_funder(funder, mocker, monkeypatch):
+    # the time taken to refresh a single funder, excluding the FTC database
+    # itself - run with `-s` to see the timing
+    monkeypatch.setenv("FTC_DB_URL", "postgresql://ftc")
+    mocker.patch("pandas.read_sql", side_effect=fake_read_sql)
+    mocker.patch("ukgrantmaking.utils.ftc.get_engine")
+    executor = mocker.patch("ukgrantmaking.utils.ftc.ThreadPoolExecutor")
+
+    start = time.perf_counter()
+    funder.update_from_ftc()
+    elapsed = time.perf_counter() - start
+    print(f"Single funder refresh from FTC: {elapsed:.3f}s")
+
+    executor.assert_not_called()
+    funder.refresh_from_db()
+    assert funder.name_registered == "Test Funder From FTC"
+    assert funder.scale_registered == "Local"
+    funder_year = FunderYear.objects.get(
+        funder_financial_year__funder=funder,
+        financial_year_end=datetime.date(2023, 3, 31),
+    )
+    assert funder_year.income_registered == 1000
@@ -1,4 +1,9 @@
 import pytest
+from django.core.management import call_command
+
+from ukgrantmaking.models.funder import Funder
+from ukgrantmaking.models.funder_utils import RecordStatus
+from ukgrantmaking.models.funder_year import FunderYear
 
 
 def get_fys(funder, successor):
@@ -49,3 +54,52 @@ def test_funder_successor_2(funder, funder_with_py):
 
     # check "new_funder_financial_year_id" is set correctly
     assert len([fy for fy in successor_fys if fy.new_funder_financial_year_id]) == 2
+
+
+@pytest.mark.django_db
+def test_funder_successor_chain(make_funder):
+    funder, successor, final_successor = [make_funder(n) for n in range(1, 4)]
+
+    funder.successor = successor
+    funder.save()
+    successor.successor = final_successor
+    successor.save()
+
+    # the funder years of both predecessors move to the final successor
+    assert len(list(funder.funder_years())) == 0
+    assert len(list(successor.funder_years())) == 0
+    assert len(list(final_successor.funder_years())) == 3
+    assert set(
+        FunderYear.objects.filter(new_funder_financial_year__isnull=False).values_list(
+            "new_funder_financial_year__funder_id", flat=True
+        )
+    ) == {final_successor.org_id}
+
+
+@pytest.mark.django_db
+def test_update_funder_successors(funder, make_funder):
+    successor = make_funder(2)
+    # set the successor without saving the funder
+    Funder.objects.filter(pk=funder.pk).update(successor=successor)
+    assert len(list(successor.funder_years())) == 1
+
+    call_command("update", "funder-successors")
+
+    assert len(list(funder.funder_years())) == 0
+    assert len(list(successor.funder_years())) == 2
+
+
+@pytest.mark.django_db
+def test_update_funder_successors_creates_financial_years(funder_with_py, make_funder):
+    successor = make_funder(3)
+    Funder.objects.filter(pk=funder_with_py.pk).update(successor=successor)
+
+    call_command("update", "funder-successors")
+
+    # the successor had no funder financial year for 2021-22, so one is created
+    # with the same defaults as the model would give it
+    ffy = successor.funder_financial_years.get(financial_year_id="2021-22")
+    assert ffy.checked == RecordStatus.UNCHECKED
+    assert ffy.date_added is not None
+    assert ffy.date_updated is not None
+    assert ffy.original_funder_years.count() == 1
@@ -0,0 +1,302 @@
+import datetime
+from collections import Counter
+
+import pytest
+from django.core.management import call_command
+
+from ukgrantmaking.management.commands.funders.update_funder_aggregates import (
+    aggregate_trigger_status,
+    check_funder_aggregates,
+    set_aggregate_triggers,
+)
+from ukgrantmaking.models.financial_years import FinancialYear, FinancialYearStatus
+from ukgrantmaking.models.funder import Funder
+from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.models.grant import DirtyFunderYear, Grant
+from ukgrantmaking.utils.funder_year import (
+    next_funder_year_dates,
+    update_dirty_funder_year_grants,
+    update_funder_year_grants,
+)
+
+
+def test_next_funder_year_dates():
+    year = FinancialYear(
+        fy="2023-24",
+        funders_start_date=datetime.date(2023, 5, 1),
+        funders_end_date=datetime.date(2024, 4, 30),
+        grants_start_date=datetime.date(2023, 4, 1),
+        grants_end_date=datetime.date(2024, 3, 31),
+    )
+    assert next_funder_year_dates(year, None) == (
+        datetime.date(2023, 4, 1),
+        datetime.date(2024, 3, 31),
+    )
+    assert next_funder_year_dates(year, datetime.date(2020, 12, 31)) == (
+        datetime.date(2023, 4, 1),
+        datetime.date(2024, 3, 31),
+    )
+    assert next_funder_year_dates(year, datetime.date(2023, 12, 31)) == (
+        datetime.date(2024, 1, 1),
+        datetime.date(2024, 12, 31),
+    )
+    assert next_funder_year_dates(year, datetime.date(2024, 2, 29)) == (
+        datetime.date(2024, 3, 1),
+        datetime.date(2025, 2, 28),
+    )
+
+
+def make_grant(n: int, funder_id: str, amount: float, **kwargs) -> Grant:
+    return Grant(
+        grant_id=f"360G-test-{n}",
+        title=f"Grant {n}",
+        amount_awarded=amount,
+        amount_awarded_GBP=amount,
+        award_date_registered=kwargs.pop("award_date", datetime.date(2022, 6, 1)),
+        funding_organisation_id=funder_id,
+        funder_id=funder_id,
+        financial_year_id="2022-23",
+        **kwargs,
+    )
+
+
+@pytest.mark.django_db
+def test_update_funder_year_grants(funder, financial_year):
+    other_funder = Funder.objects.create(
+        org_id="GB-COH-00000001", name_registered="Test Company Funder"
+    )
+    charity_without_years = Funder.objects.create(
+        org_id="GB-CHC-00000099", name_registered="Test Charity Funder"
+    )
+    Grant.objects.bulk_create(
+        [
+            make_grant(1, funder.org_id, 100),
+            make_grant(2, funder.org_id, 50, recipient_type_registered="Individual"),
+            make_grant(
+                3, funder.org_id, 1000, inclusion=Grant.InclusionStatus.EXCLUDED
+            ),
+            make_grant(4, funder.org_id, 1000, award_date=datetime.date(2019, 1, 1)),
+            make_grant(5, other_funder.org_id, 200),
+            make_grant(6, charity_without_years.org_id, 300),
+        ]
+    )
+
+    results = update_funder_year_grants([financial_year.fy])
+    assert results == Counter(
+        {
+            "Funder years updated": 1,
+            "Funder years created": 1,
+            "Funders skipped (charities)": 1,
+        }
+    )
+
+    funder_year = FunderYear.objects.get(
+        funder_financial_year__funder=funder,
+        funder_financial_year__financial_year=financial_year,
+    )
+    assert funder_year.spending_grant_making_institutions_main_360Giving == 100
+    assert funder_year.spending_grant_making_individuals_360Giving == 50
+
+    new_funder_year = FunderYear.objects.get(
+        funder_financial_year__funder=other_funder,
+        funder_financial_year__financial_year=financial_year,
+    )
+    assert new_funder_year.financial_year_start == datetime.date(2022, 4, 1)
+    assert new_funder_year.financial_year_end == datetime.date(2023, 3, 31)
+    assert new_funder_year.spending_grant_making_institutions_main_360Giving == 200
+    assert new_funder_year.spending_grant_making_individuals_360Giving == 0
+    assert not FunderYear.objects.filter(
+        funder_financial_year__funder=charity_without_years
+    ).exists()
+
+    # running again doesn't change anything
+    assert update_funder_year_grants([financial_year.fy]) == Counter(
+        {"Funder years updated": 0, "Funders skipped (charities)": 1}
+    )
+
+
+@pytest.mark.django_db
+def test_update_dirty_funder_year_grants(funder, financial_year):
+    other_funder = Funder.objects.create(
+        org_id="GB-COH-00000001", name_registered="Test Company Funder"
+    )
+    Grant.objects.bulk_create(
+        [
+            make_grant(1, funder.org_id, 100),
+            make_grant(2, other_funder.org_id, 200),
+        ]
+    )
+    assert not DirtyFunderYear.objects.exists()
+
+    # saving a grant marks its funder and financial year
+    grant = Grant.objects.get(grant_id="360G-test-1")
+    grant.amount_awarded_GBP = 150
+    grant.save()
+    assert list(
+        DirtyFunderYear.objects.values_list("funder_id", "financial_year_id")
+    ) == [(funder.org_id, financial_year.fy)]
+
+    # only the marked funder is recalculated
+    assert update_dirty_funder_year_grants([financial_year.fy]) == Counter(
+        {"Funder years updated": 1}
+    )
+    funder_year = FunderYear.objects.get(
+        funder_financial_year__funder=funder,
+        funder_financial_year__financial_year=financial_year,
+    )
+    assert funder_year.spending_grant_making_institutions_main_360Giving == 150
+    assert not FunderYear.objects.filter(
+        funder_financial_year__funder=other_funder
+    ).exists()
+    assert not DirtyFunderYear.objects.exists()
+
+    # nothing to do once the marks have been cleared
+    assert update_dirty_funder_year_grants([financial_year.fy]) == Counter()
+
+
+@pytest.mark.django_db
+def test_dirty_funder_years_marked(funder, make_funder, financial_year):
+    next_year, _ = FinancialYear.objects.update_or_create(
+        fy="2023-24", defaults={"current": False}
+    )
+    # a funder year ending in December is in the next financial year, but
+    # includes grants from the start of the year
+    funder.funder_financial_years.get_or_create(financial_year=next_year)[
+        0
+    ].funder_years.create(financial_year_end=datetime.date(2023, 12, 31))
+    Grant.objects.bulk_create(
+        [make_grant(1, funder.org_id, 100, award_date=datetime.date(2023, 2, 15))]
+    )
+
+    grant = Grant.objects.get(grant_id="360G-test-1")
+    grant.amount_awarded_GBP = 150
+    grant.save()
+    assert set(
+        DirtyFunderYear.objects.values_list("funder_id", "financial_year_id")
+    ) == {(funder.org_id, financial_year.fy), (funder.org_id, next_year.fy)}
+
+    # moving the grant to another funder marks both funders
+    DirtyFunderYear.objects.all().delete()
+    other_funder = make_funder(2)
+    grant = Grant.objects.get(grant_id="360G-test-1")
+    grant.funder = other_funder
+    grant.save()
+    assert set(
+        DirtyFunderYear.objects.values_list("funder_id", "financial_year_id")
+    ) == {
+        (funder.org_id, financial_year.fy),
+        (funder.org_id, next_year.fy),
+        (other_funder.org_id, financial_year.fy),
+        (other_funder.org_id, next_year.fy),
+    }
+
+
+@pytest.mark.django_db
+def test_update_grants_skips_closed_years(funder, financial_year):
+    closed_year, _ = FinancialYear.objects.update_or_create(
+        fy="2021-22",
+        defaults={"current": False, "status": FinancialYearStatus.CLOSED},
+    )
+    closed_funder_year = funder.funder_financial_years.get_or_create(
+        financial_year=closed_year
+    )[0].funder_years.create(financial_year_end=closed_year.grants_end_date)
+    Grant.objects.bulk_create(
+        [make_grant(1, funder.org_id, 100, award_date=datetime.date(2021, 6, 1))]
+    )
+
+    # the grant is moved to the closed year, which is marked but left alone
+    # unless it's asked for
+    call_command("update", "grants")
+    assert DirtyFunderYear.objects.filter(financial_year=closed_year).exists()
+    closed_funder_year.refresh_from_db()
+    assert closed_funder_year.spending_grant_making_institutions_main_360Giving is None
+
+    call_command("update", "grants", "--financial-year", closed_year.fy)
+    closed_funder_year.refresh_from_db()
+    assert closed_funder_year.spending_grant_making_institutions_main_360Giving == 100
+    assert not DirtyFunderYear.objects.filter(financial_year=closed_year).exists()
+
+
+@pytest.mark.django_db
+def test_funder_financial_year_update_aggregates(
+    funder, make_funder, financial_year, django_assert_num_queries
+):
+    funder_financial_year = funder.funder_financial_years.get(
+        financial_year=financial_year
+    )
+    funder_year = funder_financial_year.funder_years.get()
+    funder_year.income_manual = 100
+    funder_year.funds_restricted_manual = 20
+    funder_year.funds_unrestricted_manual = 30
+    funder_year.save()
+    funder_financial_year.funder_years.create(
+        financial_year_end=financial_year.grants_start_date,
+        income_manual=50,
+        total_net_assets_manual=1_000,
+    )
+
+    # the latest funder year is used, with funds calculated from its parts
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income == 150
+    assert funder_financial_year.funds == 50
+    assert funder_financial_year.total_net_assets == 50
+
+    # a single funder financial year is updated in one statement
+    FunderYear.objects.filter(id=funder_year.id).update(funds_manual=10)
+    with django_assert_num_queries(1):
+        funder_financial_year.update_fields()
+    assert funder_financial_year.funds == 10
+
+    # updating everything only changes the rows that are out of date
+    other = make_funder(2).funder_financial_years.get(financial_year=financial_year)
+    other.funder_years.update(income_manual=5)
+    changed = FunderFinancialYear.update_aggregates()
+    assert [row[0] for row in changed] == [other.id]
+    other.refresh_from_db()
+    assert other.income == 5
+
+    # funder financial years without funder years are cleared
+    other.funder_years.all().delete()
+    FunderFinancialYear.update_aggregates([other.id])
+    other.refresh_from_db()
+    assert other.income is None
+
+
+@pytest.mark.django_db
+def test_funder_aggregate_triggers(funder, financial_year):
+    funder_financial_year = funder.funder_financial_years.get(
+        financial_year=financial_year
+    )
+    assert set(aggregate_trigger_status().values()) == {False}
+
+    # without the triggers, bulk updates leave the aggregates out of date
+    funder_financial_year.funder_years.update(income_manual=100)
+    stale = check_funder_aggregates()
+    assert [row[0] for row in stale] == [funder_financial_year.id]
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income is None
+
+    # the triggers are turned off again when the test transaction rolls back
+    set_aggregate_triggers(True)
+    assert set(aggregate_trigger_status().values()) == {True}
+    funder_financial_year.funder_years.update(income_manual=200)
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income == 200
+
+    FunderYear.objects.bulk_create(
+        [
+            FunderYear(
+                funder_financial_year=funder_financial_year,
+                financial_year_end=financial_year.grants_start_date,
+                income_manual=50,
+            )
+        ]
+    )
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income == 250
+
+    funder_financial_year.funder_years.all().delete()
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income is None
+    assert check_funder_aggregates() == []
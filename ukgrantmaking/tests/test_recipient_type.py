@@ -0,0 +1,403 @@
+import datetime
+import time
+
+import pytest
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ukgrantmaking.management.commands.grants.fetch_grant_recipients import (
+    RECIPIENT_TOTALS_QUERY,
+    UPDATE_EXISTING_RECIPIENTS_QUERY,
+)
+from ukgrantmaking.models.grant import (
+    RECIPIENT_TYPE_RULES,
+    CompanyCategory,
+    DirtyFunderYear,
+    Grant,
+    GrantRecipient,
+    resolve_inclusion,
+)
+from ukgrantmaking.utils.recipient_type import (
+    classify_recipient,
+    update_recipient_types,
+)
+
+RecipientType = Grant.RecipientType
+
+RECIPIENTS = [
+    ("GB-CHC-1234567", "Example Charity", RecipientType.CHARITY),
+    (
+        "GB-COH-12345678",
+        "Example Community Interest Company",
+        RecipientType.COMMUNITY_INTEREST_COMPANY,
+    ),
+    ("GB-CIC-12345678", "Example CIC", RecipientType.COMMUNITY_INTEREST_COMPANY),
+    ("GB-COH-12345679", "Example CIC", None),
+    ("GB-EDU-123456", "Example Borough Council", RecipientType.LOCAL_AUTHORITY),
+    ("GB-UKPRN-12345678", "Example NHS Trust", RecipientType.NHS),
+    ("GB-UKPRN-12345679", "University of Example", RecipientType.UNIVERSITY),
+    ("GB-COH-12345680", "Example University of the Third Age", None),
+    ("GB-NHS-ABC", "Example Hospital", RecipientType.NHS),
+    ("GB-SCOTEDU-1234", "Example Primary School", RecipientType.EDUCATION),
+    ("GB-CASC-123", "Example Cricket Club", RecipientType.SPORTS_CLUB),
+    ("GB-COH-12345681", "Example TOWN COUNCIL", RecipientType.LOCAL_AUTHORITY),
+    ("GB-LAE-ABC", "Example University", RecipientType.LOCAL_AUTHORITY),
+    ("360G-example-1", "Example Group", None),
+]
+
+
+@pytest.mark.parametrize("recipient_id,name,expected", RECIPIENTS)
+def test_classify_recipient(recipient_id, name, expected):
+    assert classify_recipient(RECIPIENT_TYPE_RULES, recipient_id, name) == expected
+
+
+@pytest.mark.parametrize(
+    "inclusion,funder_type,recipient_type,expected",
+    [
+        (
+            Grant.InclusionStatus.UNSURE,
+            Grant.FunderType.CENTRAL_GOVERNMENT,
+            RecipientType.NHS,
+            Grant.InclusionStatus.GOVERNMENT_TRANSFER,
+        ),
+        (
+            Grant.InclusionStatus.UNSURE,
+            Grant.FunderType.LOCAL_GOVERNMENT,
+            RecipientType.CHARITY,
+            Grant.InclusionStatus.INCLUDED,
+        ),
+        (
+            Grant.InclusionStatus.UNSURE,
+            Grant.FunderType.CENTRAL_GOVERNMENT,
+            RecipientType.ORGANISATION,
+            Grant.InclusionStatus.UNSURE,
+        ),
+        (
+            Grant.InclusionStatus.UNSURE,
+            Grant.FunderType.GRANTMAKING_ORGANISATION,
+            RecipientType.NHS,
+            Grant.InclusionStatus.UNSURE,
+        ),
+        (
+            Grant.InclusionStatus.INCLUDED,
+            Grant.FunderType.CENTRAL_GOVERNMENT,
+            RecipientType.NHS,
+            Grant.InclusionStatus.INCLUDED,
+        ),
+    ],
+)
+def test_resolve_inclusion(inclusion, funder_type, recipient_type, expected):
+    assert resolve_inclusion(inclusion, funder_type, recipient_type) == expected
+
+
+def make_recipients(copies: int = 1) -> list[GrantRecipient]:
+    return [
+        GrantRecipient(
+            recipient_id=f"{recipient_id}-{n}",
+            name_registered=name,
+            type_registered=RecipientType.ORGANISATION,
+        )
+        for n in range(copies)
+        for recipient_id, name, _ in RECIPIENTS
+    ]
+
+
+# the filters from the command before the rules were compiled into a single
+# update, kept here to check the rules still give the same result
+SEQUENTIAL_FILTERS = [
+    (
+        RecipientType.CHARITY,
+        (
+            Q(recipient_id__startswith="GB-CHC-")
+            | Q(recipient_id__startswith="GB-SC-")
+            | Q(recipient_id__startswith="GB-NIC-")
+        ),
+    ),
+    (
+        RecipientType.LOCAL_AUTHORITY,
+        (
+            Q(recipient_id__startswith="GB-LAE-")
+            | Q(recipient_id__startswith="GB-LAS-")
+            | Q(recipient_id__startswith="GB-PLA-")
+            | Q(recipient_id__startswith="GB-LANI-")
+            | Q(recipient_id__startswith="GB-UKLA-")
+        ),
+    ),
+    (
+        RecipientType.COMMUNITY_INTEREST_COMPANY,
+        Q(name__icontains="community interest company"),
+    ),
+    (
+        RecipientType.COMMUNITY_INTEREST_COMPANY,
+        Q(name__iendswith=" cic") & Q(recipient_id__startswith="GB-CIC-"),
+    ),
+    (
+        RecipientType.LOCAL_AUTHORITY,
+        (
+            Q(recipient_id__startswith="GB-UKPRN-")
+            | Q(recipient_id__startswith="GB-EDU-")
+        )
+        & Q(name__icontains="council"),
+    ),
+    (
+        RecipientType.NHS,
+        (
+            Q(recipient_id__startswith="GB-UKPRN-")
+            | Q(recipient_id__startswith="GB-EDU-")
+        )
+        & Q(name__icontains="nhs"),
+    ),
+    (
+        RecipientType.UNIVERSITY,
+        Q(name__icontains="university") & ~Q(name__icontains="third age"),
+    ),
+    (
+        RecipientType.NHS,
+        Q(recipient_id__startswith="GB-NHS-"),
+    ),
+    (
+        RecipientType.EDUCATION,
+        (
+            Q(recipient_id__startswith="GB-UKPRN-")
+            | Q(recipient_id__startswith="GB-EDU-")
+            | Q(recipient_id__startswith="GB-SCOTEDU-")
+            | Q(recipient_id__startswith="GB-WALEDU-")
+            | Q(recipient_id__startswith="GB-NIEDU-")
+        ),
+    ),
+    (
+        RecipientType.SPORTS_CLUB,
+        Q(recipient_id__startswith="GB-CASC-"),
+    ),
+    (
+        RecipientType.LOCAL_AUTHORITY,
+        Q(name__iregex="(town|parish|community|county|district) Council"),
+    ),
+]
+
+
+def sequential_update() -> None:
+    # the filters applied one update at a time, as the command used to
+    for recipient_type, filter in SEQUENTIAL_FILTERS:
+        GrantRecipient.objects.filter(
+            Q(type_registered=RecipientType.ORGANISATION)
+            & Q(type_manual__isnull=True)
+            & filter
+        ).update(type_manual=recipient_type)
+
+
+def compiled_update() -> None:
+    update_recipient_types(
+        GrantRecipient.objects.filter(
+            type_registered=RecipientType.ORGANISATION,
+            type_manual__isnull=True,
+        ),
+        RECIPIENT_TYPE_RULES,
+    )
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("update", [sequential_update, compiled_update])
+def test_update_recipient_types(update):
+    GrantRecipient.objects.bulk_create(make_recipients())
+    update()
+    assert {
+        recipient_id.rsplit("-", 1)[0]: type_manual
+        for recipient_id, type_manual in GrantRecipient.objects.values_list(
+            "recipient_id", "type_manual"
+        )
+    } == {recipient_id: expected for recipient_id, _, expected in RECIPIENTS}
+
+
+@pytest.mark.django_db
+def test_update_recipient_types_benchmark():
+    # compare the single compiled update with the sequential updates it
+    # replaces - run with `-s` to see the timings
+    GrantRecipient.objects.bulk_create(make_recipients(copies=500))
+    timings = {}
+    results = {}
+    for update in (sequential_update, compiled_update):
+        GrantRecipient.objects.update(type_manual=None)
+        start = time.perf_counter()
+        update()
+        timings[update.__name__] = time.perf_counter() - start
+        results[update.__name__] = dict(
+            GrantRecipient.objects.values_list("recipient_id", "type_manual")
+        )
+    assert results["sequential_update"] == results["compiled_update"]
+    print(
+        "Recipient type update for {:,.0f} recipients: {}".format(
+            GrantRecipient.objects.count(),
+            ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items()),
+        )
+    )
+
+
+@pytest.mark.django_db
+def test_update_recipient_type_offline():
+    GrantRecipient.objects.bulk_create(
+        [
+            GrantRecipient(
+                recipient_id=f"GB-COH-0000000{n}",
+                name_registered=f"Example Company {n}",
+                type_registered=RecipientType.ORGANISATION,
+            )
+            for n in range(1, 4)
+        ]
+    )
+    CompanyCategory.objects.bulk_create(
+        [
+            CompanyCategory(
+                company_id="GB-COH-00000001",
+                company_category="ltd",
+                refreshed=timezone.now(),
+            ),
+            CompanyCategory(
+                company_id="GB-COH-00000002",
+                company_category="ltd",
+                ftc_organisation_type="registered-charity",
+                refreshed=timezone.now(),
+            ),
+        ]
+    )
+
+    Grant.objects.bulk_create(
+        [
+            Grant(
+                grant_id=f"360G-test-{n}",
+                title=f"Grant {n}",
+                amount_awarded=100,
+                award_date_registered=datetime.date(2022, 6, 1),
+                recipient_id=f"GB-COH-0000000{n}",
+                funding_organisation_type=Grant.FunderType.CENTRAL_GOVERNMENT,
+            )
+            for n in range(1, 4)
+        ]
+    )
+
+    # only the local copy of the company categories is used
+    call_command(
+        "update", "grant-recipient-type", "--offline", "--grant-batch-size", "2"
+    )
+
+    assert dict(GrantRecipient.objects.values_list("recipient_id", "type_manual")) == {
+        "GB-COH-00000001": RecipientType.PRIVATE_COMPANY,
+        "GB-COH-00000002": RecipientType.CHARITY,
+        "GB-COH-00000003": None,
+    }
+    assert dict(Grant.objects.values_list("grant_id", "inclusion")) == {
+        "360G-test-1": Grant.InclusionStatus.PRIVATE_SECTOR_GRANT,
+        "360G-test-2": Grant.InclusionStatus.INCLUDED,
+        "360G-test-3": Grant.InclusionStatus.UNSURE,
+    }
+
+
+@pytest.mark.django_db
+def test_grant_recipient_save(funder, financial_year, django_assert_num_queries):
+    recipient = GrantRecipient.objects.create(
+        recipient_id="GB-COH-00000001",
+        name_registered="Example Company",
+        type_registered=RecipientType.ORGANISATION,
+    )
+    Grant.objects.bulk_create(
+        [
+            Grant(
+                grant_id=f"360G-test-{n}",
+                title=f"Grant {n}",
+                amount_awarded=100,
+                award_date_registered=datetime.date(2022, 6, 1),
+                recipient=recipient,
+                recipient_type_manual=recipient_type,
+                funder=funder,
+                funding_organisation_type=funder_type,
+                financial_year=financial_year,
+            )
+            for n, recipient_type, funder_type in [
+                (1, None, Grant.FunderType.CENTRAL_GOVERNMENT),
+                (2, None, Grant.FunderType.GRANTMAKING_ORGANISATION),
+                (3, RecipientType.NHS, Grant.FunderType.CENTRAL_GOVERNMENT),
+                (4, RecipientType.UNIVERSITY, Grant.FunderType.CENTRAL_GOVERNMENT),
+            ]
+        ]
+    )
+
+    DirtyFunderYear.objects.all().delete()
+    recipient.type_manual = RecipientType.PRIVATE_COMPANY
+    # one statement to save the recipient, two to mark the funder years of its
+    # grants, and one to update the grants
+    with django_assert_num_queries(4):
+        recipient.save()
+
+    assert DirtyFunderYear.objects.filter(
+        funder=funder, financial_year=financial_year
+    ).exists()
+
+    assert {
+        grant_id: (recipient_type, inclusion)
+        for grant_id, recipient_type, inclusion in Grant.objects.values_list(
+            "grant_id", "recipient_type", "inclusion"
+        )
+    } == {
+        "360G-test-1": (
+            RecipientType.PRIVATE_COMPANY,
+            Grant.InclusionStatus.PRIVATE_SECTOR_GRANT,
+        ),
+        "360G-test-2": (RecipientType.PRIVATE_COMPANY, Grant.InclusionStatus.UNSURE),
+        "360G-test-3": (RecipientType.NHS, Grant.InclusionStatus.GOVERNMENT_TRANSFER),
+        "360G-test-4": (RecipientType.UNIVERSITY, Grant.InclusionStatus.UNSURE),
+    }
+
+
+@pytest.mark.django_db
+def test_update_existing_recipients_keeps_ftc_names():
+    GrantRecipient.objects.bulk_create(
+        [
+            GrantRecipient(
+                recipient_id="GB-CHC-1234567",
+                name_registered="Example Charity From FTC",
+                type_registered=RecipientType.ORGANISATION,
+                date_of_registration=datetime.date(2000, 1, 1),
+                content_hash="ftc",
+            ),
+            GrantRecipient(
+                recipient_id="GB-COH-12345678",
+                name_registered="Old Company Name",
+                type_registered=RecipientType.ORGANISATION,
+                content_hash="old",
+            ),
+        ]
+    )
+    Grant.objects.bulk_create(
+        [
+            Grant(
+                grant_id=f"360G-test-{n}",
+                title=f"Grant {n}",
+                amount_awarded=100,
+                award_date_registered=datetime.date(2022, 6, 1),
+                recipient_organisation_id=recipient_id,
+                recipient_organisation_name=name,
+                funding_organisation_type=Grant.FunderType.CENTRAL_GOVERNMENT,
+            )
+            for n, recipient_id, name in [
+                (1, "GB-CHC-1234567", "EXAMPLE CHARITY"),
+                (2, "GB-COH-12345678", "New Company Name"),
+            ]
+        ]
+    )
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(RECIPIENT_TOTALS_QUERY)
+        cursor.execute(UPDATE_EXISTING_RECIPIENTS_QUERY)
+
+    # recipients found in FTC keep the FTC name and aren't marked as changed
+    assert {
+        recipient_id: (name, content_hash)
+        for recipient_id, name, content_hash in GrantRecipient.objects.values_list(
+            "recipient_id", "name_registered", "content_hash"
+        )
+    } == {
+        "GB-CHC-1234567": ("Example Charity From FTC", "ftc"),
+        "GB-COH-12345678": ("New Company Name", None),
+    }
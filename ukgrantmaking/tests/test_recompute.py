@@ -0,0 +1,82 @@
+import pytest
+
+from ukgrantmaking.models.funder import Funder
+from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.recompute import deferred_recompute
+
+
+@pytest.mark.django_db
+def test_deferred_recompute_funder(financial_year, tag):
+    with deferred_recompute() as dirty:
+        funder = Funder.objects.create(
+            org_id="GB-CHC-00000001", name_registered="Test Funder"
+        )
+        funder.tags.set([tag])
+        funder.segment = "Community Foundation"
+        funder.save()
+        # nothing is updated until the block exits
+        assert dirty.funders == {"GB-CHC-00000001"}
+        assert not funder.funder_financial_years.exists()
+
+    funder.refresh_from_db()
+    assert funder.current_year.financial_year == financial_year
+    assert funder.current_year.segment == "Community Foundation"
+    assert set(funder.tags.values_list("slug", flat=True)) == {"ccew", tag.slug}
+    assert set(funder.current_year.tags.values_list("slug", flat=True)) == {
+        "ccew",
+        tag.slug,
+    }
+
+
+@pytest.mark.django_db
+def test_deferred_recompute_funder_years(funder, financial_year):
+    funder_financial_year = funder.funder_financial_years.get(
+        financial_year=financial_year
+    )
+    funder_year = funder_financial_year.funder_years.get()
+
+    with deferred_recompute():
+        funder_year.income_manual = 100
+        funder_year.save()
+        funder_financial_year.funder_years.create(
+            financial_year_end=financial_year.grants_start_date,
+            income_manual=50,
+        )
+        funder_financial_year.refresh_from_db()
+        assert funder_financial_year.income is None
+
+    funder_financial_year.refresh_from_db()
+    assert funder_financial_year.income == 150
+
+
+@pytest.mark.django_db
+def test_deferred_recompute_successor(funder, make_funder, financial_year):
+    successor = make_funder(2)
+    with deferred_recompute():
+        funder.successor = successor
+        funder.save()
+
+    successor_year = FunderFinancialYear.objects.get(
+        funder=successor, financial_year=financial_year
+    )
+    funder_year = FunderYear.objects.get(funder_financial_year__funder=funder)
+    assert funder_year.new_funder_financial_year == successor_year
+
+
+@pytest.mark.django_db
+def test_deferred_recompute_exception(funder, financial_year):
+    funder_year = FunderYear.objects.get(funder_financial_year__funder=funder)
+    with pytest.raises(ValueError):
+        with deferred_recompute():
+            funder_year.income_manual = 100
+            funder_year.save()
+            raise ValueError("Stop")
+
+    # the save inside the block is rolled back, and saves outside the block
+    # aren't deferred
+    assert FunderYear.objects.get(pk=funder_year.pk).income_manual is None
+    assert funder_year.funder_financial_year.income is None
+    funder_year.save()
+    funder_year.funder_financial_year.refresh_from_db()
+    assert funder_year.funder_financial_year.income == 100
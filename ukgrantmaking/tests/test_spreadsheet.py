@@ -0,0 +1,93 @@
+import datetime
+
+import pytest
+from django.core.management import call_command
+from openpyxl import Workbook
+
+from ukgrantmaking.management.commands.funders.fetch_ccew import (
+    CHARITY_NUMBER_COLUMN,
+    FIELDS_TO_UPDATE,
+    FINANCIAL_YEAR_END_COLUMN,
+)
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.spreadsheet import iter_spreadsheet, read_spreadsheet
+
+
+def write_workbook(path, rows, sheet="Sheet1"):
+    wb = Workbook()
+    ws = wb.active
+    ws.title = sheet
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+    return path
+
+
+def test_iter_spreadsheet(tmp_path):
+    file = write_workbook(
+        tmp_path / "test.xlsx",
+        [
+            ["A title row"],
+            ["org_id", "name", "amount", None],
+            ["GB-CHC-1", "Funder 1", 100],
+            ["GB-CHC-2", "Funder 2", 200.5, "extra"],
+            [None, None, None],
+            ["GB-CHC-3", "Funder 3", None],
+        ],
+    )
+    batches = list(iter_spreadsheet(file, skip_rows=1, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0].columns.tolist() == ["org_id", "name", "amount", "Unnamed: 3"]
+    assert batches[1]["org_id"].tolist() == ["GB-CHC-3"]
+
+    df = read_spreadsheet(file, skip_rows=1, columns=["org_id", "amount"])
+    assert df.columns.tolist() == ["org_id", "amount"]
+    assert df["org_id"].tolist() == ["GB-CHC-1", "GB-CHC-2", "GB-CHC-3"]
+    assert df["amount"].tolist()[:2] == [100, 200.5]
+
+
+def test_iter_spreadsheet_csv(tmp_path):
+    file = tmp_path / "test.csv"
+    file.write_text("org_id,amount\nGB-CHC-1,100\nGB-CHC-2,200\nGB-CHC-3,300\n")
+    batches = list(iter_spreadsheet(file, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert read_spreadsheet(file)["amount"].tolist() == [100, 200, 300]
+
+
+@pytest.mark.django_db
+def test_fetch_ccew(funder, financial_year, tmp_path):
+    funder_year = FunderYear.objects.get(
+        funder_financial_year__funder=funder,
+        financial_year_end=financial_year.grants_end_date,
+    )
+    funder_year.spending_grant_making_individuals_registered = 10
+    funder_year.save()
+
+    header = [CHARITY_NUMBER_COLUMN, FINANCIAL_YEAR_END_COLUMN] + [
+        field_name for field_name, _ in FIELDS_TO_UPDATE
+    ]
+    charity_number = int(funder.org_id.removeprefix("GB-CHC-"))
+    year_end = datetime.datetime.combine(
+        funder_year.financial_year_end, datetime.time()
+    )
+    file = write_workbook(
+        tmp_path / "ccew.xlsx",
+        [
+            header,
+            [charity_number, year_end, 3, "0 - 2", 1, 500, None, 1000, 0, 0],
+            [99999999, year_end, 1, 1, 1, 1, 1, 1, 1, 1],
+        ],
+    )
+
+    call_command("fetch", "ccew", str(file))
+
+    funder_year.refresh_from_db()
+    assert funder_year.employees_permanent_registered == 3
+    assert funder_year.employees_fixedterm_registered is None
+    assert funder_year.employees_selfemployed_registered == 1
+    assert funder_year.employees_registered == 4
+    assert funder_year.income_investment_registered == 500
+    # missing values don't overwrite existing ones
+    assert funder_year.spending_grant_making_individuals_registered == 10
+    assert funder_year.spending_grant_making_institutions_charitable_registered == 1000
+    assert funder_year.content_hash is None
@@ -0,0 +1,104 @@
+import time
+
+import pandas as pd
+import pytest
+
+from ukgrantmaking.utils.text import (
+    _to_titlecase,
+    to_titlecase,
+    to_titlecase_series,
+)
+
+# outputs of `to_titlecase` before it was cached
+TITLECASE_GOLDEN = [
+    ("THE BIG LOTTERY FUND", "The Big Lottery Fund"),
+    (
+        "  ST JOHN'S CHURCH OF ENGLAND PRIMARY SCHOOL  ",
+        "St John's Church of England Primary School",
+    ),
+    ("YMCA ENGLAND & WALES", "YMCA England & Wales"),
+    ("mixed Case Name Ltd", "mixed Case Name Ltd"),
+    ("the 1st hampton scouts", "The 1st Hampton Scouts"),
+    ("NHS CHARITIES TOGETHER", "NHS Charities Together"),
+    ("MR AND MRS SMITH'S TRUST", "Mr and Mrs Smith's Trust"),
+    ("BBC CHILDREN IN NEED", "BBC Children in Need"),
+    ("U3A (WEST)", "U3A (West)"),
+    ("FRIENDS OF ST. MARY'S", "Friends of St Mary's"),
+    ("YOU'RE WELCOME CIO", "You're Welcome CIO"),
+    ("CLWB PEL-DROED CWM", "Clwb Pel-Droed Cwm"),
+    ("WORLD WAR II VETERANS", "World War II Veterans"),
+    ("A.B.C. PLAYGROUP", "A.B.C. Playgroup"),
+    ("THE 21ST CENTURY TRUST", "The 21st Century Trust"),
+    ("lowercase only foundation", "Lowercase Only Foundation"),
+    ("DR. JONES (UK) LTD", "Dr Jones (UK) Ltd"),
+    ("CE PRIMARY SCHOOL (VA)", "CE Primary School (Va)"),
+    ("", ""),
+    ("THIS IS A SENTENCE. AND ANOTHER ONE.", "This is a Sentence. And Another One."),
+]
+
+
+@pytest.mark.parametrize("name,expected", TITLECASE_GOLDEN)
+def test_to_titlecase(name, expected):
+    assert to_titlecase(name) == expected
+
+
+def test_to_titlecase_sentence():
+    assert (
+        to_titlecase("THIS IS A SENTENCE. AND ANOTHER ONE.", sentence=True)
+        == "This is a sentence. And another one."
+    )
+
+
+def test_to_titlecase_series():
+    names = pd.Series(
+        [name for name, _ in TITLECASE_GOLDEN] + [None, float("nan"), 3],
+        dtype=object,
+    )
+    result = to_titlecase_series(names)
+    assert result.iloc[: len(TITLECASE_GOLDEN)].tolist() == [
+        expected for _, expected in TITLECASE_GOLDEN
+    ]
+    assert result.iloc[-3] is None
+    assert pd.isna(result.iloc[-2])
+    assert result.iloc[-1] == 3
+
+
+def uncached_titlecase(s):
+    # `to_titlecase` without the cache, as it was before
+    if not isinstance(s, str):
+        return s
+    s = s.strip()
+    if not s.isupper() and not s.islower():
+        return s
+    return _to_titlecase.__wrapped__(s, False)
+
+
+def test_to_titlecase_series_benchmark():
+    # compare titlecasing each row with the deduplicated, cached series
+    # version - run with `-s` to see the timings
+    names = pd.Series(
+        [name for name, _ in TITLECASE_GOLDEN] * 500
+        + [f"TRUST NUMBER {n}" for n in range(2_000)]
+    )
+    timings = {}
+
+    start = time.perf_counter()
+    expected = names.map(uncached_titlecase)
+    timings["per row"] = time.perf_counter() - start
+
+    _to_titlecase.cache_clear()
+    start = time.perf_counter()
+    result = to_titlecase_series(names)
+    timings["series"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    to_titlecase_series(names)
+    timings["series (cached)"] = time.perf_counter() - start
+
+    assert result.tolist() == expected.tolist()
+    print(
+        "Titlecase {:,.0f} names: {}".format(
+            len(names),
+            ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timings.items()),
+        )
+    )
@@ -0,0 +1,382 @@
+import hashlib
+import io
+import json
+import math
+from collections import Counter
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from typing import Any, Callable, Dict, Generator
+
+import pandas as pd
+from django.db import connection, models, transaction
+from django.utils import timezone
+
+from ukgrantmaking.utils import DEFAULT_BATCH_SIZE, batched
+
+
+def _copy_fields(model: type[models.Model]) -> list[models.Field]:
+    # concrete fields that are written to the database - excludes generated
+    # fields and auto-incrementing primary keys
+    return [
+        field
+        for field in model._meta.concrete_fields
+        if not field.generated and not isinstance(field, models.AutoField)
+    ]
+
+
+def _copy_value(field: models.Field, value) -> str:
+    """
+    Format a value for the PostgreSQL COPY text format.
+    """
+    if isinstance(value, models.Model):
+        value = value.pk
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return "\\N"
+    if isinstance(field, models.JSONField):
+        value = json.dumps(value, cls=field.encoder)
+    else:
+        value = field.get_db_prep_save(value, connection)
+        if value is None:
+            return "\\N"
+    if isinstance(value, bool):
+        value = "t" if value else "f"
+    elif isinstance(value, (date, datetime, time)):
+        value = value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_from(cursor, sql: str, data: io.StringIO):
+    if hasattr(cursor, "copy_expert"):
+        # psycopg2
+        cursor.copy_expert(sql, data)
+    else:
+        # psycopg 3
+        with cursor.copy(sql) as copy:
+            copy.write(data.getvalue())
+
+
+def content_hash(fields: list[models.Field], values: dict) -> str:
+    """
+    A hash of the values of the given fields, used to check whether a record
+    has changed since it was last loaded.
+    """
+    return hashlib.md5(
+        "\t".join(
+            _copy_value(field, values.get(field.name)) for field in fields
+        ).encode("utf8")
+    ).hexdigest()
+
+
+def do_copy_update(
+    model: type[models.Model],
+    iterable: Generator[Dict, None, None],
+    unique_fields: list[str],
+    update_fields: list[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hash_field: str | None = None,
+    clear_on_update: list[str] | None = None,
+    returning: list[str] | None = None,
+    on_returning: Callable[[list[tuple]], None] | None = None,
+) -> Counter:
+    """
+    Insert or update records using PostgreSQL `COPY`.
+
+    Takes the same arguments as `do_batched_update`. Each batch of records is
+    copied into a temporary staging table and then merged into the model's
+    table with a single `INSERT ... ON CONFLICT DO UPDATE`. Fields missing from
+    the records get their default value, as they would in `bulk_create`.
+
+    Existing rows are only updated if they have changed. If `hash_field` is
+    given, a hash of the `update_fields` is stored in that field and compared,
+    otherwise the `update_fields` are compared directly. Any `clear_on_update`
+    fields are set to null on rows that are updated - for example to clear a
+    hash stored by another loader.
+
+    If `returning` and `on_returning` are given, `on_returning` is called for
+    each batch with the values of the `returning` fields of every record that
+    was inserted or changed, followed by the values that the changed records
+    had before they were updated.
+
+    Returns the number of records inserted, changed and unchanged.
+    """
+    clear_on_update = clear_on_update or []
+    qn = connection.ops.quote_name
+    fields = _copy_fields(model)
+    hash_fields = [model._meta.get_field(field) for field in update_fields]
+    columns = ", ".join(qn(field.column) for field in fields)
+    table = qn(model._meta.db_table)
+    staging = qn(f"{model._meta.db_table}_staging")
+    unique_columns = [
+        qn(model._meta.get_field(field).column) for field in unique_fields
+    ]
+    if hash_field:
+        compare_columns = [qn(model._meta.get_field(hash_field).column)]
+    else:
+        compare_columns = [qn(field.column) for field in hash_fields]
+
+    def is_distinct(old: str, new: str) -> str:
+        return "({}) IS DISTINCT FROM ({})".format(
+            ", ".join(f"{old}.{column}" for column in compare_columns),
+            ", ".join(f"{new}.{column}" for column in compare_columns),
+        )
+
+    set_columns = [
+        "{column} = EXCLUDED.{column}".format(column=qn(field.column))
+        for field in hash_fields
+    ]
+    if hash_field:
+        set_columns.append(
+            "{column} = EXCLUDED.{column}".format(
+                column=qn(model._meta.get_field(hash_field).column)
+            )
+        )
+    set_columns += [
+        "{} = NULL".format(qn(model._meta.get_field(field).column))
+        for field in clear_on_update
+    ]
+    if update_fields:
+        on_conflict = "DO UPDATE SET {} WHERE {}".format(
+            ", ".join(set_columns),
+            is_distinct(table, "EXCLUDED"),
+        )
+    else:
+        on_conflict = "DO NOTHING"
+    if returning and on_returning:
+        on_conflict += " RETURNING {}".format(
+            ", ".join(qn(model._meta.get_field(field).column) for field in returning)
+        )
+    old_values_query = """
+        SELECT {}
+        FROM {} t
+            INNER JOIN {} s
+                ON {}
+        WHERE {}
+    """.format(
+        ", ".join(
+            "t.{}".format(qn(model._meta.get_field(field).column))
+            for field in returning or []
+        ),
+        table,
+        staging,
+        " AND ".join(f"t.{column} = s.{column}" for column in unique_columns),
+        is_distinct("t", "s"),
+    )
+    count_query = f"""
+        SELECT count(*) FILTER (WHERE t.{unique_columns[0]} IS NULL) AS inserted,
+            count(*) FILTER (WHERE t.{unique_columns[0]} IS NOT NULL AND {is_distinct("t", "s")}) AS changed,
+            count(*) FILTER (WHERE t.{unique_columns[0]} IS NOT NULL AND NOT {is_distinct("t", "s")}) AS unchanged
+        FROM {staging} s
+            LEFT OUTER JOIN {table} t
+                ON {" AND ".join(f"t.{column} = s.{column}" for column in unique_columns)}
+    """
+
+    counts = Counter()
+    with transaction.atomic(), connection.cursor() as cursor:
+        # temporary tables aren't written to the WAL, and are dropped at the end
+        cursor.execute(
+            f"CREATE TEMPORARY TABLE {staging} AS SELECT {columns} FROM {table} WITH NO DATA"
+        )
+        for batch in batched(iterable, batch_size):
+            # defaults for any fields not found in the records are
+            # worked out once for each batch
+            now = timezone.now()
+            defaults = {
+                field.name: (
+                    now
+                    if getattr(field, "auto_now", False)
+                    or getattr(field, "auto_now_add", False)
+                    else field.get_default()
+                )
+                for field in fields
+            }
+
+            data = io.StringIO()
+            for record in batch:
+                values = {
+                    **defaults,
+                    **{model._meta.get_field(k).name: v for k, v in record.items()},
+                }
+                if hash_field:
+                    values[model._meta.get_field(hash_field).name] = content_hash(
+                        hash_fields, values
+                    )
+                data.write(
+                    "\t".join(
+                        _copy_value(field, values[field.name]) for field in fields
+                    )
+                )
+                data.write("\n")
+            data.seek(0)
+
+            cursor.execute(f"TRUNCATE {staging}")
+            _copy_from(cursor, f"COPY {staging} ({columns}) FROM STDIN", data)
+            if update_fields:
+                cursor.execute(count_query)
+                for key, value in zip(
+                    ["inserted", "changed", "unchanged"], cursor.fetchone()
+                ):
+                    counts[key] += value
+            old_values = []
+            if returning and on_returning and update_fields:
+                cursor.execute(old_values_query)
+                old_values = cursor.fetchall()
+            cursor.execute(
+                f"""
+                INSERT INTO {table} ({columns})
+                SELECT {columns} FROM {staging}
+                ON CONFLICT ({", ".join(unique_columns)}) {on_conflict}
+                """
+            )
+            if returning and on_returning:
+                on_returning(cursor.fetchall() + old_values)
+        cursor.execute(f"DROP TABLE {staging}")
+    return counts
+
+
+# the value in a `bulk_upsert` index for a key matching more than one record
+_AMBIGUOUS = object()
+
+
+@dataclass(frozen=True)
+class UpsertKey:
+    """
+    How a column in a dataframe is matched to a field on the model.
+
+    If there is no exact match, each of the `fallbacks` is tried in turn.
+    A fallback is a function applied to both the dataframe value and the
+    field value, so a fallback of `lambda d: (d.year, d.month)` matches a
+    date in the same month.
+    """
+
+    column: str
+    field: str
+    fallbacks: tuple[Callable[[Any], Any], ...] = ()
+
+
+def bulk_upsert(
+    queryset: models.QuerySet,
+    df: pd.DataFrame,
+    keys: list[UpsertKey],
+    fields: dict[str, str],
+    create: Callable[[dict], models.Model | None] | None = None,
+    overwrite: bool = True,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> tuple[Counter, pd.Series]:
+    """
+    Update existing records from the rows of a dataframe, and create any
+    records that aren't found.
+
+    Rows are matched on the `keys`. The candidates are fetched with a single
+    query on the first key, so that key must match exactly. Values are copied
+    from the dataframe column to the model field given in `fields`. Missing
+    values don't replace existing values, and with `overwrite=False` only
+    fields that are empty on the existing record are filled in.
+
+    Unmatched rows are passed to `create` as a dict, which returns a new
+    (unsaved) record or None to skip the row. Without `create` they are
+    skipped. Rows whose first match is with more than one record, such as a
+    funder with two years ending in the same month, are ambiguous and are
+    skipped rather than guessing which record to update.
+
+    Returns the number of rows that were matched, created and skipped, and
+    the primary key of the record for each row.
+    """
+    model = queryset.model
+    rows = df.astype(object).where(df.notna(), None)
+
+    # the candidate records, found with one query on the first key
+    candidates = []
+    for values in batched(rows[keys[0].column].dropna().unique(), batch_size):
+        candidates.extend(
+            queryset.filter(**{f"{keys[0].field}__in": values}).values_list(
+                "pk", *[key.field for key in keys]
+            )
+        )
+
+    # an index of the candidates for each level of matching, from exact to
+    # the loosest fallback
+    levels = max(len(key.fallbacks) for key in keys) + 1
+
+    def match_key(level: int, values: tuple) -> tuple:
+        return tuple(
+            key.fallbacks[min(level, len(key.fallbacks)) - 1](value)
+            if level and key.fallbacks and value is not None
+            else value
+            for key, value in zip(keys, values)
+        )
+
+    indexes = [{} for _ in range(levels)]
+    for pk, *values in candidates:
+        for level, index in enumerate(indexes):
+            key = match_key(level, values)
+            index[key] = pk if index.get(key, pk) == pk else _AMBIGUOUS
+
+    counts = Counter(matched=0, created=0, skipped=0)
+    pks = pd.Series(None, index=df.index, dtype=object)
+    matched = {}
+    new_records = {}
+    to_create = []
+    for row_index, row in zip(rows.index, rows.to_dict("records")):
+        values = tuple(row[key.column] for key in keys)
+        pk = None
+        for level, index in enumerate(indexes):
+            pk = index.get(match_key(level, values))
+            if pk is not None:
+                break
+        if pk is _AMBIGUOUS:
+            counts["skipped"] += 1
+            continue
+        if pk is not None:
+            counts["matched"] += 1
+            pks[row_index] = pk
+            matched.setdefault(pk, []).append(row)
+            continue
+        if values in new_records:
+            # a record has already been created for an earlier row
+            counts["matched"] += 1
+            _set_upsert_fields(new_records[values], row, fields, overwrite)
+            to_create.append((row_index, new_records[values]))
+            continue
+        record = create(row) if create else None
+        if record is None:
+            counts["skipped"] += 1
+            continue
+        counts["created"] += 1
+        _set_upsert_fields(record, row, fields, overwrite=True)
+        new_records[values] = record
+        to_create.append((row_index, record))
+
+    update_fields = list(fields.values())
+    for pk_batch in batched(matched.keys(), batch_size):
+        records = model.objects.in_bulk(pk_batch)
+        for pk, record in records.items():
+            for row in matched[pk]:
+                _set_upsert_fields(record, row, fields, overwrite)
+        if update_fields:
+            model.objects.bulk_update(
+                records.values(), update_fields, batch_size=batch_size
+            )
+
+    model.objects.bulk_create(new_records.values(), batch_size=batch_size)
+    for row_index, record in to_create:
+        pks[row_index] = record.pk
+
+    return counts, pks
+
+
+def _set_upsert_fields(
+    record: models.Model, row: dict, fields: dict[str, str], overwrite: bool
+) -> None:
+    for column, field in fields.items():
+        value = row.get(column)
+        if value is None:
+            continue
+        if not overwrite and getattr(record, field):
+            continue
+        setattr(record, field, value)
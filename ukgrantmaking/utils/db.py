@@ -0,0 +1,123 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import Connection, Engine, create_engine, event
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Environment variables holding the URL of each external database
+EXTERNAL_DATABASES = {
+    "datastore": "TSG_DATASTORE_URL",
+    "ftc": "FTC_DB_URL",
+}
+
+ENGINE_POOL_SIZE = 5
+
+_engines: dict[str, Engine] = {}
+_timings: dict[str, Counter] = {}
+_lock = threading.Lock()
+
+
+def _add_timing_listeners(engine: Engine, timings: Counter) -> None:
+    @event.listens_for(engine, "do_connect")
+    def before_connect(dialect, conn_rec, cargs, cparams):
+        conn_rec.info["connect_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "connect")
+    def after_connect(dbapi_connection, conn_rec):
+        start = conn_rec.info.pop("connect_start", None)
+        if start is not None:
+            timings["connections"] += 1
+            timings["connection_seconds"] += time.perf_counter() - start
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        timings["queries"] += 1
+        timings["query_seconds"] += elapsed
+        logger.debug(f"Query ran in {elapsed:.3f}s")
+
+
+def get_engine(db_con: str) -> Engine:
+    """
+    Get a pooled engine for an external database URL. The engine is created on
+    first use and shared by every later caller, so connections stay open
+    between queries.
+    """
+    with _lock:
+        engine = _engines.get(db_con)
+        if engine is None:
+            engine = create_engine(
+                db_con,
+                pool_size=ENGINE_POOL_SIZE,
+                max_overflow=0,
+                pool_pre_ping=True,
+            )
+            _timings[db_con] = Counter()
+            _add_timing_listeners(engine, _timings[db_con])
+            _engines[db_con] = engine
+    return engine
+
+
+def get_external_engine(name: str) -> Engine:
+    """
+    Get the pooled engine for one of the named external databases, using the
+    URL from its environment variable.
+    """
+    env_var = EXTERNAL_DATABASES[name]
+    db_con = os.environ.get(env_var)
+    if not db_con:
+        raise ValueError(f"{env_var} environment variable not set")
+    return get_engine(db_con)
+
+
+@contextmanager
+def stream_connection(db_con: str, chunk_size: int) -> Iterator[Connection]:
+    """
+    A connection that uses a server-side cursor, so that results can be read
+    `chunk_size` rows at a time.
+    """
+    with (
+        get_engine(db_con)
+        .connect()
+        .execution_options(stream_results=True, max_row_buffer=chunk_size) as conn
+    ):
+        yield conn
+
+
+def engine_timings(db_con: str) -> Counter:
+    """
+    The number of connections and queries made through the engine for a URL,
+    and the time spent on each.
+    """
+    return Counter(_timings.get(db_con, Counter()))
+
+
+def log_engine_timings(db_con: str) -> None:
+    timings = engine_timings(db_con)
+    logger.info(
+        f"[Database] {timings['connections']:,.0f} connections "
+        f"({timings['connection_seconds']:,.2f}s), "
+        f"{timings['queries']:,.0f} queries ({timings['query_seconds']:,.2f}s)"
+    )
+
+
+def dispose_engines() -> None:
+    """
+    Close all connections held by the pooled engines.
+    """
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+        _timings.clear()
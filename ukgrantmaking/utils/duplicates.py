@@ -0,0 +1,136 @@
+from dataclasses import dataclass, field
+from typing import Callable
+
+import pandas as pd
+
+
+def normalise_text(s: pd.Series) -> pd.Series:
+    return s.astype("string").str.strip().str.lower()
+
+
+def normalise_amount(s: pd.Series) -> pd.Series:
+    return pd.to_numeric(s, errors="coerce").astype(float)
+
+
+def normalise_date(s: pd.Series) -> pd.Series:
+    # make sure both sides use the same resolution, so they hash the same way
+    return pd.to_datetime(s, utc=True, format="ISO8601").dt.as_unit("ns")
+
+
+def normalise_grant_id(s: pd.Series) -> pd.Series:
+    # National Lottery Community Fund grants have a slightly different format
+    # in the DCMS data, but the same ID.
+    return (
+        s.astype("string")
+        .str.strip()
+        .str.replace("DCMS-tnlcomfund-", "360G-tnlcomfund-", regex=False)
+    )
+
+
+@dataclass
+class DuplicateRule:
+    """
+    A rule for matching grants. Two grants match if all the fields are equal
+    once they have been normalised.
+    """
+
+    name: str
+    fields: dict[str, Callable[[pd.Series], pd.Series]] = field(default_factory=dict)
+
+    def keys(self, df: pd.DataFrame) -> pd.Series:
+        # the grant ID is the index of the dataframe
+        columns = {
+            name: normalise(df.index.to_series() if name == "grant_id" else df[name])
+            for name, normalise in self.fields.items()
+        }
+        return pd.Series(
+            pd.util.hash_pandas_object(
+                pd.DataFrame(columns, index=df.index), index=False
+            ).to_numpy(),
+            index=df.index,
+        )
+
+
+NL_DUPLICATE_RULES = [
+    DuplicateRule(
+        "Grant ID",
+        {"grant_id": normalise_grant_id},
+    ),
+    DuplicateRule(
+        "Title, amount, award date, recipient and funder",
+        {
+            "title": normalise_text,
+            "amount_awarded": normalise_amount,
+            "award_date_registered": normalise_date,
+            "recipient_organization_name": normalise_text,
+            "funding_organization_id": normalise_text,
+        },
+    ),
+]
+
+
+class DuplicateMatcher:
+    """
+    Find grants that duplicate grants already seen from another publisher.
+
+    Grants are added to an index using `add`, which can be called for each
+    chunk of data. Only a 64-bit hash of the normalised fields of each rule is
+    kept, along with the grant ID. Other grants can then be checked against
+    the index with `match`.
+    """
+
+    def __init__(self, rules: list[DuplicateRule] = NL_DUPLICATE_RULES):
+        self.rules = rules
+        self._chunks: dict[str, list[pd.Series]] = {rule.name: [] for rule in rules}
+        self._index: dict[str, pd.Series] = {}
+
+    def add(self, df: pd.DataFrame):
+        """
+        Add grants to the index. The grant ID should be the index of the dataframe.
+        """
+        for rule in self.rules:
+            keys = rule.keys(df)
+            self._chunks[rule.name].append(
+                pd.Series(df.index.to_numpy(), index=keys.to_numpy())
+            )
+            self._index.pop(rule.name, None)
+
+    def _rule_index(self, rule: DuplicateRule) -> pd.Series:
+        if rule.name not in self._index:
+            chunks = self._chunks[rule.name]
+            index = pd.concat(chunks) if chunks else pd.Series(dtype="object")
+            self._index[rule.name] = index[~index.index.duplicated(keep="first")]
+            self._chunks[rule.name] = [self._index[rule.name]]
+        return self._index[rule.name]
+
+    def match(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Find grants that match a grant in the index.
+
+        Returns a dataframe with the ID of each matched grant as the index, the
+        ID of the grant it matched (`duplicate_of`) and the name of the first
+        rule that matched (`rule`).
+        """
+        results = []
+        remaining = df
+        for rule in self.rules:
+            if remaining.empty:
+                break
+            index = self._rule_index(rule)
+            keys = rule.keys(remaining)
+            found = keys.isin(index.index)
+            results.append(
+                pd.DataFrame(
+                    {
+                        "duplicate_of": index.reindex(
+                            keys[found].to_numpy()
+                        ).to_numpy(),
+                        "rule": rule.name,
+                    },
+                    index=keys[found].index,
+                )
+            )
+            remaining = remaining[~found.to_numpy()]
+        if not results:
+            return pd.DataFrame(columns=["duplicate_of", "rule"])
+        return pd.concat(results)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+from datetime import datetime, timezone
+from pathlib import Path
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FETCH_TIMEOUT = 120
+FETCH_RETRIES = 3
+CHUNK_SIZE = 1024 * 1024
+
+
+def _session(retries: int = FETCH_RETRIES) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+        )
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_file(
+    url: str,
+    suffix: str = "",
+    offline: bool = False,
+    cache_dir: str | Path | None = None,
+    timeout: int = FETCH_TIMEOUT,
+) -> Path:
+    """
+    Download a file to the local cache, and return the path to the cached copy.
+
+    If the file has been downloaded before, the server is asked whether it
+    has changed since (using the ETag and Last-Modified headers) and the cached
+    copy is used if it hasn't. With `offline` the cached copy is always used.
+
+    A local file path can also be given as the url, in which case it is
+    returned unchanged.
+    """
+    if not url.startswith(("http://", "https://")):
+        return Path(url)
+
+    cache_dir = Path(cache_dir or settings.FETCH_CACHE_DIR)
+    path = cache_dir / (hashlib.sha1(url.encode("utf8")).hexdigest() + suffix)
+    metadata_path = path.with_name(path.name + ".json")
+
+    if offline:
+        if not path.exists():
+            raise FileNotFoundError(f"No cached copy of {url} found in {cache_dir}")
+        logger.info(f"Using cached copy of {url}")
+        return path
+
+    headers = {}
+    if path.exists() and metadata_path.exists():
+        metadata = json.loads(metadata_path.read_text())
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+
+    logger.info(f"Fetching {url}")
+    with _session().get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            logger.info(f"{url} not modified, using cached copy")
+            return path
+        r.raise_for_status()
+
+        # download to a temporary file first so a failed download doesn't
+        # replace the cached copy
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        download_path = path.with_name(path.name + ".download")
+        with open(download_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+        download_path.replace(path)
+
+        metadata_path.write_text(
+            json.dumps(
+                {
+                    "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "fetched": datetime.now(timezone.utc).isoformat(),
+                }
+            )
+        )
+    logger.info(f"Saved {url} to {path}")
+    return path
@@ -0,0 +1,94 @@
+from typing import Literal
+
+import pandas as pd
+from django.db import connection, models
+
+from ukgrantmaking.models.financial_years import FinancialYear
+
+DateType = Literal["grants", "funders"]
+
+UPDATE_FINANCIAL_YEAR_QUERY = """
+    WITH updated AS (
+        UPDATE {table} AS t
+        SET {financial_year} = fy.fy
+        FROM ukgrantmaking_financialyear AS fy,
+            {table} AS old
+        WHERE old.{pk} = t.{pk}
+            AND t.{date} >= fy.{date_type}_start_date
+            AND t.{date} <= fy.{date_type}_end_date
+            AND t.{financial_year} IS DISTINCT FROM fy.fy
+        RETURNING fy.fy AS new_financial_year,
+            old.{financial_year} AS old_financial_year,
+            t.*
+    ){on_update}
+    SELECT new_financial_year, count(*)
+    FROM updated
+    GROUP BY new_financial_year
+    ORDER BY new_financial_year
+"""
+
+
+def update_financial_year(
+    model: type[models.Model],
+    date_field: str,
+    date_type: DateType = "grants",
+    financial_year_field: str = "financial_year",
+    on_update: str | None = None,
+) -> dict[str, int]:
+    """
+    Set the financial year of every record based on a date field, using the
+    grants or funders date ranges of each financial year.
+
+    Only records where the financial year changes are updated. Returns the
+    number of records updated for each financial year.
+
+    `on_update` is an optional SQL statement run in the same query, which can
+    use the updated records as `updated`. It has the new values of the
+    table's columns, along with `old_financial_year`.
+    """
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            UPDATE_FINANCIAL_YEAR_QUERY.format(
+                table=qn(model._meta.db_table),
+                pk=qn(model._meta.pk.column),
+                financial_year=qn(model._meta.get_field(financial_year_field).column),
+                date=qn(model._meta.get_field(date_field).column),
+                date_type=date_type,
+                on_update=f",\n    on_update AS ({on_update})" if on_update else "",
+            )
+        )
+        return dict(cursor.fetchall())
+
+
+def financial_year_lookup(
+    dates: pd.Series,
+    date_type: DateType = "funders",
+    financial_years: pd.DataFrame | None = None,
+) -> pd.Series:
+    """
+    Find the financial year for each date in a series, using the grants or
+    funders date ranges of each financial year.
+
+    Returns a series with the same index, with None for any dates that aren't
+    in a financial year.
+    """
+    if financial_years is None:
+        financial_years = pd.DataFrame.from_records(
+            FinancialYear.objects.values(
+                "fy", f"{date_type}_start_date", f"{date_type}_end_date"
+            ),
+            columns=["fy", f"{date_type}_start_date", f"{date_type}_end_date"],
+        )
+    intervals = pd.IntervalIndex.from_arrays(
+        pd.to_datetime(financial_years[f"{date_type}_start_date"]),
+        pd.to_datetime(financial_years[f"{date_type}_end_date"]),
+        closed="both",
+    )
+    positions = intervals.get_indexer(pd.to_datetime(dates))
+    fys = financial_years["fy"].to_numpy(dtype=object)
+    return pd.Series(
+        [fys[position] if position >= 0 else None for position in positions],
+        index=dates.index,
+        dtype=object,
+    )
@@ -0,0 +1,135 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+from ukgrantmaking.utils import batched
+from ukgrantmaking.utils.db import get_engine
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FTC_CHUNK_SIZE = 10_000
+FTC_WORKERS = 4
+# below this many org IDs the query is run directly, without a connection pool
+FTC_SMALL_ID_THRESHOLD = 50
+
+# Classifications of charities in England and Wales. The charity numbers are
+# matched directly so the index on the registration number can be used.
+FTC_CLASSIFICATION_CTE = """
+    c AS (
+        SELECT 'GB-CHC-' || registered_charity_number AS org_id,
+            array_agg(classification_description) FILTER (WHERE classification_type = 'How') AS how,
+            array_agg(classification_description) FILTER (WHERE classification_type = 'What') AS what,
+            array_agg(classification_description) FILTER (WHERE classification_type = 'Who') AS who
+        FROM charity_ccewcharityclassification
+        WHERE linked_charity_number = 0
+            AND registered_charity_number = ANY(%(charity_numbers)s::int[])
+        GROUP BY 1
+    )
+"""
+
+# Headquarters and area of operation locations of each organisation
+FTC_LOCATION_CTE = """
+    l AS (
+        SELECT org_id,
+            array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq,
+            json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_laua IS NOT NULL) AS la_hq_name,
+            array_agg(DISTINCT l.geo_laua) FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo,
+            json_object_agg(DISTINCT l.geo_laua, la."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_laua IS NOT NULL) AS la_aoo_name,
+            array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq,
+            json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_rgn IS NOT NULL) AS rgn_hq_name,
+            array_agg(DISTINCT l.geo_rgn) FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo,
+            json_object_agg(DISTINCT l.geo_rgn, rgn."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_rgn IS NOT NULL) AS rgn_aoo_name,
+            array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq,
+            json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'HQ' AND l.geo_ctry IS NOT NULL) AS ctry_hq_name,
+            array_agg(DISTINCT l.geo_ctry) FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo,
+            json_object_agg(DISTINCT l.geo_ctry, ctry."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_ctry IS NOT NULL) AS ctry_aoo_name,
+            array_agg(DISTINCT l.geo_iso) FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo,
+            json_object_agg(DISTINCT l.geo_iso, iso."name") FILTER (WHERE "locationType" = 'AOO' AND l.geo_iso IS NOT NULL AND l.geo_iso != 'GB') AS overseas_aoo_name,
+            SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'HQ' THEN 1 ELSE 0 END) > 0 AS london_hq,
+            SUM(CASE WHEN l.geo_rgn = 'E12000007' AND "locationType" = 'AOO' THEN 1 ELSE 0 END) > 0 AS london_aoo,
+            array_agg(DISTINCT l.geo_lsoa21) FILTER (WHERE "locationType" = 'HQ' AND l.geo_lsoa21 IS NOT NULL) AS lsoa_hq
+        FROM ftc_organisationlocation l
+            LEFT OUTER JOIN geo_geolookup rgn
+                ON l.geo_rgn = rgn."geoCode"
+            LEFT OUTER JOIN geo_geolookup ctry
+                ON l.geo_ctry = ctry."geoCode"
+            LEFT OUTER JOIN geo_geolookup la
+                ON l.geo_laua = la."geoCode"
+            LEFT OUTER JOIN geo_geolookup iso
+                ON l.geo_iso = iso."geoCode"
+        WHERE l.org_id = ANY(%(org_ids)s::text[])
+        GROUP BY 1
+    )
+"""
+
+# The scale of each organisation
+FTC_SCALE_CTE = """
+    s AS (
+        SELECT c.org_id,
+            ve.title AS scale
+        FROM ftc_vocabulary v
+            INNER JOIN ftc_vocabularyentries ve
+                ON v.id = ve.vocabulary_id
+            INNER JOIN ftc_organisationclassification c
+                ON ve.id = c.vocabulary_id
+        WHERE v.slug = 'scale'
+            AND c.org_id = ANY(%(org_ids)s::text[])
+    )
+"""
+
+
+def ftc_query_params(org_ids: list[str]) -> dict[str, list]:
+    """
+    The parameters for an FTC query: the org IDs, and the registered numbers
+    of any charities in England and Wales.
+    """
+    return {
+        "org_ids": org_ids,
+        "charity_numbers": [
+            int(org_id.removeprefix("GB-CHC-"))
+            for org_id in org_ids
+            if org_id.startswith("GB-CHC-") and org_id.removeprefix("GB-CHC-").isdigit()
+        ],
+    }
+
+
+def read_ftc_chunks(
+    db_con: str,
+    query: str,
+    org_ids: Iterable[str],
+    chunk_size: int = FTC_CHUNK_SIZE,
+    workers: int = FTC_WORKERS,
+) -> Iterator[pd.DataFrame]:
+    """
+    Run a query against the Find that Charity database for a list of org IDs,
+    and return the results as a dataframe for each chunk of org IDs.
+
+    The query should filter on the `org_ids` parameter using
+    `= ANY(%(org_ids)s::text[])`, so the IDs are passed as a single array
+    rather than a long list of values. Chunks are run in parallel on the shared
+    pool of connections, and at most `workers` chunks are held in memory at a
+    time. A small number of IDs is fetched with a single query instead.
+    """
+    org_ids = list(org_ids)
+    engine = get_engine(db_con)
+
+    def read_chunk(chunk: list[str]) -> pd.DataFrame:
+        with engine.connect() as conn:
+            return pd.read_sql(query, con=conn, params=ftc_query_params(chunk))
+
+    if len(org_ids) < FTC_SMALL_ID_THRESHOLD:
+        yield read_chunk(org_ids)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in batched(org_ids, chunk_size):
+            pending.append(executor.submit(read_chunk, chunk))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,356 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+from typing import Iterable
+
+import pandas as pd
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, models
+from django.db.models.functions import Coalesce
+
+from ukgrantmaking.models.financial_years import FinancialYear
+from ukgrantmaking.models.funder import FunderNote
+from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
+from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.models.grant import DirtyFunderYear, Grant
+from ukgrantmaking.utils.financial_year import financial_year_lookup
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CHARITY_ORG_ID_SCHEMAS = ("GB-CHC", "GB-SC", "GB-NIC")
+
+GRANT_INCLUSION = (
+    Grant.InclusionStatus.INCLUDED.value,
+    Grant.InclusionStatus.UNSURE.value,
+)
+
+GRANT_TOTALS = """
+    COALESCE(SUM(g."amount_awarded_GBP") FILTER (
+        WHERE g.recipient_type IS DISTINCT FROM 'Individual'
+    ), 0) AS institutions,
+    COALESCE(SUM(g."amount_awarded_GBP") FILTER (
+        WHERE g.recipient_type = 'Individual'
+    ), 0) AS individuals
+"""
+
+# Recalculate the grant totals for existing funder years, using the grants
+# awarded by the funder between the start and end of each funder year. Only
+# funder years where the totals change are updated.
+UPDATE_FUNDER_YEAR_GRANTS_QUERY = f"""
+    WITH funder_year_dates AS (
+        SELECT fyr.id,
+            ffy.funder_id,
+            COALESCE(
+                fyr.financial_year_start,
+                fyr.financial_year_end - 365
+            ) AS start_date,
+            fyr.financial_year_end AS end_date
+        FROM ukgrantmaking_funderyear AS fyr
+            INNER JOIN ukgrantmaking_funderfinancialyear AS ffy
+                ON fyr.funder_financial_year_id = ffy.id
+        WHERE ffy.financial_year_id = ANY(%(financial_years)s)
+            AND (%(all_funders)s OR ffy.funder_id = ANY(%(funder_ids)s))
+            AND EXISTS (
+                SELECT 1
+                FROM ukgrantmaking_grant AS g
+                WHERE g.funder_id = ffy.funder_id
+            )
+    ),
+    totals AS (
+        SELECT d.id,
+            {GRANT_TOTALS}
+        FROM funder_year_dates AS d
+            LEFT OUTER JOIN ukgrantmaking_grant AS g
+                ON g.funder_id = d.funder_id
+                AND g.award_date >= d.start_date
+                AND g.award_date <= d.end_date
+                AND g.inclusion IN %(inclusion)s
+        GROUP BY d.id
+    )
+    UPDATE ukgrantmaking_funderyear AS fyr
+    SET "spending_grant_making_institutions_main_360Giving" = totals.institutions,
+        "spending_grant_making_individuals_360Giving" = totals.individuals
+    FROM totals
+    WHERE fyr.id = totals.id
+        AND (
+            fyr."spending_grant_making_institutions_main_360Giving",
+            fyr."spending_grant_making_individuals_360Giving"
+        ) IS DISTINCT FROM (totals.institutions, totals.individuals)
+"""
+
+# Grant totals for each funder and financial year where the funder has grants
+# in the financial year but no funder years.
+MISSING_FUNDER_YEAR_GRANTS_QUERY = f"""
+    SELECT g.funder_id,
+        fy.fy,
+        f.org_id_schema IN %(charity_schemas)s AS is_charity,
+        {GRANT_TOTALS}
+    FROM ukgrantmaking_grant AS g
+        INNER JOIN ukgrantmaking_funder AS f
+            ON g.funder_id = f.org_id
+        INNER JOIN ukgrantmaking_financialyear AS fy
+            ON g.award_date >= fy.grants_start_date
+            AND g.award_date <= fy.grants_end_date
+    WHERE fy.fy = ANY(%(financial_years)s)
+        AND (%(all_funders)s OR g.funder_id = ANY(%(funder_ids)s))
+        AND g.inclusion IN %(inclusion)s
+        AND NOT EXISTS (
+            SELECT 1
+            FROM ukgrantmaking_funderyear AS fyr
+                INNER JOIN ukgrantmaking_funderfinancialyear AS ffy
+                    ON fyr.funder_financial_year_id = ffy.id
+            WHERE ffy.funder_id = g.funder_id
+                AND ffy.financial_year_id = fy.fy
+        )
+    GROUP BY g.funder_id, fy.fy, f.org_id_schema
+    ORDER BY g.funder_id, fy.fy
+"""
+
+
+def next_funder_year_dates(
+    year: FinancialYear, previous_year_end: date | None
+) -> tuple[date, date]:
+    """
+    Find the start and end dates for a new funder year in a financial year.
+
+    If the funder's latest funder year ends in the financial year then the new
+    funder year follows on from it, otherwise the financial year's default
+    grant dates are used.
+    """
+    if previous_year_end is None or not (
+        year.contains_date_grant(previous_year_end)
+        or year.contains_date_funder(previous_year_end)
+    ):
+        return year.grants_start_date, year.grants_end_date
+    if previous_year_end.month == 2 and previous_year_end.day == 29:
+        fyend = date(previous_year_end.year + 1, 2, 28)
+    else:
+        fyend = date(
+            previous_year_end.year + 1, previous_year_end.month, previous_year_end.day
+        )
+    return previous_year_end + timedelta(days=1), fyend
+
+
+def latest_funder_year_ends(funder_ids: list[str]) -> dict[str, date]:
+    """
+    Find the end date of the latest funder year for each funder, including
+    funder years transferred from predecessors (see `Funder.funder_years`).
+    """
+    return dict(
+        FunderYear.objects.filter(
+            models.Q(
+                new_funder_financial_year__isnull=True,
+                funder_financial_year__funder_id__in=funder_ids,
+            )
+            | models.Q(
+                new_funder_financial_year__funder_id__in=funder_ids,
+                new_funder_financial_year__isnull=False,
+            )
+        )
+        .annotate(
+            owner_id=Coalesce(
+                "new_funder_financial_year__funder_id",
+                "funder_financial_year__funder_id",
+            )
+        )
+        .values("owner_id")
+        .annotate(latest=models.Max("financial_year_end"))
+        .values_list("owner_id", "latest")
+    )
+
+
+def update_funder_year_grants(
+    financial_years: list[str], funder_ids: list[str] | None = None
+) -> Counter:
+    """
+    Update the 360Giving grant totals of funder years in the given financial
+    years, using the grants awarded by each funder.
+
+    Existing funder years are updated in a single query. Funders with grants
+    in a financial year but no funder years get a new funder year, unless
+    they are charities (which get their funder years from the charity
+    regulators).
+    """
+    results = Counter()
+    params = {
+        "financial_years": list(financial_years),
+        "all_funders": not funder_ids,
+        "funder_ids": list(funder_ids or []),
+        "inclusion": GRANT_INCLUSION,
+        "charity_schemas": CHARITY_ORG_ID_SCHEMAS,
+    }
+
+    with connection.cursor() as cursor:
+        cursor.execute(UPDATE_FUNDER_YEAR_GRANTS_QUERY, params)
+        results["Funder years updated"] = cursor.rowcount
+
+        cursor.execute(MISSING_FUNDER_YEAR_GRANTS_QUERY, params)
+        missing = []
+        for funder_id, fy, is_charity, institutions, individuals in cursor.fetchall():
+            if is_charity:
+                logger.info(
+                    f"Skipping {funder_id} {fy} as it's a charity and doesn't have funder years",
+                )
+                results["Funders skipped (charities)"] += 1
+                continue
+            missing.append((funder_id, fy, institutions, individuals))
+
+    if not missing:
+        return results
+
+    years = FinancialYear.objects.in_bulk([fy for _, fy, _, _ in missing])
+    previous_year_ends = latest_funder_year_ends(
+        list({funder_id for funder_id, _, _, _ in missing})
+    )
+
+    FunderFinancialYear.objects.bulk_create(
+        [
+            FunderFinancialYear(funder_id=funder_id, financial_year_id=fy)
+            for funder_id, fy, _, _ in missing
+        ],
+        ignore_conflicts=True,
+    )
+    funder_financial_years = {
+        (ffy.funder_id, ffy.financial_year_id): ffy
+        for ffy in FunderFinancialYear.objects.filter(
+            funder_id__in={funder_id for funder_id, _, _, _ in missing},
+            financial_year_id__in=years.keys(),
+        )
+    }
+
+    funder_years = []
+    for funder_id, fy, institutions, individuals in missing:
+        fystart, fyend = next_funder_year_dates(
+            years[fy], previous_year_ends.get(funder_id)
+        )
+        logger.info(f"Creating {funder_id} {fyend}")
+        funder_years.append(
+            FunderYear(
+                funder_financial_year=funder_financial_years[(funder_id, fy)],
+                financial_year_start=fystart,
+                financial_year_end=fyend,
+                spending_grant_making_institutions_main_360Giving=institutions,
+                spending_grant_making_individuals_360Giving=individuals,
+            )
+        )
+    FunderYear.objects.bulk_create(funder_years)
+    results["Funder years created"] = len(funder_years)
+
+    # bulk_create doesn't call FunderYear.save, so update the funder financial
+    # years with the new values here
+    refresh_funder_financial_years(
+        {funder_year.funder_financial_year_id for funder_year in funder_years}
+    )
+
+    return results
+
+
+def refresh_funder_financial_years(ids: Iterable[int]) -> None:
+    """
+    Recalculate the values of funder financial years from their funder years,
+    for when the funder years have been saved without `FunderYear.save`.
+    """
+    FunderFinancialYear.update_aggregates(list(ids))
+
+
+def funder_financial_year_ids(
+    funder_year_ends: Iterable[tuple[str, date]],
+) -> dict[tuple[str, date], int]:
+    """
+    Find the funder financial year for each pair of funder and financial year
+    end, creating any that don't exist yet. Year ends that aren't in a
+    financial year are left out.
+    """
+    funder_year_ends = pd.DataFrame(
+        list(set(funder_year_ends)), columns=["funder_id", "financial_year_end"]
+    )
+    funder_year_ends["fy"] = financial_year_lookup(
+        funder_year_ends["financial_year_end"], date_type="funders"
+    )
+    funder_year_ends = funder_year_ends.dropna(subset=["fy"])
+    if funder_year_ends.empty:
+        return {}
+
+    pairs = set(funder_year_ends[["funder_id", "fy"]].itertuples(index=False))
+    FunderFinancialYear.objects.bulk_create(
+        [
+            FunderFinancialYear(funder_id=funder_id, financial_year_id=fy)
+            for funder_id, fy in pairs
+        ],
+        ignore_conflicts=True,
+    )
+    ids = {
+        (funder_id, fy): ffy_id
+        for funder_id, fy, ffy_id in FunderFinancialYear.objects.filter(
+            funder_id__in={funder_id for funder_id, _ in pairs},
+            financial_year_id__in={fy for _, fy in pairs},
+        ).values_list("funder_id", "financial_year_id", "id")
+    }
+    return {
+        (row.funder_id, row.financial_year_end): ids[(row.funder_id, row.fy)]
+        for row in funder_year_ends.itertuples()
+    }
+
+
+def add_funder_year_notes(
+    funder_year_ids: pd.Series, notes: pd.Series, only_if_empty: bool = True
+) -> int:
+    """
+    Add a note to each funder year. With `only_if_empty`, funder years that
+    already have notes are skipped.
+    """
+    content_type = ContentType.objects.get_for_model(FunderYear)
+    notes = pd.DataFrame({"object_id": funder_year_ids, "note": notes}).dropna()
+    notes["object_id"] = notes["object_id"].astype(int).astype(str)
+    existing = set(
+        FunderNote.objects.filter(
+            content_type=content_type, object_id__in=notes["object_id"]
+        ).values_list("object_id", "note")
+    )
+    with_notes = {object_id for object_id, _ in existing}
+    new_notes = [
+        FunderNote(content_type=content_type, object_id=object_id, note=note)
+        for object_id, note in notes.drop_duplicates().itertuples(index=False)
+        if (object_id, note) not in existing
+        and not (only_if_empty and object_id in with_notes)
+    ]
+    FunderNote.objects.bulk_create(new_notes)
+    return len(new_notes)
+
+
+def update_dirty_funder_year_grants(financial_years: list[str]) -> Counter:
+    """
+    Update the 360Giving grant totals for the funders that have been marked
+    as having changed grants in the given financial years, and then clear
+    their marks. Marks in other financial years are left in place.
+    """
+    dirty = list(
+        DirtyFunderYear.objects.filter(
+            financial_year_id__in=financial_years
+        ).values_list("id", "funder_id", "financial_year_id")
+    )
+    logger.info(f"{len(dirty):,.0f} funder years marked as changed")
+
+    funders_by_year = defaultdict(set)
+    for _, funder_id, fy in dirty:
+        funders_by_year[fy].add(funder_id)
+
+    results = Counter()
+    for fy, funder_ids in sorted(funders_by_year.items()):
+        results.update(update_funder_year_grants([fy], sorted(funder_ids)))
+
+    DirtyFunderYear.objects.filter(id__in=[id_ for id_, _, _ in dirty]).delete()
+    return results
+
+
+def clear_dirty_funder_years(
+    financial_years: list[str], funder_ids: list[str] | None = None
+) -> None:
+    """
+    Clear the changed marks for funder years that have been recalculated.
+    """
+    dirty = DirtyFunderYear.objects.filter(financial_year_id__in=financial_years)
+    if funder_ids:
+        dirty = dirty.filter(funder_id__in=funder_ids)
+    dirty.delete()
@@ -0,0 +1,107 @@
+import operator
+import re
+from dataclasses import dataclass
+from functools import cached_property, reduce
+
+from django.db import models
+from django.db.models import Q
+
+
+@dataclass(frozen=True)
+class RecipientTypeRule:
+    """
+    A rule for finding the type of a recipient organisation from its ID and
+    name.
+
+    Each condition that is set must match. Within a condition any of the
+    values can match. Name conditions are case insensitive.
+    """
+
+    recipient_type: str
+    id_prefixes: tuple[str, ...] = ()
+    name_contains: tuple[str, ...] = ()
+    name_endswith: tuple[str, ...] = ()
+    name_regex: str | None = None
+    name_excludes: tuple[str, ...] = ()
+
+    def to_q(self) -> Q:
+        conditions = []
+        for lookup, values in (
+            ("recipient_id__startswith", self.id_prefixes),
+            ("name__icontains", self.name_contains),
+            ("name__iendswith", self.name_endswith),
+        ):
+            if values:
+                conditions.append(
+                    reduce(operator.or_, [Q(**{lookup: value}) for value in values])
+                )
+        if self.name_regex:
+            conditions.append(Q(name__iregex=self.name_regex))
+        for value in self.name_excludes:
+            conditions.append(~Q(name__icontains=value))
+        return reduce(operator.and_, conditions)
+
+    @cached_property
+    def _name_pattern(self) -> re.Pattern | None:
+        if self.name_regex:
+            return re.compile(self.name_regex, re.IGNORECASE)
+        return None
+
+    def matches(self, recipient_id: str | None, name: str | None) -> bool:
+        recipient_id = recipient_id or ""
+        name = (name or "").lower()
+        if self.id_prefixes and not recipient_id.startswith(self.id_prefixes):
+            return False
+        if self.name_contains and not any(
+            value.lower() in name for value in self.name_contains
+        ):
+            return False
+        if self.name_endswith and not name.endswith(
+            tuple(value.lower() for value in self.name_endswith)
+        ):
+            return False
+        if self._name_pattern and not self._name_pattern.search(name):
+            return False
+        if any(value.lower() in name for value in self.name_excludes):
+            return False
+        return True
+
+
+def classify_recipient(
+    rules: list[RecipientTypeRule], recipient_id: str | None, name: str | None
+) -> str | None:
+    """
+    Find the type of a recipient using the first rule that matches, or None if
+    no rules match.
+    """
+    for rule in rules:
+        if rule.matches(recipient_id, name):
+            return rule.recipient_type
+    return None
+
+
+def recipient_type_case(rules: list[RecipientTypeRule]) -> models.Case:
+    """
+    A `CASE` expression giving the type from the first rule that matches.
+    """
+    return models.Case(
+        *[
+            models.When(rule.to_q(), then=models.Value(rule.recipient_type))
+            for rule in rules
+        ],
+        default=models.Value(None),
+        output_field=models.CharField(),
+    )
+
+
+def update_recipient_types(
+    queryset: models.QuerySet, rules: list[RecipientTypeRule]
+) -> int:
+    """
+    Set `type_manual` for all recipients in the queryset that match one of the
+    rules, in a single `UPDATE` statement. Returns the number of recipients
+    updated.
+    """
+    return queryset.filter(
+        reduce(operator.or_, [rule.to_q() for rule in rules])
+    ).update(type_manual=recipient_type_case(rules))
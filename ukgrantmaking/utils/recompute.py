@@ -0,0 +1,336 @@
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterable, Iterator
+
+from django.db import connection, models, transaction
+
+logger = logging.getLogger(__name__)
+
+FUNDER_TAG_PREFIXES = {
+    "GB-CHC": "ccew",
+    "GB-SC": "oscr",
+    "GB-NIC": "ccni",
+}
+
+# Follow the successor of each funder, and the successor of that successor,
+# to find the final successor. `path` records the funders visited so a loop of
+# successors ends rather than recursing forever. Only funders with one of
+# `funder_ids` in their chain are included, unless `all_funders` is set.
+SUCCESSOR_CHAIN_CTE = """
+    WITH RECURSIVE successor_chain AS (
+        SELECT org_id,
+            successor_id,
+            ARRAY[org_id::text, successor_id::text] AS path
+        FROM ukgrantmaking_funder
+        WHERE successor_id IS NOT NULL
+        UNION ALL
+        SELECT chain.org_id,
+            f.successor_id,
+            chain.path || f.successor_id::text
+        FROM successor_chain AS chain
+            INNER JOIN ukgrantmaking_funder AS f
+                ON f.org_id = chain.successor_id
+        WHERE f.successor_id IS NOT NULL
+            AND NOT f.successor_id::text = ANY(chain.path)
+    ),
+    final_successor AS (
+        SELECT org_id, successor_id
+        FROM (
+            SELECT DISTINCT ON (org_id) org_id, successor_id, path
+            FROM successor_chain
+            ORDER BY org_id, cardinality(path) DESC
+        ) AS chains
+        WHERE %(all_funders)s OR path && %(funder_ids)s::text[]
+    )
+"""
+
+# Create funder financial years for the final successors, for each financial
+# year where a predecessor has funder years. The new rows are unchecked and
+# dated now, as they would be if created through the model.
+CREATE_SUCCESSOR_FINANCIAL_YEARS_QUERY = (
+    SUCCESSOR_CHAIN_CTE
+    + """
+    INSERT INTO ukgrantmaking_funderfinancialyear (
+        funder_id,
+        financial_year_id,
+        segment,
+        included,
+        makes_grants_to_individuals,
+        checked,
+        date_added,
+        date_updated
+    )
+    SELECT DISTINCT ON (fs.successor_id, ffy.financial_year_id)
+        fs.successor_id,
+        ffy.financial_year_id,
+        ffy.segment,
+        ffy.included,
+        ffy.makes_grants_to_individuals,
+        %(checked)s,
+        now(),
+        now()
+    FROM final_successor AS fs
+        INNER JOIN ukgrantmaking_funderfinancialyear AS ffy
+            ON ffy.funder_id = fs.org_id
+    WHERE EXISTS (
+        SELECT 1
+        FROM ukgrantmaking_funderyear AS fyr
+        WHERE fyr.funder_financial_year_id = ffy.id
+    )
+    ORDER BY fs.successor_id, ffy.financial_year_id, ffy.id
+    ON CONFLICT (financial_year_id, funder_id) DO NOTHING
+"""
+)
+
+# Point the funder years of funders with a successor at the final successor's
+# funder financial year for the same financial year. Returns the funder
+# financial years the funder years belonged to, and moved from and to.
+TRANSFER_TO_SUCCESSOR_QUERY = (
+    SUCCESSOR_CHAIN_CTE
+    + """
+    UPDATE ukgrantmaking_funderyear AS fyr
+    SET new_funder_financial_year_id = successor_ffy.id
+    FROM ukgrantmaking_funderyear AS old_fyr
+        INNER JOIN ukgrantmaking_funderfinancialyear AS ffy
+            ON old_fyr.funder_financial_year_id = ffy.id
+        INNER JOIN final_successor AS fs
+            ON ffy.funder_id = fs.org_id
+        INNER JOIN ukgrantmaking_funderfinancialyear AS successor_ffy
+            ON successor_ffy.funder_id = fs.successor_id
+            AND successor_ffy.financial_year_id = ffy.financial_year_id
+    WHERE fyr.id = old_fyr.id
+        AND fyr.new_funder_financial_year_id IS DISTINCT FROM successor_ffy.id
+    RETURNING fyr.funder_financial_year_id,
+        old_fyr.new_funder_financial_year_id,
+        fyr.new_funder_financial_year_id
+"""
+)
+
+# Copy the segment, inclusion and tags of funders to their funder financial
+# years for the current financial year.
+UPDATE_CURRENT_YEAR_QUERIES = [
+    """
+    UPDATE ukgrantmaking_funderfinancialyear AS ffy
+    SET segment = f.segment,
+        included = f.included,
+        makes_grants_to_individuals = f.makes_grants_to_individuals
+    FROM ukgrantmaking_funder AS f
+    WHERE ffy.funder_id = f.org_id
+        AND ffy.id = ANY(%(funder_financial_year_ids)s)
+    """,
+    """
+    DELETE FROM ukgrantmaking_funderfinancialyear_tags
+    WHERE funderfinancialyear_id = ANY(%(funder_financial_year_ids)s)
+    """,
+    """
+    INSERT INTO ukgrantmaking_funderfinancialyear_tags
+        (funderfinancialyear_id, fundertag_id)
+    SELECT ffy.id, ft.fundertag_id
+    FROM ukgrantmaking_funderfinancialyear AS ffy
+        INNER JOIN ukgrantmaking_funder_tags AS ft
+            ON ffy.funder_id = ft.funder_id
+    WHERE ffy.id = ANY(%(funder_financial_year_ids)s)
+    """,
+]
+
+
+@dataclass
+class DirtyRecords:
+    funders: set[str] = field(default_factory=set)
+    funder_financial_years: set[int] = field(default_factory=set)
+
+
+_dirty_records: ContextVar[DirtyRecords | None] = ContextVar(
+    "dirty_records", default=None
+)
+
+
+def defer_funder(org_id: str) -> bool:
+    """
+    Mark a funder as needing its related records updated. Returns False if
+    there is no `deferred_recompute` block, and the caller should update
+    them straight away.
+    """
+    dirty = _dirty_records.get()
+    if dirty is None:
+        return False
+    dirty.funders.add(org_id)
+    return True
+
+
+def defer_funder_financial_years(*ids: int | None) -> bool:
+    """
+    Mark funder financial years as needing their values recalculated from
+    their funder years. Returns False if there is no `deferred_recompute`
+    block.
+    """
+    dirty = _dirty_records.get()
+    if dirty is None:
+        return False
+    dirty.funder_financial_years.update(id_ for id_ in ids if id_ is not None)
+    return True
+
+
+@contextmanager
+def deferred_recompute() -> Iterator[DirtyRecords]:
+    """
+    Defer the updates that run when a `Funder` or `FunderYear` is saved.
+
+    Inside the block, saves only record which funders and funder financial
+    years have changed. When the block exits the updates are run once for
+    all of them, rather than once for every save. Nested blocks are merged
+    into the outermost one. The block runs in a transaction, so if it raises
+    an exception its saves are rolled back along with the updates.
+    """
+    if _dirty_records.get() is not None:
+        yield _dirty_records.get()
+        return
+
+    dirty = DirtyRecords()
+    with transaction.atomic():
+        token = _dirty_records.set(dirty)
+        try:
+            yield dirty
+        finally:
+            _dirty_records.reset(token)
+        recompute(dirty)
+
+
+def recompute(dirty: DirtyRecords) -> None:
+    if not dirty.funders and not dirty.funder_financial_years:
+        return
+
+    # imported here as the models use this module
+    from ukgrantmaking.utils.funder_year import refresh_funder_financial_years
+
+    with transaction.atomic():
+        funder_financial_year_ids = set(dirty.funder_financial_years)
+        if dirty.funders:
+            funder_financial_year_ids |= recompute_funders(dirty.funders)
+        if funder_financial_year_ids:
+            refresh_funder_financial_years(funder_financial_year_ids)
+    logger.info(
+        "Recomputed %s funders and %s funder financial years",
+        len(dirty.funders),
+        len(funder_financial_year_ids),
+    )
+
+
+def recompute_funders(org_ids: Iterable[str]) -> set[int]:
+    """
+    Do the updates from `Funder.save` for a set of funders at once.
+
+    Returns the IDs of the funder financial years that need their values
+    recalculated.
+    """
+    from ukgrantmaking.models.financial_years import (
+        FinancialYear,
+        FinancialYearStatus,
+    )
+    from ukgrantmaking.models.funder import Funder, FunderTag
+    from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
+    from ukgrantmaking.models.funder_year import FunderYear
+
+    funders = list(Funder.objects.filter(org_id__in=set(org_ids)))
+    funder_ids = [funder.org_id for funder in funders]
+
+    # make sure the funders have the last five funder financial years, and one
+    # for the current financial year
+    current_fy = FinancialYear.objects.current()
+    fys = set(
+        FinancialYear.objects.filter(
+            models.Q(current=True) | ~models.Q(status=FinancialYearStatus.FUTURE)
+        ).order_by("-fy")[:5]
+    ) | {current_fy}
+    FunderFinancialYear.objects.bulk_create(
+        [
+            FunderFinancialYear(
+                funder=funder,
+                financial_year=fy,
+                segment=funder.segment,
+                included=funder.included,
+                makes_grants_to_individuals=funder.makes_grants_to_individuals,
+            )
+            for funder in funders
+            for fy in fys
+        ],
+        ignore_conflicts=True,
+    )
+
+    # update auto-generated tags
+    tag_links = []
+    for prefix, slug in FUNDER_TAG_PREFIXES.items():
+        tagged = [funder for funder in funders if funder.org_id.startswith(prefix)]
+        if not tagged:
+            continue
+        tag_object, _ = FunderTag.objects.get_or_create(
+            slug=slug, defaults={"tag": slug.upper()}
+        )
+        tag_links.extend(
+            Funder.tags.through(funder_id=funder.org_id, fundertag_id=tag_object.pk)
+            for funder in tagged
+        )
+    Funder.tags.through.objects.bulk_create(tag_links, ignore_conflicts=True)
+
+    # set the current funder financial year, and copy the latest values to it
+    current_years = dict(
+        FunderFinancialYear.objects.filter(
+            funder_id__in=funder_ids, financial_year=current_fy
+        ).values_list("funder_id", "id")
+    )
+    Funder.objects.bulk_update(
+        [
+            Funder(org_id=org_id, current_year_id=ffy_id)
+            for org_id, ffy_id in current_years.items()
+        ],
+        ["current_year"],
+    )
+    changed = set(current_years.values())
+    if current_fy.status == FinancialYearStatus.OPEN:
+        with connection.cursor() as cursor:
+            for query in UPDATE_CURRENT_YEAR_QUERIES:
+                cursor.execute(
+                    query, {"funder_financial_year_ids": list(current_years.values())}
+                )
+
+    # transfer financial years to successors
+    changed |= transfer_to_successors(funder_ids)
+
+    # funder years that have been transferred also change the totals
+    changed.update(
+        FunderYear.objects.filter(
+            funder_financial_year__funder_id__in=funder_ids,
+            new_funder_financial_year__isnull=False,
+        ).values_list("new_funder_financial_year_id", flat=True)
+    )
+    return changed
+
+
+def transfer_to_successors(funder_ids: Iterable[str] | None = None) -> set[int]:
+    """
+    Move the funder years of funders that have been taken over to the final
+    successor in their chain of successors, creating the successor's funder
+    financial years where needed.
+
+    Funders whose chain includes one of `funder_ids` are transferred, which
+    covers the funders themselves and all of their predecessors, or every
+    funder if `funder_ids` is None. Returns the IDs of the funder financial
+    years that need their values recalculated.
+    """
+    # imported here as the models use this module
+    from ukgrantmaking.models.funder_utils import RecordStatus
+
+    params = {
+        "all_funders": funder_ids is None,
+        "funder_ids": [] if funder_ids is None else list(funder_ids),
+        "checked": RecordStatus.UNCHECKED,
+    }
+    changed = set()
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_SUCCESSOR_FINANCIAL_YEARS_QUERY, params)
+        cursor.execute(TRANSFER_TO_SUCCESSOR_QUERY, params)
+        for ffy_ids in cursor.fetchall():
+            changed.update(ffy_id for ffy_id in ffy_ids if ffy_id is not None)
+    return changed
@@ -0,0 +1,77 @@
+from pathlib import Path
+from typing import Iterator
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from ukgrantmaking.utils import DEFAULT_BATCH_SIZE, batched
+
+
+def iter_spreadsheet(
+    file: str | Path,
+    sheet: str | None = None,
+    skip_rows: int = 0,
+    columns: list[str] | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Iterator[pd.DataFrame]:
+    """
+    Read a spreadsheet in batches of rows, returning a dataframe for each
+    batch.
+
+    Excel files are opened in read-only mode, so rows are streamed from the
+    file rather than the whole workbook being loaded into memory. CSV files
+    are read in chunks. The first row after `skip_rows` is used as the
+    header, and `columns` can be used to only keep some of the columns.
+    """
+    if Path(file).suffix.lower() == ".csv":
+        for df in pd.read_csv(
+            file, skiprows=skip_rows, usecols=columns, chunksize=batch_size
+        ):
+            yield df
+        return
+
+    wb = load_workbook(filename=file, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet else wb.worksheets[0]
+        rows = ws.iter_rows(min_row=skip_rows + 1, values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        header = [
+            str(value) if value is not None else f"Unnamed: {i}"
+            for i, value in enumerate(header)
+        ]
+        width = len(header)
+        for batch in batched(rows, batch_size):
+            # skip blank rows, and make every row the same width as the header
+            batch = [
+                row[:width] + (None,) * (width - len(row))
+                for row in batch
+                if any(value is not None for value in row)
+            ]
+            if not batch:
+                continue
+            df = pd.DataFrame(batch, columns=header)
+            if columns is not None:
+                df = df[columns]
+            yield df
+    finally:
+        wb.close()
+
+
+def read_spreadsheet(
+    file: str | Path,
+    sheet: str | None = None,
+    skip_rows: int = 0,
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """
+    Read the whole of a spreadsheet into a single dataframe, using the same
+    streaming reader as `iter_spreadsheet`.
+    """
+    batches = list(
+        iter_spreadsheet(file, sheet=sheet, skip_rows=skip_rows, columns=columns)
+    )
+    if not batches:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(batches, ignore_index=True)
@@ -1,11 +1,14 @@
 import re
+from functools import lru_cache
 from typing import Any
 
+import pandas as pd
 import titlecase
 
 VOWELS = re.compile("[AEIOUYaeiouy]")
 ORD_NUMBERS_RE = re.compile(r"([0-9]+(?:st|nd|rd|th))")
 SENTENCE_SPLIT = re.compile(r"(\. )")
+TITLECASE_CACHE_SIZE = 100_000
 
 
 def title_exceptions(word: str, **kwargs) -> str | None:
@@ -106,6 +109,11 @@ def to_titlecase(s: Any, sentence: bool = False) -> Any:
     if not s.isupper() and not s.islower():
         return s
 
+    return _to_titlecase(s, sentence)
+
+
+@lru_cache(maxsize=TITLECASE_CACHE_SIZE)
+def _to_titlecase(s: str, sentence: bool) -> str:
     # if it's a sentence then use capitalize
     if sentence:
         return "".join([sent.capitalize() for sent in re.split(SENTENCE_SPLIT, s)])
@@ -117,6 +125,21 @@ def to_titlecase(s: Any, sentence: bool = False) -> Any:
     return s[0].upper() + s[1:]
 
 
+def to_titlecase_series(series: pd.Series, sentence: bool = False) -> pd.Series:
+    """
+    Apply `to_titlecase` to a series of names. Each distinct name is only
+    titlecased once, and the results are cached between calls.
+    """
+    is_str = series.map(lambda value: isinstance(value, str)).astype(bool)
+    if not is_str.any():
+        return series
+    names = series[is_str]
+    lookup = {name: to_titlecase(name, sentence) for name in names.unique()}
+    result = series.astype(object).copy()
+    result[is_str] = names.map(lookup)
+    return result
+
+
 def regex_search(s: str, regex: str) -> bool:
     return re.search(regex, s) is not None
 
@@ -30,6 +30,7 @@ from ukgrantmaking.models.funder import Funder, FunderTag
 from ukgrantmaking.models.funder_financial_year import FunderFinancialYear
 from ukgrantmaking.models.funder_utils import RecordStatus
 from ukgrantmaking.models.funder_year import FunderYear
+from ukgrantmaking.utils.recompute import deferred_recompute
 from ukgrantmaking.utils.text import to_titlecase
 
 
@@ -594,6 +595,9 @@ def edit_funderyear(funder_year: FunderYear, request, suffix: str = "cy"):
     if changed_values:
         funder_year.funder_financial_year.checked_on = timezone.now()
         funder_year.funder_financial_year.checked_by = request.user
+        funder_year.funder_financial_year.save(
+            update_fields=["checked_on", "checked_by"]
+        )
         funder_year.save()
 
         LogEntry.objects.log_actions(
@@ -665,17 +669,22 @@ def htmx_edit_funderyear(request, org_id, funderyear_id=None):
         if request.POST.get("action") == "cancel":
             context["edit"] = False
         else:
-            context["funder_year"] = edit_funderyear(funder_year, request, suffix="cy")
+            # update the funder financial years once for both funder years
+            with deferred_recompute():
+                context["funder_year"] = edit_funderyear(
+                    funder_year, request, suffix="cy"
+                )
 
-            if request.POST.get("py-id"):
-                context["funder_year_py"] = FunderYear.objects.filter(
-                    funder_financial_year__funder=funder, id=request.POST.get("py-id")
-                ).first()
+                if request.POST.get("py-id"):
+                    context["funder_year_py"] = FunderYear.objects.filter(
+                        funder_financial_year__funder=funder,
+                        id=request.POST.get("py-id"),
+                    ).first()
 
-            if context["funder_year_py"]:
-                context["funder_year_py"] = edit_funderyear(
-                    context["funder_year_py"], request, suffix="py"
-                )
+                if context["funder_year_py"]:
+                    context["funder_year_py"] = edit_funderyear(
+                        context["funder_year_py"], request, suffix="py"
+                    )
             context["edit"] = False
     return render(
         request,